@@ -18,6 +18,145 @@ Copyright 2010 VendAsta Technologies Inc.
 
 Release Notes:
 
+v2.1.0
+- added "python -m fantasm.build compile [fsm.yaml]", which writes a precompiled fsm.yaml.compiled artifact
+  holding the validated configuration and the FSM factory's State/Transition tables. It is used on startup
+  in place of parsing the .yaml as long as the digests of the .yaml file and its imports still match, and it
+  was built by the same fantasm code (fantasm.__version__ and a digest of the fantasm sources); otherwise the
+  .yaml is parsed again.
+- added "lazy_actions: True" (top-level in fsm.yaml), which defers importing/instantiating entry, exit and
+  action classes until their first use. Run "python -m fantasm.build validate [fsm.yaml]" before deploying
+  to import and check every action eagerly.
+- the URL path and task-name suffix of each (state, event) are now built once, when the FSM factory is
+  built (State.getDispatchPlan()), instead of on every dispatch. Precompiled artifacts from earlier
+  versions are ignored and must be rebuilt.
+- added machine-level "payload_format: json". POST tasks then carry the whole typed context as a single
+  JSON body (Content-Type: application/json), which FSMHandler decodes in one pass; values no longer need a
+  context_types entry to arrive typed, and values that are not of their context_types are still cast as in
+  the urlencoded format. As in the urlencoded format, only keys declared "pickle" in context_types are
+  unpickled. GET tasks, and machines without the attribute, keep the urlencoded params format.
+  FSMHandler picks the decoder from the Content-Type, so tasks already queued in either format still run
+  after switching.
+- added machine-level "compression_threshold: <bytes>". POST task bodies and fan-in work packages
+  (_FantasmFanIn.context) larger than this are zlib-compressed behind a marker, and transparently
+  decompressed by FSMHandler and JSONProperty. fantasm.utils.Metrics.ratio('compression.task') and
+  Metrics.ratio('compression.jsonProperty') report the compression ratio achieved in the current process.
+- added machine-level "offload_threshold: <bytes>". Context values whose pickle is larger than this are
+  written once to a _FantasmContextBlob (keyed by content hash) and tasks carry only a reference, which
+  FSMContext resolves the first time the key is read (context[key], .get(), .pop(), .items(), .values());
+  unread references are passed along as-is, under their own task param (__cb__), so no user value is mistaken
+  for one. The clones of a fork/spawn fan-out pickle a value they still share once between them.
+  _FantasmContextBlob is scrubbed by createdTime with the other models; storing a value again resets it, and so
+  does passing an unread reference along a day (CONTEXT_BLOB_REFRESH_AGE) after that.
+- FSMContext.clone() (and so .fork()) is now copy-on-write: the first clone deep-copies the mutable values once,
+  and the context and all its clones share those copies, copying a value again only when they read or replace it
+  (fork x 1000: ~140k forks/s, was ~4.7k, see fantasm_tests.benchmarks). As a result, a mutable value the caller
+  set or read before cloning is detached from the context: mutating it in place no longer changes the context.
+  The dict API is otherwise unchanged, but dict(context) and {**context} bypass FSMContext and may expose shared
+  values.
+- added FSMContext.fork(data, nextEvent=...). When the action passes the event it will return, each forked
+  context is turned into a Task right away and the Tasks are queued in batches of MAX_TASKS_PER_ADD while
+  the action is still running, instead of all being held until it returns. Task names are the same as
+  before, so a retried action re-queues nothing twice.
+- fsm._queueTasks() (used by startStateMachine() and fork()) now adds its MAX_TASKS_PER_ADD batches
+  concurrently with Queue.add_async(), up to constants.MAX_TASK_ADD_RPCS_IN_FLIGHT at a time; it used to add
+  them one after another. If some Tasks already existed, the TaskAlreadyExistsError/TombstonedTaskError it
+  raises lists them in .alreadyEnqueuedTasks. Test doubles that replace Queue.add must now replace
+  Queue.add_async as well (see fantasm_tests.helpers.TaskQueueDouble).
+- added startStateMachine(..., treeSpawnSize=N) (and FSMContext.spawn(..., treeSpawnSize=N)). With more than
+  N contexts, the contexts are written to _FantasmContextBlobs in slices of N (halved until a slice fits in
+  constants.CONTEXT_BLOB_MAX_SIZE; a single larger context raises SpawnContextTooLargeRuntimeError), and a tree
+  of spawner tasks (up to constants.TREE_SPAWN_FAN_OUT children each) queues the machines, so the calling
+  request does not build every FSMContext and Task itself. Spawner task names derive from taskName
+  ('<taskName>--spawn-3-1'), so the whole spawn is idempotent. The spawner tasks run on the machine's default
+  queue and target, and are handled by the new handlers.FSMSpawnHandler, mounted at /fantasm/spawn/ (the
+  "spawn" route of wrap_wsgi_app()).
+- fan-in work packages (_FantasmFanIn) are now stored under "fan_in_entity_groups: N" (state-level, default
+  constants.DEFAULT_FAN_IN_ENTITY_GROUPS = 8) parent keys per workIndex, and read back with strongly consistent
+  ancestor queries (_FantasmFanIn.fetchWorkIndex()). An entity group takes about one write per second, so a
+  single workIndex takes about N work packages per second; raise N for fan-ins with more writers. Changing N
+  hides the work packages of in-flight fan-ins, so let those drain first. The 5 second
+  DATASTORE_ASYNCRONOUS_INDEX_WRITE_WAIT_TIME sleeps in the fan-out retry path and in every fan-in are gone;
+  the constant is kept, but no longer used. Work packages written by earlier versions have no parent, and are
+  also read with a workIndex query while constants.FAN_IN_READ_ROOT_WORK_PACKAGES is True (the default); set it
+  to False once the fan-ins in flight during the upgrade are done, to save that query.
+- the contexts a fan-in action receives are now an FSMContextList, a list that reads the work packages from
+  the datastore the first time it is used. Added state-level "fan_in_max_contexts: N": the list is then read
+  lazily each time it is iterated over (len(), indexing and "in" still work, but load every context), and a
+  fan-in hands at most N contexts to its action and queues the rest as a follow-up fan-in chunk (task names
+  end in '-chunk-1', '-chunk-2', ...) that continues after the last work package of the previous chunk.
+  Precompiled artifacts from earlier versions are ignored and must be rebuilt.
+- added state-level "fan_in_combiner: ClassName" for fan_in states. The class has a combine(context, other)
+  method (see action.FSMFanInCombiner) that merges other into context, e.g., by summing a counter. The
+  contexts an action forks towards the fan-in are then combined in the forking Task, and one work package is
+  written per fan_in_group value instead of one per fork, so the fan-in reads far fewer work packages.
+  Precompiled artifacts from earlier versions are ignored and must be rebuilt.
+- the memcache release of a fan-out's write lock now runs while the fan-in Task is queued. The run-once
+  semaphore of a work package and the work package itself are now written in one cross-group transaction and
+  one datastore put (RunOnceSemaphore.writeRunOnceSemaphoreWithEntities()), so that every write of a fork
+  agrees on its workIndex; a retried Task no longer reads the semaphore beforehand.
+- lock.ReadWriteLock now keeps its counters in a pluggable lock.LockBackend. lock.MemcacheLockBackend is the
+  default; lock.setLockBackend(lock.InProcessLockBackend()) keeps them in a dict, for local runs where every
+  Task runs in one process. The 2**16/2**15 counter offsets are now constants.WRITE_LOCK_OFFSET and
+  constants.READ_LOCK_OFFSET.
+- added state-level "fan_in_read_lock_countdown: <seconds>" for fan_in states. When the fan-in Task finds
+  writers still in flight, it re-queues itself with this countdown (Task names end in '-read-lock-wait-1',
+  ...) instead of busy-waiting for up to 5 seconds, and fans in regardless after
+  constants.FAN_IN_READ_LOCK_MAX_WAITS re-queues. Follow-up fan_in_max_contexts chunks no longer re-acquire
+  the read lock. Precompiled artifacts from earlier versions are ignored and must be rebuilt.
+- added state-level "fan_in_shards: N" for fan_in states. The fanned-in contexts are spread over N shards
+  by a hash of their work package key name, and each shard is an independent fan-in with its own lock, work
+  index and fan-in Task, so the shards fan in in parallel. The shard is carried in the context, and Task
+  names of the fan-in and the states after it end in '-shard-<n>'. To merge the shards, transition (now or
+  in a later state) to another fan_in state; a fan-in after a sharded fan-in is allowed and fans the shards
+  in again. Precompiled artifacts from earlier versions are ignored and must be rebuilt.
+- fan-in cleanup deletes the work packages with keys-only queries, in batches of 500 async deletes, and
+  continues in another cleanup Task when there are too many for one request
+- added state-level "fan_in_cleanup_period: <seconds>" for fan_in states. The workIndexes of the fan-ins of a
+  period are collected in memcache, and one cleanup Task deletes all of their work packages after the period
+  is over, instead of one cleanup Task per fan-in. Evicted workIndexes are left to the scrubber.
+- added state-level "fan_in_expected: N" for fan_in states, where N is a count or the context key the count is
+  stored in. Writers count their work packages in a sharded memcache counter, and the writer that reaches N
+  fires the fan-in right away; the Task queued for the end of the fan_in period becomes a no-op.
+- added state-level "fan_in_adaptive: True" for fan_in states. The fan-in waits twice the arrival span of the
+  work packages of the previous fan-in of the same state and event, with the fan_in period as the upper bound.
+- FSMContext.initialize() queues its Task and writes its _FantasmInstance concurrently
+- added machine-level "instance_rows: False" to skip the _FantasmInstance writes of a machine, and
+  startStateMachine(..., instanceRows=True) / FSMContext.spawn(..., instanceRows=True) to write the
+  _FantasmInstances of all the started machines in one multi-put, while their Tasks are queued
+- added machine-level "run_once_semaphore_mode: strict|fast" (default strict). In fast mode the duplicate Task
+  guard of FSMHandler checks an in-process LRU of recent semaphores, then does a memcache.add(), and only falls
+  back to the datastore transaction when memcache can neither add nor find the semaphore.
+  RunOnceSemaphore.addRunOnceSemaphores() does the same for a batch of semaphores, and Metrics counts
+  'runOnceSemaphore.duplicates', '.lruHits' and '.datastoreFallbacks'.
+- added action.NDBPrefetchingContinuationFSMAction: an NDB continuation that starts the keys-only query of the
+  next page while it fetches the entities of the current page and runs execute(), and then queues the next
+  continuation Task with the next page's keys in its token, so that Task does not run a query of its own. With
+  method GET, a page whose keys would not fit in the url (CONTINUATION_PREFETCH_MAX_GET_TOKEN_LENGTH) is handed
+  over as a cursor instead, and the next Task queries its page with the entities; use method POST to prefetch
+  every page. DatastoreContinuationFSMAction now also continues after a short page when the action reports more
+  results. FSMContext.continuation() takes a snapshot, to queue the next Task with a context from before
+  execute().
+- added action.ShardedDatastoreContinuationFSMAction: an NDB continuation that splits the query into key ranges
+  (from a __scatter__ sample, or getSplitKeys()) and runs each key range as its own chain of continuation Tasks,
+  named with 'continuation-shard-N'. A fan_in state after it joins the key ranges, and its
+  checkFanInForTotalResultsCount() adds up CONTINUATION_RESULTS_COUNTER_PARAM across them. The split keys are
+  written to a _FantasmContextBlob, so that a retry of the first Task uses the same key ranges.
+- added ContinuationFSMAction.getTargetBatchTime(): when it returns a number of seconds, datastore and list
+  continuations size each batch from the time per result of the last batch (kept in the lock backend), between 1
+  and getMaxBatchSize(). The batch size is decided by the Task that queues the batch and carried in the context,
+  so a retried Task fetches the same batch. A retry, which may follow a deadline that kept the batch from
+  recording its time, records at least twice the target time for it, so the next batch is at most half its size.
+- added action.StoredListContinuationFSMAction: a list continuation that calls getList() once, writes the list to
+  _FantasmContextBlobs in compressed chunks of getChunkSize() items (models.StoredList), and has every later Task
+  read only the chunks of its own batch.
+- added the state attributes "continuation_batches" and "continuation_seconds": a continuation state runs up to
+  continuation_batches batches in the same Task, for at most continuation_seconds, and then queues the Task of the
+  next batch. Each batch keeps the context and Task names it would have had in its own Task. A retry of such a
+  Task stops where an earlier attempt stopped, or after the batches it completed, and keeps continuation_seconds;
+  note that it runs the actions of those batches again.
+- fixed models.Encoder writing ndb keys as "b'...'" strings that could not be decoded
+
 v2.0.1
 - allow _findYaml to find the yaml file if we are installed in a venv beside the src directory
 
@@ -81,7 +220,7 @@ v1.0.0
 
 """
 
-__version__ = '2.0.1'
+__version__ = '2.1.0'
 
 from fantasm import console
 from fantasm import handlers
@@ -116,6 +255,7 @@ def FantasmMiddleware(app, wsgi_env, start_response):
         routes = {
             'fsm': handlers.FSMHandler,
             'cleanup': handlers.FSMFanInCleanupHandler,
+            'spawn': handlers.FSMSpawnHandler,
             'log': handlers.FSMLogHandler,
         }
         path_segment = path.split('/')[2]
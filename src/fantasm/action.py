@@ -16,6 +16,9 @@ Copyright 2010 VendAsta Technologies Inc.
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import json
+import time
+import urllib.parse
 
 from fantasm.constants import CONTINUATION_RESULTS_KEY
 from fantasm.constants import CONTINUATION_RESULT_KEY
@@ -23,6 +26,16 @@ from fantasm.constants import CONTINUATION_MORE_RESULTS_KEY
 from fantasm.constants import CONTINUATION_RESULTS_COUNTER_PARAM
 from fantasm.constants import CONTINUATION_RESULTS_SIZE_PARAM
 from fantasm.constants import CONTINUATION_COMPLETE_PARAM
+from fantasm.constants import CONTINUATION_SHARD_PARAM
+from fantasm.constants import CONTINUATION_SHARDS_PARAM
+from fantasm.constants import CONTINUATION_SCATTER_OVERSAMPLING
+from fantasm.constants import CONTINUATION_BATCH_SIZE_PARAM
+from fantasm.constants import CONTINUATION_MAX_BATCH_SIZE
+from fantasm.constants import CONTINUATION_PREFETCH_MAX_GET_TOKEN_LENGTH
+from fantasm.constants import DEFAULT_CONTINUATION_SHARDS
+from fantasm.constants import TASK_NAME_PARAM
+from fantasm.constants import RETRY_COUNT_PARAM
+from fantasm.constants import DEFAULT_STORED_LIST_CHUNK_SIZE
 from fantasm.constants import STEPS_PARAM
 from fantasm.constants import GEN_PARAM
 
@@ -43,9 +56,27 @@ class FSMAction:
         """
         raise NotImplementedError()
 
+class FSMFanInCombiner:
+    """ Defines the interface for fan_in_combiner classes. """
+
+    def combine(self, context, other):
+        """ Merges the data of other into context, in place. The return value is ignored.
+
+        @param context: the FSMContext that is written down as the fan-in work package
+        @param other: another FSMContext bound for the same fan-in work index, which is then discarded
+
+        The fan-in action receives the combined FSMContexts instead of the original ones, so combine() must be
+        associative and must leave the context in the form the fan-in action expects, e.g., summing a counter.
+        It is run in the Task that forks the FSMContexts, and is run again over the same forks when that Task
+        is retried.
+        """
+        raise NotImplementedError()
+
 class ContinuationFSMAction(FSMAction):
     """ Defines the interface for all continuation actions. """
 
+    __STARTED_AT = '__batch_started_at__'
+
     def continuation(self, context, obj, token=None):
         """ Accepts a token (may be None) and returns the next token for the continutation.
 
@@ -85,6 +116,74 @@ class ContinuationFSMAction(FSMAction):
         """
         return context.get(CONTINUATION_RESULTS_SIZE_PARAM, 0)
 
+    # W0613: 78:DatastoreContinuationFSMAction.getBatchSize: Unused argument 'obj'
+    def getTargetBatchTime(self, context, obj): # pylint: disable=W0613
+        """ Returns the wall time, in seconds, that each continuation Task should take to fetch and execute its
+        batch, or None (the default) to always use getBatchSize(). Override to size batches adaptively.
+
+        With a target, getBatchSize() is the size of the first batch, and each later batch is sized from the time
+        per result of the last batch that completed, between 1 and getMaxBatchSize(). The size of a batch is
+        decided by the Task that queues it and carried in the context, so that a retried Task fetches the same
+        batch its first attempt did (the next continuation Task was queued with the token after that batch).
+        """
+        return None
+
+    # W0613: 78:DatastoreContinuationFSMAction.getBatchSize: Unused argument 'obj'
+    def getMaxBatchSize(self, context, obj): # pylint: disable=W0613
+        """ Returns the largest adaptive batch size, default CONTINUATION_MAX_BATCH_SIZE. """
+        return CONTINUATION_MAX_BATCH_SIZE
+
+    def recordBatchTime(self, context, obj):
+        """ Records the time per result of the batch that was just executed, for getTargetBatchTime(). Called
+        after execute() on continuation states, and so also where NDBPrefetchingContinuationFSMAction finishes
+        its batch.
+
+        The time is kept in the lock backend, rather than in the context, because the next continuation Task is
+        queued before execute() runs.
+        """
+        from fantasm.lock import getLockBackend
+
+        startedAt = obj.get(self.__STARTED_AT)
+        size = len(obj.get(CONTINUATION_RESULTS_KEY) or [])
+        if startedAt is not None and size:
+            getLockBackend().set(self._getBatchTimeKey(context), (time.time() - startedAt) / size)
+
+    def _getBatchSize(self, context, obj):
+        """ Returns the size of this batch, and puts the size of the next batch in the context, see
+        getTargetBatchTime(). """
+        from fantasm.lock import getLockBackend
+
+        target = self.getTargetBatchTime(context, obj)
+        if not target:
+            return self.getBatchSize(context, obj)
+
+        obj[self.__STARTED_AT] = time.time()
+        size = context.get(CONTINUATION_BATCH_SIZE_PARAM) or self.getBatchSize(context, obj)
+        nextSize = size
+        timePerResult = getLockBackend().get(self._getBatchTimeKey(context))
+        if obj.get(RETRY_COUNT_PARAM):
+            # the attempt before may have hit the deadline, and so never got to recordBatchTime(); this batch keeps
+            # its size (see getTargetBatchTime()), but it is taken to have run twice the target, halving the next
+            timePerResult = max(timePerResult or 0, 2.0 * target / size)
+            getLockBackend().set(self._getBatchTimeKey(context), timePerResult)
+        if timePerResult:
+            nextSize = int(target / timePerResult)
+        context[CONTINUATION_BATCH_SIZE_PARAM] = max(1, min(nextSize, self.getMaxBatchSize(context, obj)))
+        return size
+
+    @staticmethod
+    def _getBatchTimeKey(context):
+        """ Returns the lock backend key of the time per result of a continuation. """
+        return 'fantasm-batch-time-%s-%s' % (context.instanceName, context.currentState.name)
+
+    def _countResults(self, context, obj, limit, token=None):
+        """ Returns the number of results of this continuation so far, including this batch. """
+        size = len(obj[CONTINUATION_RESULTS_KEY])
+        if CONTINUATION_BATCH_SIZE_PARAM in context:
+            # batch sizes vary, so the count is carried from the previous continuation Task
+            return (context.get(CONTINUATION_RESULTS_COUNTER_PARAM, 0) if token else 0) + size
+        return context.get(GEN_PARAM, {}).get(str(context[STEPS_PARAM]), 0) * limit + size
+
 class DatastoreContinuationFSMAction(ContinuationFSMAction):
     """ A datastore continuation. """
 
@@ -94,7 +193,7 @@ class DatastoreContinuationFSMAction(ContinuationFSMAction):
         """ Accepts a token (an optional cursor) and returns the next token for the continutation.
         The results of the query are stored on obj.results.
         """
-        limit = self.getBatchSize(context, obj)
+        limit = self._getBatchSize(context, obj)
         results = self._fetchResults(limit, context, obj, token=token)
 
         # place results on obj.results
@@ -108,11 +207,12 @@ class DatastoreContinuationFSMAction(ContinuationFSMAction):
             obj[CONTINUATION_RESULT_KEY] = None
         obj.result = obj[CONTINUATION_RESULT_KEY] # deprecated interface
 
-        context[CONTINUATION_RESULTS_COUNTER_PARAM] = \
-            context.get(GEN_PARAM, {}).get(str(context[STEPS_PARAM]), 0) * limit + len(obj[CONTINUATION_RESULTS_KEY])
+        context[CONTINUATION_RESULTS_COUNTER_PARAM] = self._countResults(context, obj, limit, token=token)
         context[CONTINUATION_RESULTS_SIZE_PARAM] = len(obj[CONTINUATION_RESULTS_KEY])
 
-        if len(obj[CONTINUATION_RESULTS_KEY]) == limit:
+        # a page can be short of entities that were deleted after their keys were queried, see
+        # NDBPrefetchingContinuationFSMAction
+        if len(obj[CONTINUATION_RESULTS_KEY]) == limit or obj.get(CONTINUATION_MORE_RESULTS_KEY):
             nextToken = self._getNextToken(context, obj, token=token)
             if nextToken:
                 context[CONTINUATION_COMPLETE_PARAM] = False
@@ -209,9 +309,257 @@ class NDBDatastoreContinuationFSMAction(DatastoreContinuationFSMAction):
         """ Returns the RPC deadline. Default 5 seconds."""
         return 0    # Strong Consistency
 
+class NDBPrefetchingContinuationFSMAction(NDBDatastoreContinuationFSMAction):
+    """ An NDB datastore continuation that overlaps the query of the next page with the fetch of the current one.
+
+    Each Task starts the keys-only query of the next page with fetch_page_async(), fetches the entities of its
+    own page and runs execute() while that query runs, and then (see recordBatchTime()) queues the next
+    continuation Task with the keys of the next page (and the cursor after them) in the token, so that the next
+    Task skips its own query. The next Task is queued with the context as it was before execute(), as with
+    other continuations, and is not queued at all when the next page is empty.
+
+    The token holds the urlsafe keys of a whole page. With method GET, a page whose keys would not fit in the url
+    (see CONTINUATION_PREFETCH_MAX_GET_TOKEN_LENGTH) is passed as a cursor instead, and the next Task queries its
+    page, entities and all, itself; use method POST to prefetch every page.
+    """
+
+    __NEXT_TOKEN = '__next_token__'
+    __NEXT_PAGE = '__next_page__'
+    __CONTEXT = '__prefetching_context__'
+
+    def continuation(self, context, obj, token=None):
+        """ see DatastoreContinuationFSMAction.continuation(); while the next page is queried, returns None, and
+        the next continuation Task is queued by recordBatchTime() """
+        nextToken = super().continuation(context, obj, token=token)
+        if obj.get(self.__NEXT_PAGE) is not None:
+            context[CONTINUATION_COMPLETE_PARAM] = False
+            obj[self.__CONTEXT] = context.clone()
+        return nextToken
+
+    def recordBatchTime(self, context, obj):
+        """ see ContinuationFSMAction.recordBatchTime(); also waits for the query of the next page, which ran
+        along with execute(), and queues the next continuation Task with its keys """
+        super().recordBatchTime(context, obj)
+        nextPage = obj.pop(self.__NEXT_PAGE, None)
+        if nextPage is None:
+            return
+        nextKeys, nextCursor, more = nextPage.get_result()
+        if nextKeys:
+            nextToken = json.dumps({
+                'keys': [_str(key.urlsafe()) for key in nextKeys],
+                'cursor': more and _str(nextCursor.to_websafe_string()) or None,
+            })
+            context.continuation(nextToken, snapshot=obj.pop(self.__CONTEXT))
+        else:
+            obj[CONTINUATION_MORE_RESULTS_KEY] = False
+            context[CONTINUATION_COMPLETE_PARAM] = True
+
+    def _fetchResults(self, limit, context, obj, token=None):
+        """ Actually fetches the results. """
+        from google.appengine.ext import ndb
+        from google.appengine.ext.ndb import query as ndb_query
+
+        query = self.getQuery(context, obj)
+        assert isinstance(query, ndb_query.Query)
+
+        options = {
+            'deadline': self.getDeadline(context, obj),
+            'read_policy': self.getReadPolicy(context, obj),
+        }
+
+        keysOnly = self.getKeysOnly(context, obj)
+        prefetched = json.loads(token) if token else {'keys': None, 'cursor': None}
+        cursor = prefetched['cursor'] and ndb_query.Cursor.from_websafe_string(prefetched['cursor'])
+        entities = None
+        if prefetched['keys'] is None:
+            # nothing was prefetched, so the page is queried with its entities in one go
+            page, cursor, more = query.fetch_page(limit, start_cursor=cursor, keys_only=keysOnly,
+                                                  produce_cursors=True, **options)
+            cursor = more and cursor
+            if keysOnly:
+                keys = page
+            else:
+                entities = page
+                keys = [entity.key for entity in page]
+        else:
+            keys = [ndb.Key(urlsafe=key) for key in prefetched['keys']]
+
+        # the next page has about as many keys as this one, so this tells whether they fit in the url
+        prefetch = context.method != 'GET' or \
+            len(urllib.parse.quote(json.dumps([_str(key.urlsafe()) for key in keys]))) <= \
+            CONTINUATION_PREFETCH_MAX_GET_TOKEN_LENGTH
+
+        # start the query of the next page, and fetch the entities of this page (and execute() them) while it runs
+        nextPage = None
+        nextToken = None
+        if cursor and prefetch:
+            nextPage = query.fetch_page_async(limit, start_cursor=cursor, keys_only=True, produce_cursors=True,
+                                              **options)
+        elif cursor:
+            nextToken = json.dumps({'keys': None, 'cursor': _str(cursor.to_websafe_string())})
+        if keysOnly:
+            results = keys
+        elif entities is not None:
+            results = entities
+        else:
+            results = [entity for entity in ndb.get_multi(keys, **options) if entity is not None]
+
+        obj[CONTINUATION_MORE_RESULTS_KEY] = nextToken is not None or nextPage is not None
+        obj[self.__NEXT_TOKEN] = nextToken
+        obj[self.__NEXT_PAGE] = nextPage
+        return results
+
+    def _getNextToken(self, context, obj, token=None):
+        """ Gets the next token. """
+        return obj.pop(self.__NEXT_TOKEN)
+
+class ShardedDatastoreContinuationFSMAction(NDBDatastoreContinuationFSMAction):
+    """ An NDB datastore continuation that splits the query into key ranges, and runs each key range as an
+    independent chain of continuation Tasks.
+
+    The first Task picks the split keys from a __scatter__ sample of the kind, queues the first continuation Task
+    of every other key range, and continues over the first key range itself. The Tasks of a key range have
+    'continuation-shard-N' in their names, so the states after the continuation run once per Task, and a fan_in
+    state after the continuation joins all the key ranges.
+
+    The query is filtered on __key__, so getQuery() must not have sort orders other than on the key.
+    CONTINUATION_RESULTS_COUNTER_PARAM counts the results of the key range so far, and
+    checkFanInForTotalResultsCount() adds up the key ranges once all of them are complete.
+    """
+
+    __NEXT_TOKEN = '__next_token__'
+
+    def continuation(self, context, obj, token=None):
+        """ Accepts a token (the key range and cursor of a shard) and returns the next token for the
+        continuation. The first Task (token None) queues the other shards. """
+        if not token:
+            token = self._startShards(context, obj)
+        count = json.loads(token)['count']
+        nextToken = super().continuation(context, obj, token=token)
+        context[CONTINUATION_RESULTS_COUNTER_PARAM] = count + len(obj[CONTINUATION_RESULTS_KEY])
+        return nextToken
+
+    def _startShards(self, context, obj):
+        """ Queues the first continuation Task of every key range but the first, and returns the token of the
+        first key range. """
+        from fantasm.models import _FantasmContextBlob
+
+        # the split keys are written down for the retries of this Task, since the shards already queued keep
+        # theirs; __scatter__ sampled again may pick other ones
+        taskName = obj.get(TASK_NAME_PARAM)
+        keyName = taskName and 'continuation-shards-' + taskName
+        data = _FantasmContextBlob.read(keyName) if keyName else None
+        if data is None:
+            data = json.dumps([_str(key.urlsafe()) for key in self.getSplitKeys(context, obj)]).encode('utf-8')
+            if keyName:
+                data = _FantasmContextBlob.writeOnce(keyName, data)
+        splitKeys = json.loads(data.decode('utf-8'))
+
+        bounds = [None] + splitKeys + [None]
+        context[CONTINUATION_SHARDS_PARAM] = len(bounds) - 1
+        context[CONTINUATION_SHARD_PARAM] = 0
+        for shard in range(1, len(bounds) - 1):
+            context.continuation(self._buildToken(bounds[shard], bounds[shard + 1]), shard=shard)
+        return self._buildToken(bounds[0], bounds[1])
+
+    @staticmethod
+    def _buildToken(start, end, cursor=None, count=0):
+        """ Returns the token of the shard [start, end), continuing at cursor. """
+        return json.dumps({'start': start, 'end': end, 'cursor': cursor, 'count': count})
+
+    def _fetchResults(self, limit, context, obj, token=None):
+        """ Actually fetches the results. """
+        from google.appengine.ext import ndb
+        from google.appengine.ext.ndb import query as ndb_query
+
+        query = self.getQuery(context, obj)
+        assert isinstance(query, ndb_query.Query)
+
+        shard = json.loads(token)
+        if shard['start']:
+            query = query.filter(ndb.Model._key >= ndb.Key(urlsafe=shard['start']))
+        if shard['end']:
+            query = query.filter(ndb.Model._key < ndb.Key(urlsafe=shard['end']))
+
+        kwargs = {
+            'produce_cursors': True,
+            'keys_only': self.getKeysOnly(context, obj),
+            'deadline': self.getDeadline(context, obj),
+            'read_policy': self.getReadPolicy(context, obj),
+        }
+        if shard['cursor']:
+            kwargs['start_cursor'] = ndb_query.Cursor.from_websafe_string(shard['cursor'])
+
+        results, cursor, more = query.fetch_page(limit, **kwargs)
+
+        obj[CONTINUATION_MORE_RESULTS_KEY] = more
+        obj[self.__NEXT_TOKEN] = more and self._buildToken(shard['start'], shard['end'],
+                                                           cursor=_str(cursor.to_websafe_string()),
+                                                           count=shard['count'] + len(results)) or None
+        return results
+
+    def _getNextToken(self, context, obj, token=None):
+        """ Gets the next token. """
+        return obj.pop(self.__NEXT_TOKEN)
+
+    # W0613: 78:DatastoreContinuationFSMAction.getBatchSize: Unused argument 'obj'
+    def getShardCount(self, context, obj): # pylint: disable=W0613
+        """ Returns the number of key ranges, default DEFAULT_CONTINUATION_SHARDS. Override for different
+        values. """
+        return DEFAULT_CONTINUATION_SHARDS
+
+    def getSplitKeys(self, context, obj):
+        """ Returns the sorted ndb.Keys that split the query into getShardCount() key ranges. Override to split
+        on known boundaries.
+
+        The default samples CONTINUATION_SCATTER_OVERSAMPLING __scatter__ keys per key range, as the mapreduce
+        library does. Small kinds may have too few __scatter__ keys, and get fewer key ranges.
+        """
+        from google.appengine.api import datastore
+        from google.appengine.ext import ndb
+
+        shards = self.getShardCount(context, obj)
+        if shards < 2:
+            return []
+        query = self.getQuery(context, obj)
+        scatter = datastore.Query(query.kind, namespace=query.namespace, keys_only=True)
+        scatter.Order('__scatter__')
+        sample = sorted(scatter.Get(shards * CONTINUATION_SCATTER_OVERSAMPLING))
+        splitKeys = []
+        for shard in range(1, shards):
+            key = sample and sample[len(sample) * shard // shards]
+            if key and key not in splitKeys:
+                splitKeys.append(key)
+        return [ndb.Key.from_old_key(key) for key in splitKeys]
+
+    @staticmethod
+    def checkFanInForTotalResultsCount(contexts, obj):
+        """ Checks for the total number of continuation results, across all the key ranges
+
+        @param contexts: a list of FSMContext instances, from a fan-in
+        @param obj: An object which the action can operate on
+        @return: the total number of results from the continuation, or None if the contexts do not include the
+                 last batch of every key range
+        """
+        counts = {}
+        shards = None
+        for context in contexts:
+            if context.get(CONTINUATION_COMPLETE_PARAM):
+                counts[context.get(CONTINUATION_SHARD_PARAM, 0)] = context[CONTINUATION_RESULTS_COUNTER_PARAM]
+                shards = context.get(CONTINUATION_SHARDS_PARAM, 1)
+        if shards is None or len(counts) < shards:
+            return None
+        return sum(counts.values())
+
+def _str(value):
+    """ Returns the bytes the NDB API returns for urlsafe keys and cursors as a str """
+    return value.decode('ascii') if isinstance(value, bytes) else value
+
 class ListContinuationFSMAction(ContinuationFSMAction):
     """ A list-of-things continuation. """
 
+    __NEXT_TOKEN = '__next_token__'
+
     def getList(self, context, obj):
         """ Returns a list of items to continue over. THIS LIST CANNOT CHANGE BETWEEN CALLS!!!"""
         raise NotImplementedError()
@@ -224,11 +572,8 @@ class ListContinuationFSMAction(ContinuationFSMAction):
         """ Accepts a token (an optional index) and returns the next token for the continutation.
         The results of getList()[token] are stored on obj.results.
         """
-        # the token is the index into the list
-        items = self.getList(context, obj)
-        index = int(token or '0')
-        batchsize = limit = self.getBatchSize(context, obj)
-        results = items[index:index + batchsize]
+        limit = self._getBatchSize(context, obj)
+        results = self._fetchResults(limit, context, obj, token=token)
 
         # place results on obj.results
         obj[CONTINUATION_RESULTS_KEY] = results
@@ -241,14 +586,59 @@ class ListContinuationFSMAction(ContinuationFSMAction):
             obj[CONTINUATION_RESULT_KEY] = None
         obj.result = obj[CONTINUATION_RESULT_KEY] # deprecated interface
 
-        index += batchsize
-
-        context[CONTINUATION_RESULTS_COUNTER_PARAM] = \
-            context.get(GEN_PARAM, {}).get(str(context[STEPS_PARAM]), 0) * limit + len(obj[CONTINUATION_RESULTS_KEY])
+        context[CONTINUATION_RESULTS_COUNTER_PARAM] = self._countResults(context, obj, limit, token=token)
         context[CONTINUATION_COMPLETE_PARAM] = len(obj[CONTINUATION_RESULTS_KEY]) < limit
         context[CONTINUATION_RESULTS_SIZE_PARAM] = len(obj[CONTINUATION_RESULTS_KEY])
 
         # unlike a datastore continuation, we know when the end of the data
         # occurs by the value of the token.
-        if index < len(items):
-            return str(index)
+        return self._getNextToken(context, obj, token=token)
+
+    def _fetchResults(self, limit, context, obj, token=None):
+        """ Actually fetches the results. """
+        # the token is the index into the list
+        items = self.getList(context, obj)
+        index = int(token or '0') + limit
+        obj[self.__NEXT_TOKEN] = str(index) if index < len(items) else None
+        return items[index - limit:index]
+
+    def _getNextToken(self, context, obj, token=None):
+        """ Gets the next token. """
+        return obj.pop(self.__NEXT_TOKEN)
+
+class StoredListContinuationFSMAction(ListContinuationFSMAction):
+    """ A list-of-things continuation that calls getList() only once.
+
+    The first Task writes the list to the datastore in chunks of getChunkSize() items (see models.StoredList),
+    and every Task after it reads only the chunks of its own batch, instead of building the whole list again.
+    Since the list is stored, it cannot change between calls.
+    """
+
+    __NEXT_TOKEN = '__next_token__'
+
+    # W0613: 78:DatastoreContinuationFSMAction.getBatchSize: Unused argument 'obj'
+    def getChunkSize(self, context, obj): # pylint: disable=W0613
+        """ Returns the number of items per stored chunk, default DEFAULT_STORED_LIST_CHUNK_SIZE. """
+        return DEFAULT_STORED_LIST_CHUNK_SIZE
+
+    def _fetchResults(self, limit, context, obj, token=None):
+        """ Actually fetches the results. """
+        from fantasm.models import StoredList
+
+        if token:
+            stored = json.loads(token)
+            storedList = StoredList(stored['list'], stored['length'], stored['chunk'])
+            index = stored['index']
+        else:
+            storedList = StoredList.store(self.getList(context, obj), self.getChunkSize(context, obj))
+            index = 0
+
+        results = storedList.slice(index, index + limit)
+        index += limit
+        obj[self.__NEXT_TOKEN] = index < storedList.length and json.dumps({
+            'list': storedList.digest,
+            'length': storedList.length,
+            'chunk': storedList.chunkSize,
+            'index': index,
+        }) or None
+        return results
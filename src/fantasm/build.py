@@ -0,0 +1,91 @@
+""" Fantasm: A taskqueue-based Finite State Machine for App Engine Python
+
+Docs and examples: http://code.google.com/p/fantasm/
+
+Copyright 2010 VendAsta Technologies Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+
+
+Build-time tooling for fsm.yaml. Run as part of a deploy, e.g.,
+
+    python -m fantasm.build compile src/fsm.yaml
+
+which writes src/fsm.yaml.compiled beside the .yaml file. On startup, config.currentConfiguration() uses the
+precompiled artifact instead of parsing the .yaml (and FSM() skips rebuilding its States and Transitions), as
+long as neither the .yaml file nor any of its imports have changed since the artifact was written.
+
+    python -m fantasm.build validate src/fsm.yaml
+
+imports every action class named in the .yaml and checks its interface. With "lazy_actions: True" this is
+otherwise deferred to the first dispatch of each state, so run it before deploying.
+"""
+
+import argparse
+import sys
+
+from fantasm import config
+from fantasm.exceptions import YamlFileNotFoundError
+from fantasm.fsm import FSM
+
+
+def validateYaml(filename=None):
+    """ Parses a .yaml file and eagerly resolves all of its actions, raising a ConfigurationError on problems.
+
+    @param filename: the .yaml file; if None, the usual fsm.yaml lookup is used
+    @return: the validated Configuration
+    """
+    filename = filename or config._findYaml() # pylint: disable=W0212
+    if not filename:
+        raise YamlFileNotFoundError('fsm.yaml')
+    configuration = config.loadYaml(filename=filename)
+    configuration.resolveActions()
+    return configuration
+
+def compileYaml(filename=None, outputFilename=None):
+    """ Parses and validates a .yaml file, and writes the precompiled artifact for it.
+
+    @param filename: the .yaml file; if None, the usual fsm.yaml lookup is used
+    @param outputFilename: where to write the artifact (default: beside the .yaml file)
+    @return: the filename of the artifact
+    """
+    filename = filename or config._findYaml() # pylint: disable=W0212
+    configuration = validateYaml(filename=filename)
+    factory = FSM(currentConfig=configuration)
+    tables = (factory.machines, factory.pseudoInits, factory.pseudoFinals)
+    return config.dumpCompiledYaml(configuration, tables, filename, outputFilename=outputFilename)
+
+def main(argv=None):
+    """ Command-line entry point. """
+    parser = argparse.ArgumentParser(prog='python -m fantasm.build', description='fsm.yaml build tooling')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compileParser = subparsers.add_parser('compile', help='write a precompiled artifact for fsm.yaml')
+    compileParser.add_argument('filename', nargs='?', default=None, help='path to fsm.yaml')
+    compileParser.add_argument('-o', '--output', default=None, help='artifact filename')
+
+    validateParser = subparsers.add_parser('validate', help='import and check every action in fsm.yaml')
+    validateParser.add_argument('filename', nargs='?', default=None, help='path to fsm.yaml')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compile':
+        outputFilename = compileYaml(filename=args.filename, outputFilename=args.output)
+        print('Wrote %s' % outputFilename)
+    elif args.command == 'validate':
+        configuration = validateYaml(filename=args.filename)
+        print('OK: %d machine(s)' % len(configuration.machines))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
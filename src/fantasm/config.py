@@ -18,6 +18,7 @@ Copyright 2010 VendAsta Technologies Inc.
 """
 
 
+import hashlib
 import json
 import logging
 import os
@@ -57,7 +58,7 @@ def currentConfiguration(filename=None):
         if _config and not constants.DEV_APPSERVER:
             return _config
 
-        _config = loadYaml(filename=filename)
+        _config = loadCompiledYaml(filename=filename) or loadYaml(filename=filename)
 
     return _config
 
@@ -96,7 +97,7 @@ def _findYaml(yamlNames=constants.YAML_NAMES):
                 return yamlPath
     return None
 
-def loadYaml(filename=None, importedAlready=None, rootUrl=None, enableCapabilitiesCheck=None):
+def loadYaml(filename=None, importedAlready=None, rootUrl=None, enableCapabilitiesCheck=None, lazyActions=None):
     """ Loads the YAML and constructs a configuration from it. """
     if not filename:
         filename = _findYaml()
@@ -115,16 +116,136 @@ def loadYaml(filename=None, importedAlready=None, rootUrl=None, enableCapabiliti
     return Configuration(configDict,
                          importedAlready=importedAlready,
                          rootUrl=rootUrl,
-                         enableCapabilitiesCheck=enableCapabilitiesCheck)
+                         enableCapabilitiesCheck=enableCapabilitiesCheck,
+                         lazyActions=lazyActions)
+
+def compiledFilename(filename):
+    """ Returns the filename of the precompiled artifact for a given .yaml file. """
+    return filename + constants.COMPILED_YAML_SUFFIX
+
+def _digestFile(filename):
+    """ Returns a hex digest of the contents of a file. """
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+_codeVersion = None
+
+def _getCodeVersion():
+    """ Returns fantasm.__version__ and a digest of the fantasm sources, so that a precompiled artifact is only
+    used with the fantasm code that built it; the pickled Configuration/State/Transition objects depend on it.
+    """
+    global _codeVersion # pylint: disable=W0603
+    if _codeVersion is None:
+        from fantasm import __version__
+        packageDirectory = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(packageDirectory)):
+            if name.endswith('.py'):
+                digest.update(name.encode('utf-8'))
+                with open(os.path.join(packageDirectory, name), 'rb') as f:
+                    digest.update(f.read())
+        _codeVersion = '%s-%s' % (__version__, digest.hexdigest())
+    return _codeVersion
+
+def _relativeYamlPath(filename, directory):
+    """ Returns a (base, path) pair for a .yaml file that survives moving the application to another
+    directory (i.e., build machine vs. deployed instance). Built-in machines are relative to this package.
+    """
+    packageDirectory = os.path.dirname(os.path.abspath(__file__))
+    filename = os.path.abspath(filename)
+    if os.path.dirname(filename) == packageDirectory:
+        return ('fantasm', os.path.basename(filename))
+    return ('app', os.path.relpath(filename, directory))
+
+def _absoluteYamlPath(relativePath, directory):
+    """ The inverse of _relativeYamlPath(). """
+    base, path = relativePath
+    if base == 'fantasm':
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return os.path.join(directory, path)
+
+def dumpCompiledYaml(configuration, tables, filename, outputFilename=None):
+    """ Writes a precompiled artifact for a .yaml file.
+
+    The artifact holds the validated Configuration and the flattened State/Transition tables built by the
+    FSM factory, along with a digest of the .yaml file and every .yaml file it imported, and the version of the
+    fantasm code (see _getCodeVersion()).
+
+    @param configuration: the Configuration loaded from filename
+    @param tables: a (machines, pseudoInits, pseudoFinals) tuple, as built by FSM._init()
+    @param filename: the .yaml file the configuration was loaded from
+    @param outputFilename: where to write the artifact (default: compiledFilename(filename))
+    @return: the filename of the artifact
+    """
+    outputFilename = outputFilename or compiledFilename(filename)
+    directory = os.path.dirname(os.path.abspath(outputFilename))
+    digests = [(_relativeYamlPath(yamlFile, directory), _digestFile(yamlFile))
+               for yamlFile in [filename] + list(configuration.importedFiles)]
+    artifact = {
+        'version': _getCodeVersion(),
+        'digests': digests,
+        'configuration': configuration,
+        'tables': tables,
+    }
+    with open(outputFilename, 'wb') as f:
+        pickle.dump(artifact, f, pickle.HIGHEST_PROTOCOL)
+    return outputFilename
+
+def loadCompiledYaml(filename=None):
+    """ Loads the precompiled artifact for a .yaml file, if there is one and it is still current.
+
+    @param filename: the .yaml file; if None, the usual fsm.yaml lookup is used
+    @return: a Configuration with .compiledTables set, or None if the .yaml must be parsed
+    """
+    if not filename:
+        filename = _findYaml()
+    if not filename:
+        return None
+
+    artifactFilename = compiledFilename(filename)
+    if not os.path.exists(artifactFilename):
+        return None
+
+    try:
+        with open(artifactFilename, 'rb') as f:
+            artifact = pickle.load(f)
+    except Exception:
+        logging.warning('Unable to load precompiled configuration "%s". Parsing .yaml instead.',
+                        artifactFilename, exc_info=True)
+        return None
+
+    if artifact.get('version') != _getCodeVersion():
+        logging.info('Precompiled configuration "%s" was built by another version of fantasm. Parsing .yaml '
+                     'instead.', artifactFilename)
+        return None
+
+    directory = os.path.dirname(os.path.abspath(artifactFilename))
+    for relativePath, digest in artifact['digests']:
+        yamlFile = _absoluteYamlPath(relativePath, directory)
+        if not os.path.exists(yamlFile) or _digestFile(yamlFile) != digest:
+            logging.info('Precompiled configuration "%s" is stale ("%s" changed). Parsing .yaml instead.',
+                         artifactFilename, yamlFile)
+            return None
+
+    configuration = artifact['configuration']
+    configuration.compiledTables = artifact['tables']
+    return configuration
 
 class Configuration:
     """ An overall configuration that corresponds to a fantasm.yaml file. """
 
-    def __init__(self, configDict, importedAlready=None, rootUrl=None, enableCapabilitiesCheck=None):
+    # set by loadCompiledYaml(); the (machines, pseudoInits, pseudoFinals) tables for the FSM factory
+    compiledTables = None
+
+    def __init__(self, configDict, importedAlready=None, rootUrl=None, enableCapabilitiesCheck=None,
+                 lazyActions=None):
         """ Constructs the configuration from a dictionary of values. """
 
         importedAlready = importedAlready or []
 
+        # all the .yaml files loaded on behalf of this configuration (shared with imported configurations)
+        self.importedFiles = importedAlready
+
         if constants.STATE_MACHINES_ATTRIBUTE not in configDict:
             raise exceptions.StateMachinesAttributeRequiredError()
 
@@ -144,6 +265,13 @@ class Configuration:
                 message = 'Cannot specify "%s" in an imported .yaml file.' % \
                           constants.ENABLE_CAPABILITIES_CHECK_ATTRIBUTE
                 raise exceptions.ConfigurationError(message)
+        if lazyActions is None:
+            self.lazyActions = bool(configDict.get(constants.LAZY_ACTIONS_ATTRIBUTE, constants.DEFAULT_LAZY_ACTIONS))
+        else:
+            self.lazyActions = lazyActions
+            if constants.LAZY_ACTIONS_ATTRIBUTE in configDict:
+                message = 'Cannot specify "%s" in an imported .yaml file.' % constants.LAZY_ACTIONS_ATTRIBUTE
+                raise exceptions.ConfigurationError(message)
         if not self.rootUrl.endswith('/'):
             self.rootUrl += '/'
 
@@ -159,7 +287,7 @@ class Configuration:
                 self._importYaml(machineDict[constants.IMPORT_ATTRIBUTE], importedAlready=importedAlready)
                 continue
 
-            machine = _MachineConfig(machineDict, rootUrl=self.rootUrl)
+            machine = _MachineConfig(machineDict, rootUrl=self.rootUrl, lazyActions=self.lazyActions)
             if machine.name in self.machines:
                 raise exceptions.MachineNameNotUniqueError(machine.name)
 
@@ -198,7 +326,8 @@ class Configuration:
         importedConfig = loadYaml(filename=yamlFile,
                                   importedAlready=importedAlready,
                                   rootUrl=self.rootUrl,
-                                  enableCapabilitiesCheck=self.enableCapabilitiesCheck)
+                                  enableCapabilitiesCheck=self.enableCapabilitiesCheck,
+                                  lazyActions=self.lazyActions)
         self.__addMachinesFromImportedConfig(importedConfig)
 
     BUILTIN_MACHINES = (
@@ -216,9 +345,25 @@ class Configuration:
             importedConfig = loadYaml(filename=yamlFile,
                                       importedAlready=importedAlready,
                                       rootUrl=self.rootUrl,
-                                      enableCapabilitiesCheck=self.enableCapabilitiesCheck)
+                                      enableCapabilitiesCheck=self.enableCapabilitiesCheck,
+                                      lazyActions=self.lazyActions)
             self.__addMachinesFromImportedConfig(importedConfig)
 
+    def resolveActions(self):
+        """ Resolves every entry/exit/action of every machine, and checks their interfaces. This is a no-op
+        for an eagerly loaded configuration (the checks happened at load time), but with lazy_actions it is
+        the only way to find a bad class name before a Task trips over it.
+        """
+        for machine in self.machines.values():
+            for state in machine.states.values():
+                for action in (state.entry, state.action, state.exit, state.fanInCombiner):
+                    if isinstance(action, _LazyAction):
+                        action.resolve()
+                state.validateContinuation()
+            for transition in machine.transitions.values():
+                if isinstance(transition.action, _LazyAction):
+                    transition.action.resolve()
+
 def deserializeNDBKey(serialized):
     """ Deserializes an NDB key. """
     from google.appengine.ext.ndb import key as ndb_key
@@ -289,6 +434,65 @@ def _resolveClass(className, namespace):
     except AttributeError:
         raise exceptions.UnknownClassError(moduleName, className)
 
+_resolvedClasses = {}
+
+def _resolveClassMemo(className, namespace):
+    """ _resolveClass() with a per-process memo, so that each action class is imported at most once. """
+    key = (className, namespace)
+    try:
+        return _resolvedClasses[key]
+    except KeyError:
+        resolvedClass = _resolvedClasses[key] = _resolveClass(className, namespace)
+        return resolvedClass
+
+class _LazyAction:
+    """ Stands in for an action instance when lazy_actions is enabled. The action class is only imported
+    and instantiated the first time one of its attributes is used (typically .execute() during a dispatch).
+    """
+
+    def __init__(self, className, namespace, machineName, stateName, interfaceError=None,
+                 interfaceMethod='execute'):
+        """ Constructor
+
+        @param className: the (possibly namespace-relative) name of the action class
+        @param namespace: the namespace of the state/transition
+        @param machineName: the machine name, for error messages
+        @param stateName: the state name, for error messages
+        @param interfaceError: the ConfigurationError to raise if the instance has no interfaceMethod
+        @param interfaceMethod: the method the instance must have
+        """
+        self.className = className
+        self.namespace = namespace
+        self.machineName = machineName
+        self.stateName = stateName
+        self.interfaceError = interfaceError
+        self.interfaceMethod = interfaceMethod
+        self._instance = None
+
+    def resolve(self):
+        """ Returns the action instance, importing and instantiating it if necessary. """
+        if self._instance is None:
+            instance = _resolveClassMemo(self.className, self.namespace)()
+            if self.interfaceError and not hasattr(instance, self.interfaceMethod):
+                raise self.interfaceError(self.machineName, self.stateName)
+            self._instance = instance
+        return self._instance
+
+    def __getattr__(self, name):
+        # special names are looked up by copy/pickle on partially constructed instances; never resolve for them
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __getstate__(self):
+        # precompiled configurations keep the class name only, so loading them stays import-free
+        state = self.__dict__.copy()
+        state['_instance'] = None
+        return state
+
+    def __repr__(self):
+        return '<_LazyAction %s>' % self.className
+
 def _resolveObject(objectName, namespace, expectedType=str):
     """ Given a string name/path of a object, locates and returns the value of the object.
 
@@ -320,11 +524,14 @@ def _resolveObject(objectName, namespace, expectedType=str):
 class _MachineConfig:
     """ Configuration of a machine. """
 
-    def __init__(self, initDict, rootUrl=None):
+    def __init__(self, initDict, rootUrl=None, lazyActions=False):
         """ Configures the basic attributes of a machine. States and transitions are not handled
             here, but are added by an external client.
         """
 
+        # resolve actions on first use, rather than here
+        self.lazyActions = lazyActions
+
         # machine name
         self.name = initDict.get(constants.MACHINE_NAME_ATTRIBUTE)
         if not self.name:
@@ -351,9 +558,45 @@ class _MachineConfig:
         if self.logging not in constants.VALID_LOGGING_VALUES:
             raise exceptions.InvalidLoggingError(self.name, self.logging)
 
+        # task payload format
+        self.payloadFormat = initDict.get(constants.MACHINE_PAYLOAD_FORMAT_ATTRIBUTE,
+                                          constants.DEFAULT_PAYLOAD_FORMAT)
+        if self.payloadFormat not in constants.VALID_PAYLOAD_FORMAT_VALUES:
+            raise exceptions.InvalidPayloadFormatError(self.name, self.payloadFormat)
+
+        # compress task payloads and fan-in work packages larger than this many bytes
+        self.compressionThreshold = initDict.get(constants.MACHINE_COMPRESSION_THRESHOLD_ATTRIBUTE,
+                                                 constants.DEFAULT_COMPRESSION_THRESHOLD)
+        if self.compressionThreshold is not None:
+            try:
+                self.compressionThreshold = int(self.compressionThreshold)
+            except (TypeError, ValueError):
+                raise exceptions.InvalidCompressionThresholdError(self.name, self.compressionThreshold)
+            if self.compressionThreshold < 0:
+                raise exceptions.InvalidCompressionThresholdError(self.name, self.compressionThreshold)
+
+        # store context values larger than this many bytes once in the datastore, and pass a reference in tasks
+        self.offloadThreshold = initDict.get(constants.MACHINE_OFFLOAD_THRESHOLD_ATTRIBUTE,
+                                             constants.DEFAULT_OFFLOAD_THRESHOLD)
+        if self.offloadThreshold is not None:
+            try:
+                self.offloadThreshold = int(self.offloadThreshold)
+            except (TypeError, ValueError):
+                raise exceptions.InvalidOffloadThresholdError(self.name, self.offloadThreshold)
+            if self.offloadThreshold < 0:
+                raise exceptions.InvalidOffloadThresholdError(self.name, self.offloadThreshold)
+
+        # write a _FantasmInstance for each started machine
+        self.instanceRows = bool(initDict.get(constants.MACHINE_INSTANCE_ROWS_ATTRIBUTE,
+                                              constants.DEFAULT_INSTANCE_ROWS))
+
         # use datastore semaphore
         self.useRunOnceSemaphore = initDict.get(constants.MACHINE_USE_RUN_ONCE_SEMAPHORE_ATTRIBUTE,
                                                 constants.DEFAULT_USE_RUN_ONCE_SEMAPHORE)
+        self.runOnceSemaphoreMode = initDict.get(constants.MACHINE_RUN_ONCE_SEMAPHORE_MODE_ATTRIBUTE,
+                                                 constants.DEFAULT_RUN_ONCE_SEMAPHORE_MODE)
+        if self.runOnceSemaphoreMode not in constants.VALID_RUN_ONCE_SEMAPHORE_MODE_VALUES:
+            raise exceptions.InvalidRunOnceSemaphoreModeError(self.name, self.runOnceSemaphoreMode)
 
         # machine task_retry_limit, min_backoff_seconds, max_backoff_seconds, task_age_limit, max_doublings
         for (constant, attribute, default, exception) in TASK_ATTRIBUTES:
@@ -445,6 +688,7 @@ class _StateConfig:
         """ Builds a _StateConfig from a dictionary representation. This state is not added to the machine. """
 
         self.machineName = machine.name
+        self.lazyActions = machine.lazyActions
 
         # state name
         self.name = stateDict.get(constants.STATE_NAME_ATTRIBUTE)
@@ -474,6 +718,25 @@ class _StateConfig:
         self.continuation = bool(stateDict.get(constants.STATE_CONTINUATION_ATTRIBUTE, False))
         self.continuationCountdown = int(stateDict.get(constants.STATE_CONTINUATION_COUNTDOWN_ATTRIBUTE, 0))
 
+        # state continuation_batches and continuation_seconds
+        self.continuationBatches = stateDict.get(constants.STATE_CONTINUATION_BATCHES_ATTRIBUTE,
+                                                 constants.DEFAULT_CONTINUATION_BATCHES)
+        try:
+            self.continuationBatches = int(self.continuationBatches)
+        except (TypeError, ValueError):
+            raise exceptions.InvalidContinuationBatchesError(self.machineName, self.name, self.continuationBatches)
+        if self.continuationBatches <= 0 or (self.continuationBatches > 1 and not self.continuation):
+            raise exceptions.InvalidContinuationBatchesError(self.machineName, self.name, self.continuationBatches)
+        self.continuationSeconds = stateDict.get(constants.STATE_CONTINUATION_SECONDS_ATTRIBUTE,
+                                                 constants.DEFAULT_CONTINUATION_SECONDS)
+        try:
+            self.continuationSeconds = float(self.continuationSeconds)
+        except (TypeError, ValueError):
+            raise exceptions.InvalidContinuationSecondsError(self.machineName, self.name, self.continuationSeconds)
+        if self.continuationSeconds <= 0 or \
+           (constants.STATE_CONTINUATION_SECONDS_ATTRIBUTE in stateDict and not self.continuation):
+            raise exceptions.InvalidContinuationSecondsError(self.machineName, self.name, self.continuationSeconds)
+
         # state fan_in
         self.fanInPeriod = stateDict.get(constants.STATE_FAN_IN_ATTRIBUTE, constants.NO_FAN_IN)
         try:
@@ -488,6 +751,90 @@ class _StateConfig:
         if self.fanInGroup and self.fanInPeriod == constants.NO_FAN_IN:
             raise exceptions.InvalidFanInGroupError(self.machineName, self.name, self.fanInGroup)
 
+        # state fan_in_max_contexts
+        self.fanInMaxContexts = stateDict.get(constants.STATE_FAN_IN_MAX_CONTEXTS_ATTRIBUTE,
+                                              constants.DEFAULT_FAN_IN_MAX_CONTEXTS)
+        if self.fanInMaxContexts is not None:
+            try:
+                self.fanInMaxContexts = int(self.fanInMaxContexts)
+            except (TypeError, ValueError):
+                raise exceptions.InvalidFanInMaxContextsError(self.machineName, self.name, self.fanInMaxContexts)
+            if self.fanInMaxContexts <= 0 or self.fanInPeriod == constants.NO_FAN_IN:
+                raise exceptions.InvalidFanInMaxContextsError(self.machineName, self.name, self.fanInMaxContexts)
+
+        # state fan_in_shards
+        self.fanInShards = stateDict.get(constants.STATE_FAN_IN_SHARDS_ATTRIBUTE, constants.DEFAULT_FAN_IN_SHARDS)
+        if self.fanInShards is not None:
+            try:
+                self.fanInShards = int(self.fanInShards)
+            except (TypeError, ValueError):
+                raise exceptions.InvalidFanInShardsError(self.machineName, self.name, self.fanInShards)
+            if self.fanInShards <= 0 or self.fanInPeriod == constants.NO_FAN_IN:
+                raise exceptions.InvalidFanInShardsError(self.machineName, self.name, self.fanInShards)
+
+        # state fan_in_entity_groups
+        self.fanInEntityGroups = stateDict.get(constants.STATE_FAN_IN_ENTITY_GROUPS_ATTRIBUTE)
+        if self.fanInEntityGroups is not None:
+            try:
+                self.fanInEntityGroups = int(self.fanInEntityGroups)
+            except (TypeError, ValueError):
+                raise exceptions.InvalidFanInEntityGroupsError(self.machineName, self.name, self.fanInEntityGroups)
+            if self.fanInEntityGroups <= 0 or self.fanInPeriod == constants.NO_FAN_IN:
+                raise exceptions.InvalidFanInEntityGroupsError(self.machineName, self.name, self.fanInEntityGroups)
+        else:
+            self.fanInEntityGroups = constants.DEFAULT_FAN_IN_ENTITY_GROUPS
+
+        # state fan_in_cleanup_period
+        self.fanInCleanupPeriod = stateDict.get(constants.STATE_FAN_IN_CLEANUP_PERIOD_ATTRIBUTE,
+                                                constants.DEFAULT_FAN_IN_CLEANUP_PERIOD)
+        if self.fanInCleanupPeriod is not None:
+            try:
+                self.fanInCleanupPeriod = int(self.fanInCleanupPeriod)
+            except (TypeError, ValueError):
+                raise exceptions.InvalidFanInCleanupPeriodError(self.machineName, self.name, self.fanInCleanupPeriod)
+            if self.fanInCleanupPeriod <= 0 or self.fanInPeriod == constants.NO_FAN_IN:
+                raise exceptions.InvalidFanInCleanupPeriodError(self.machineName, self.name, self.fanInCleanupPeriod)
+
+        # state fan_in_expected; a count, or the context key the forking state stores the count in
+        self.fanInExpected = stateDict.get(constants.STATE_FAN_IN_EXPECTED_ATTRIBUTE,
+                                           constants.DEFAULT_FAN_IN_EXPECTED)
+        if self.fanInExpected is not None:
+            try:
+                self.fanInExpected = int(self.fanInExpected)
+                valid = self.fanInExpected > 0
+            except (TypeError, ValueError):
+                valid = isinstance(self.fanInExpected, str) and constants.NAME_RE.match(self.fanInExpected)
+            if not valid or self.fanInPeriod == constants.NO_FAN_IN:
+                raise exceptions.InvalidFanInExpectedError(self.machineName, self.name, self.fanInExpected)
+
+        # state fan_in_adaptive
+        self.fanInAdaptive = bool(stateDict.get(constants.STATE_FAN_IN_ADAPTIVE_ATTRIBUTE,
+                                                constants.DEFAULT_FAN_IN_ADAPTIVE))
+        if self.fanInAdaptive and self.fanInPeriod == constants.NO_FAN_IN:
+            raise exceptions.InvalidFanInAdaptiveError(self.machineName, self.name)
+
+        # state fan_in_read_lock_countdown
+        self.fanInReadLockCountdown = stateDict.get(constants.STATE_FAN_IN_READ_LOCK_COUNTDOWN_ATTRIBUTE,
+                                                    constants.DEFAULT_FAN_IN_READ_LOCK_COUNTDOWN)
+        if self.fanInReadLockCountdown is not None:
+            try:
+                self.fanInReadLockCountdown = int(self.fanInReadLockCountdown)
+            except (TypeError, ValueError):
+                raise exceptions.InvalidFanInReadLockCountdownError(self.machineName, self.name,
+                                                                    self.fanInReadLockCountdown)
+            if self.fanInReadLockCountdown <= 0 or self.fanInPeriod == constants.NO_FAN_IN:
+                raise exceptions.InvalidFanInReadLockCountdownError(self.machineName, self.name,
+                                                                    self.fanInReadLockCountdown)
+
+        # state fan_in_combiner
+        fanInCombinerName = stateDict.get(constants.STATE_FAN_IN_COMBINER_ATTRIBUTE)
+        if fanInCombinerName:
+            if self.fanInPeriod == constants.NO_FAN_IN:
+                raise exceptions.InvalidFanInCombinerError(self.machineName, self.name, fanInCombinerName)
+            self.fanInCombiner = self._resolveAction(fanInCombinerName, exceptions.InvalidFanInCombinerInterfaceError,
+                                                     interfaceMethod='combine')
+        else:
+            self.fanInCombiner = None
 
         # check that a state is not BOTH fan_in and continuation
         if self.continuation and self.fanInPeriod != constants.NO_FAN_IN:
@@ -495,34 +842,25 @@ class _StateConfig:
 
         # state action
         if stateDict.get(constants.STATE_ACTION_ATTRIBUTE):
-            self.action = _resolveClass(actionName, self.namespace)()
-            if not hasattr(self.action, 'execute'):
-                raise exceptions.InvalidActionInterfaceError(self.machineName, self.name)
+            self.action = self._resolveAction(actionName, exceptions.InvalidActionInterfaceError)
         else:
             self.action = None
 
-        if self.continuation:
-            if not hasattr(self.action, 'continuation'):
-                raise exceptions.InvalidContinuationInterfaceError(self.machineName, self.name)
-        else:
-            if hasattr(self.action, 'continuation'):
-                logging.warning('State\'s action class has a continuation attribute, but the state is ' +
-                                'not marked as continuation=True. This continuation method will not be ' +
-                                'executed. (Machine %s, State %s)', self.machineName, self.name)
+        # with lazy_actions, this happens in Configuration.resolveActions()
+        if not self.lazyActions:
+            self.validateContinuation()
 
         # state entry
         if stateDict.get(constants.STATE_ENTRY_ATTRIBUTE):
-            self.entry = _resolveClass(stateDict[constants.STATE_ENTRY_ATTRIBUTE], self.namespace)()
-            if not hasattr(self.entry, 'execute'):
-                raise exceptions.InvalidEntryInterfaceError(self.machineName, self.name)
+            self.entry = self._resolveAction(stateDict[constants.STATE_ENTRY_ATTRIBUTE],
+                                             exceptions.InvalidEntryInterfaceError)
         else:
             self.entry = None
 
         # state exit
         if stateDict.get(constants.STATE_EXIT_ATTRIBUTE):
-            self.exit = _resolveClass(stateDict[constants.STATE_EXIT_ATTRIBUTE], self.namespace)()
-            if not hasattr(self.exit, 'execute'):
-                raise exceptions.InvalidExitInterfaceError(self.machineName, self.name)
+            self.exit = self._resolveAction(stateDict[constants.STATE_EXIT_ATTRIBUTE],
+                                            exceptions.InvalidExitInterfaceError)
             if self.continuation:
                 raise exceptions.UnsupportedConfigurationError(self.machineName, self.name,
                     'Exit actions on continuation states are not supported.'
@@ -534,6 +872,33 @@ class _StateConfig:
         else:
             self.exit = None
 
+    def _resolveAction(self, className, interfaceError, interfaceMethod='execute'):
+        """ Returns an action instance (or a _LazyAction stand-in) for an entry/exit/action/fan_in_combiner
+        class name.
+
+        @param className: the name of the action class
+        @param interfaceError: the ConfigurationError to raise if the action has no interfaceMethod
+        @param interfaceMethod: the method the action must have
+        """
+        if self.lazyActions:
+            return _LazyAction(className, self.namespace, self.machineName, self.name, interfaceError=interfaceError,
+                               interfaceMethod=interfaceMethod)
+        action = _resolveClass(className, self.namespace)()
+        if not hasattr(action, interfaceMethod):
+            raise interfaceError(self.machineName, self.name)
+        return action
+
+    def validateContinuation(self):
+        """ Checks that the action supports .continuation() if and only if this is a continuation state. """
+        if self.continuation:
+            if not hasattr(self.action, 'continuation'):
+                raise exceptions.InvalidContinuationInterfaceError(self.machineName, self.name)
+        else:
+            if hasattr(self.action, 'continuation'):
+                logging.warning('State\'s action class has a continuation attribute, but the state is ' +
+                                'not marked as continuation=True. This continuation method will not be ' +
+                                'executed. (Machine %s, State %s)', self.machineName, self.name)
+
 class _TransitionConfig:
     """ Configuration of a transition. """
 
@@ -660,7 +1025,11 @@ class _TransitionConfig:
 
         # resolve the class for action, if specified
         if constants.TRANS_ACTION_ATTRIBUTE in transDict:
-            self.action = _resolveClass(transDict[constants.TRANS_ACTION_ATTRIBUTE], self.namespace)()
+            if machine.lazyActions:
+                self.action = _LazyAction(transDict[constants.TRANS_ACTION_ATTRIBUTE], self.namespace,
+                                          self.machineName, fromStateName)
+            else:
+                self.action = _resolveClass(transDict[constants.TRANS_ACTION_ATTRIBUTE], self.namespace)()
             if self.fromState.continuation:
                 raise exceptions.UnsupportedConfigurationError(self.machineName, self.fromState.name,
                     'Transition actions on transitions from continuation states are not supported.'
@@ -30,12 +30,17 @@ TASK_NAME_PARAM = '__tn__'
 FAN_IN_RESULTS_PARAM = '__fi__'
 RETRY_COUNT_PARAM = '__rc__'
 FORKED_CONTEXTS_PARAM = '__fc__'
+FORK_STREAM_PARAM = '__fs__'
 IMMEDIATE_MODE_PARAM = '__im__'
 MESSAGES_PARAM = '__ms__'
 FANNED_IN_CONTEXT = '__fic__'
+FAN_IN_CLEANUP_BUCKET_PARAM = '__fcb__' # the memcache key of the workIndexes of a fan_in_cleanup_period cleanup
+FAN_IN_ENTITY_GROUPS_PARAM = '__feg__' # the fan_in_entity_groups of the work packages of a cleanup
+CONTEXT_BLOBS_PARAM = '__cb__' # json {key: [digest, written]} of the context values offloaded to _FantasmContextBlobs
 NON_CONTEXT_PARAMS = (STATE_PARAM, EVENT_PARAM, INSTANCE_NAME_PARAM, TERMINATED_PARAM, TASK_NAME_PARAM,
                       FAN_IN_RESULTS_PARAM, RETRY_COUNT_PARAM, FORKED_CONTEXTS_PARAM, IMMEDIATE_MODE_PARAM,
-                      MESSAGES_PARAM, FANNED_IN_CONTEXT)
+                      MESSAGES_PARAM, FANNED_IN_CONTEXT, FORK_STREAM_PARAM, FAN_IN_CLEANUP_BUCKET_PARAM,
+                      FAN_IN_ENTITY_GROUPS_PARAM, CONTEXT_BLOBS_PARAM)
 
 
 # these parameters are stored in the FSMContext, and used to drive the task naming machanism
@@ -47,12 +52,21 @@ WORK_INDEX_PARAM = '__wix__'
 FORK_PARAM = '__fk__'
 STARTED_AT_PARAM = '__sa__'
 FAN_IN_GROUP_PARAM = '__fig__'
+FAN_IN_CURSOR_PARAM = '__fcu__' # the key name of the last work package read by the previous fan_in_max_contexts chunk
+FAN_IN_CHUNK_PARAM = '__fch__'
+FAN_IN_SHARD_PARAM = '__fsh__' # the fan_in_shards shard of a fan-in, and of the states after it
+FAN_IN_READ_LOCK_WAIT_PARAM = '__frw__' # the number of times a fan-in re-queued itself to wait for its writers
 CONTINUATION_RESULTS_COUNTER_PARAM = '__crc__'
 CONTINUATION_COMPLETE_PARAM = '__cc__'
 CONTINUATION_RESULTS_SIZE_PARAM = '__crs__'
+CONTINUATION_SHARD_PARAM = '__csh__' # the key range of a ShardedDatastoreContinuationFSMAction
+CONTINUATION_SHARDS_PARAM = '__csn__' # the number of key ranges of a ShardedDatastoreContinuationFSMAction
+CONTINUATION_BATCH_SIZE_PARAM = '__cbs__' # the adaptive batch size of the previous continuation Task
 CONTEXT_PARAMS = (STEPS_PARAM, CONTINUATION_PARAM, GEN_PARAM, INDEX_PARAM, WORK_INDEX_PARAM,
                   FORK_PARAM, STARTED_AT_PARAM, FAN_IN_GROUP_PARAM, CONTINUATION_RESULTS_COUNTER_PARAM,
-                  CONTINUATION_COMPLETE_PARAM)
+                  CONTINUATION_COMPLETE_PARAM, FAN_IN_CURSOR_PARAM, FAN_IN_CHUNK_PARAM, FAN_IN_READ_LOCK_WAIT_PARAM,
+                  FAN_IN_SHARD_PARAM, CONTINUATION_SHARD_PARAM, CONTINUATION_SHARDS_PARAM,
+                  CONTINUATION_BATCH_SIZE_PARAM)
 
 PRIVATE_PARAMS = set(NON_CONTEXT_PARAMS) | set(CONTEXT_PARAMS)
 
@@ -62,10 +76,16 @@ PARAM_TYPES = {
     GEN_PARAM : json.loads,
     INDEX_PARAM: int,
     FORK_PARAM: int,
+    FAN_IN_CHUNK_PARAM: int,
+    FAN_IN_READ_LOCK_WAIT_PARAM: int,
+    FAN_IN_SHARD_PARAM: int,
     STARTED_AT_PARAM: float,
     CONTINUATION_RESULTS_COUNTER_PARAM: int,
     CONTINUATION_COMPLETE_PARAM: bool,
     CONTINUATION_RESULTS_SIZE_PARAM: int,
+    CONTINUATION_SHARD_PARAM: int,
+    CONTINUATION_SHARDS_PARAM: int,
+    CONTINUATION_BATCH_SIZE_PARAM: int,
 }
 
 CHARS_FOR_RANDOM = 'BDGHJKLMNPQRTVWXYZ23456789' # no vowels or things that look like vowels - profanity-free!
@@ -79,6 +99,17 @@ CONTINUATION_RESULT_KEY = 'result'
 CONTINUATION_RESULT_PARAM = CONTINUATION_RESULT_KEY
 CONTINUATION_MORE_RESULTS_KEY = 'has_more_results'
 
+# ShardedDatastoreContinuationFSMAction samples this many __scatter__ keys per key range
+DEFAULT_CONTINUATION_SHARDS = 8
+CONTINUATION_SCATTER_OVERSAMPLING = 32
+
+# with getTargetBatchTime(), continuations size each batch between 1 and this many results
+CONTINUATION_MAX_BATCH_SIZE = 1000
+
+# with method GET, an NDBPrefetchingContinuationFSMAction passes a cursor rather than the prefetched keys when they
+# would take more than this many url-quoted characters, to keep its Tasks below taskqueue.MAX_URL_LENGTH (2083)
+CONTINUATION_PREFETCH_MAX_GET_TOKEN_LENGTH = 1000
+
 REQUEST_LENGTH = 30
 
 MAX_NAME_LENGTH = 50 # we need to combine a number of names into a task name, which has a 500 char limit
@@ -99,19 +130,80 @@ DEFAULT_LOG_QUEUE_NAME = DEFAULT_QUEUE_NAME
 DEFAULT_CLEANUP_QUEUE_NAME = DEFAULT_QUEUE_NAME
 DEFAULT_TARGET = None
 DEFAULT_USE_RUN_ONCE_SEMAPHORE = True
+RUN_ONCE_SEMAPHORE_MODE_STRICT = 'strict' # memcache, then a datastore transaction
+RUN_ONCE_SEMAPHORE_MODE_FAST = 'fast' # an in-process LRU, then memcache.add(); the datastore only if memcache fails
+VALID_RUN_ONCE_SEMAPHORE_MODE_VALUES = (RUN_ONCE_SEMAPHORE_MODE_STRICT, RUN_ONCE_SEMAPHORE_MODE_FAST)
+DEFAULT_RUN_ONCE_SEMAPHORE_MODE = RUN_ONCE_SEMAPHORE_MODE_STRICT
+RUN_ONCE_SEMAPHORE_LRU_SIZE = 10000 # semaphore keys remembered per process by the 'fast' mode
+RUN_ONCE_SEMAPHORE_METRIC = 'runOnceSemaphore'
+DEFAULT_INSTANCE_ROWS = True # write a _FantasmInstance for each started machine
 
 NO_FAN_IN = -1
 DEFAULT_FAN_IN_PERIOD = NO_FAN_IN # fan_in period (in seconds)
-DATASTORE_ASYNCRONOUS_INDEX_WRITE_WAIT_TIME = 5.0 # seconds
+DATASTORE_ASYNCRONOUS_INDEX_WRITE_WAIT_TIME = 5.0 # seconds; no longer used, fan-ins read with ancestor queries
+FAN_IN_ENTITY_GROUP_KIND = '_FantasmFanInGroup' # the (never written) parents of _FantasmFanIn work packages
+DEFAULT_FAN_IN_ENTITY_GROUPS = 8 # entity groups per workIndex, to spread out the fan-in writes (~1 write/s each)
+FAN_IN_READ_ROOT_WORK_PACKAGES = True # also read the work packages written without a parent, before 2.1.0
+FAN_IN_QUERY_BATCH_SIZE = 100
+DEFAULT_FAN_IN_MAX_CONTEXTS = None # None reads all the work packages of a fan-in at once
+DEFAULT_FAN_IN_SHARDS = None # None fans in all the work packages of a fan-in in one Task at a time
+DEFAULT_FAN_IN_CLEANUP_PERIOD = None # None queues one cleanup Task per fan-in
+FAN_IN_CLEANUP_BATCH_SIZE = 500 # work packages per db.delete()
+FAN_IN_CLEANUP_MAX_BATCHES = 20 # per cleanup Task; the rest are deleted by a follow-up cleanup Task
+DEFAULT_FAN_IN_READ_LOCK_COUNTDOWN = None # None busy-waits for the fan-in writers in the fan-in Task
+FAN_IN_READ_LOCK_MAX_WAITS = 5 # re-queues with fan_in_read_lock_countdown before fanning in regardless
+DEFAULT_FAN_IN_EXPECTED = None # None fans in after the fan_in period only
+FAN_IN_ARRIVAL_COUNTER_SHARDS = 8 # memcache counters per workIndex, to spread out the fan_in_expected increments
+DEFAULT_FAN_IN_ADAPTIVE = False
+DEFAULT_CONTINUATION_BATCHES = 1 # continuation batches per Task
+DEFAULT_CONTINUATION_SECONDS = 60 # with continuation_batches, queue the next Task once a Task has run this long
+FAN_IN_ADAPTIVE_FACTOR = 2 # fan_in_adaptive waits this many times the arrival span of the previous fan-in
+FAN_IN_ADAPTIVE_MIN_PERIOD = 1 # seconds
+
+# the memcache counters of lock.ReadWriteLock: writers incr() from WRITE_LOCK_OFFSET, and the reader decr()s by
+# READ_LOCK_OFFSET, so a counter above READ_LOCK_OFFSET means writers are still in flight, and a counter below
+# WRITE_LOCK_OFFSET tells a writer that it was too late
+WRITE_LOCK_OFFSET = 2**16
+READ_LOCK_OFFSET = 2**15
 
 DEFAULT_COUNTDOWN = 0
+MAX_TASK_ADD_RPCS_IN_FLIGHT = 10 # concurrent Queue.add_async() calls of MAX_TASKS_PER_ADD Tasks each
 
 YAML_NAMES = ('fsm.yaml', 'fsm.yml', 'fantasm.yaml', 'fantasm.yml')
+COMPILED_YAML_SUFFIX = '.compiled' # e.g., fsm.yaml.compiled, written by "python -m fantasm.build compile"
 
 DEFAULT_ROOT_URL = '/fantasm/' # where all the fantasm handlers are mounted
 DEFAULT_LOG_URL = '/fantasm/log/'
 DEFAULT_CLEANUP_URL = '/fantasm/cleanup/'
+DEFAULT_SPAWN_URL = '/fantasm/spawn/'
+TREE_SPAWN_FAN_OUT = 10 # the number of child spawner tasks per spawner task; see startStateMachine(treeSpawnSize)
 DEFAULT_ENABLE_CAPABILITIES_CHECK = True
+DEFAULT_LAZY_ACTIONS = False
+
+PAYLOAD_FORMAT_URLENCODED = 'urlencoded' # one form param per context key
+PAYLOAD_FORMAT_JSON = 'json' # the whole typed context as a single JSON body (POST only)
+VALID_PAYLOAD_FORMAT_VALUES = (PAYLOAD_FORMAT_URLENCODED, PAYLOAD_FORMAT_JSON)
+DEFAULT_PAYLOAD_FORMAT = PAYLOAD_FORMAT_URLENCODED
+JSON_CONTENT_TYPE = 'application/json'
+PAYLOAD_CONTEXT_KEY = '__context__' # in a json payload, the typed context values
+PAYLOAD_CAST_KEY = '__cast__' # in a json payload, the context keys that still need a context_types cast
+PAYLOAD_BYTES_KEY = '__bytes__' # in a json payload, marks base64 encoded bytes that are not UTF-8
+
+DEFAULT_COMPRESSION_THRESHOLD = None # bytes; None disables compression
+COMPRESSED_PAYLOAD_PREFIX = b'\x00fantasm-zlib\x00' # leads a compressed task body; never starts a form/json body
+COMPRESSED_JSON_PREFIX = 'zlib:' # leads a compressed, base64-encoded JSONProperty value; never starts json
+COMPRESSION_METRIC_TASK = 'compression.task'
+COMPRESSION_METRIC_JSON_PROPERTY = 'compression.jsonProperty'
+COMPRESSION_METRIC_STORED_LIST = 'compression.storedList'
+
+DEFAULT_OFFLOAD_THRESHOLD = None # bytes (pickled); None never offloads context values
+CONTEXT_BLOB_REFRESH_AGE = 24 * 60 * 60 # seconds; an unread offloaded value passed along after this long
+                                       # refreshes the createdTime of its _FantasmContextBlob for the scrubber
+
+CONTEXT_BLOB_MAX_SIZE = 1000000 # bytes; keeps a _FantasmContextBlob below the 1MB datastore entity limit
+
+DEFAULT_STORED_LIST_CHUNK_SIZE = 100 # items per _FantasmContextBlob of a StoredListContinuationFSMAction
+STORED_LIST_PUT_BATCH_SIZE = 500 # entities per datastore put when writing a stored list
 
 ### attribute names for YAML parsing
 
@@ -132,6 +224,7 @@ MAX_DOUBLINGS_ATTRIBUTE = 'max_doublings'
 
 ROOT_URL_ATTRIBUTE = 'root_url'
 ENABLE_CAPABILITIES_CHECK_ATTRIBUTE = 'enable_capabilities_check'
+LAZY_ACTIONS_ATTRIBUTE = 'lazy_actions'
 STATE_MACHINES_ATTRIBUTE = 'state_machines'
 
 MACHINE_NAME_ATTRIBUTE = 'name'
@@ -140,13 +233,20 @@ MACHINE_TRANSITIONS_ATTRIBUTE = 'transitions'
 MACHINE_CONTEXT_TYPES_ATTRIBUTE = 'context_types'
 MACHINE_LOGGING_NAME_ATTRIBUTE = 'logging'
 MACHINE_USE_RUN_ONCE_SEMAPHORE_ATTRIBUTE = 'use_run_once_semaphore'
+MACHINE_PAYLOAD_FORMAT_ATTRIBUTE = 'payload_format'
+MACHINE_COMPRESSION_THRESHOLD_ATTRIBUTE = 'compression_threshold'
+MACHINE_OFFLOAD_THRESHOLD_ATTRIBUTE = 'offload_threshold'
+MACHINE_INSTANCE_ROWS_ATTRIBUTE = 'instance_rows'
+MACHINE_RUN_ONCE_SEMAPHORE_MODE_ATTRIBUTE = 'run_once_semaphore_mode'
 VALID_MACHINE_ATTRIBUTES = (NAMESPACE_ATTRIBUTE, MAX_RETRIES_ATTRIBUTE, TASK_RETRY_LIMIT_ATTRIBUTE,
                             MIN_BACKOFF_SECONDS_ATTRIBUTE, MAX_BACKOFF_SECONDS_ATTRIBUTE,
                             TASK_AGE_LIMIT_ATTRIBUTE, MAX_DOUBLINGS_ATTRIBUTE,
                             MACHINE_NAME_ATTRIBUTE, QUEUE_NAME_ATTRIBUTE, TARGET_ATTRIBUTE,
                             MACHINE_STATES_ATTRIBUTE, MACHINE_CONTEXT_TYPES_ATTRIBUTE,
                             MACHINE_LOGGING_NAME_ATTRIBUTE, MACHINE_USE_RUN_ONCE_SEMAPHORE_ATTRIBUTE,
-                            COUNTDOWN_ATTRIBUTE)
+                            COUNTDOWN_ATTRIBUTE, MACHINE_PAYLOAD_FORMAT_ATTRIBUTE,
+                            MACHINE_COMPRESSION_THRESHOLD_ATTRIBUTE, MACHINE_OFFLOAD_THRESHOLD_ATTRIBUTE,
+                            MACHINE_INSTANCE_ROWS_ATTRIBUTE, MACHINE_RUN_ONCE_SEMAPHORE_MODE_ATTRIBUTE)
                             # MACHINE_TRANSITIONS_ATTRIBUTE is intentionally not in this list;
                             # it is used internally only
 
@@ -162,13 +262,28 @@ STATE_INITIAL_ATTRIBUTE = 'initial'
 STATE_FINAL_ATTRIBUTE = 'final'
 STATE_CONTINUATION_ATTRIBUTE = 'continuation'
 STATE_CONTINUATION_COUNTDOWN_ATTRIBUTE = 'continuation_countdown'
+STATE_CONTINUATION_BATCHES_ATTRIBUTE = 'continuation_batches'
+STATE_CONTINUATION_SECONDS_ATTRIBUTE = 'continuation_seconds'
 STATE_FAN_IN_ATTRIBUTE = 'fan_in'
 STATE_FAN_IN_GROUP_ATTRIBUTE = 'fan_in_group'
+STATE_FAN_IN_MAX_CONTEXTS_ATTRIBUTE = 'fan_in_max_contexts'
+STATE_FAN_IN_COMBINER_ATTRIBUTE = 'fan_in_combiner'
+STATE_FAN_IN_READ_LOCK_COUNTDOWN_ATTRIBUTE = 'fan_in_read_lock_countdown'
+STATE_FAN_IN_SHARDS_ATTRIBUTE = 'fan_in_shards'
+STATE_FAN_IN_CLEANUP_PERIOD_ATTRIBUTE = 'fan_in_cleanup_period'
+STATE_FAN_IN_EXPECTED_ATTRIBUTE = 'fan_in_expected'
+STATE_FAN_IN_ADAPTIVE_ATTRIBUTE = 'fan_in_adaptive'
+STATE_FAN_IN_ENTITY_GROUPS_ATTRIBUTE = 'fan_in_entity_groups'
 STATE_TRANSITIONS_ATTRIBUTE = 'transitions'
 VALID_STATE_ATTRIBUTES = (NAMESPACE_ATTRIBUTE, STATE_NAME_ATTRIBUTE, STATE_ENTRY_ATTRIBUTE, STATE_EXIT_ATTRIBUTE,
                           STATE_ACTION_ATTRIBUTE, STATE_INITIAL_ATTRIBUTE, STATE_FINAL_ATTRIBUTE,
                           STATE_CONTINUATION_ATTRIBUTE, STATE_FAN_IN_ATTRIBUTE, STATE_FAN_IN_GROUP_ATTRIBUTE,
-                          STATE_TRANSITIONS_ATTRIBUTE, STATE_CONTINUATION_COUNTDOWN_ATTRIBUTE)
+                          STATE_TRANSITIONS_ATTRIBUTE, STATE_CONTINUATION_COUNTDOWN_ATTRIBUTE,
+                          STATE_FAN_IN_MAX_CONTEXTS_ATTRIBUTE, STATE_FAN_IN_COMBINER_ATTRIBUTE,
+                          STATE_FAN_IN_READ_LOCK_COUNTDOWN_ATTRIBUTE, STATE_FAN_IN_SHARDS_ATTRIBUTE,
+                          STATE_FAN_IN_CLEANUP_PERIOD_ATTRIBUTE, STATE_FAN_IN_EXPECTED_ATTRIBUTE,
+                          STATE_FAN_IN_ADAPTIVE_ATTRIBUTE, STATE_CONTINUATION_BATCHES_ATTRIBUTE,
+                          STATE_CONTINUATION_SECONDS_ATTRIBUTE, STATE_FAN_IN_ENTITY_GROUPS_ATTRIBUTE)
 
 TRANS_TO_ATTRIBUTE = 'to'
 TRANS_EVENT_ATTRIBUTE = 'event'
@@ -122,6 +122,22 @@ class FanInNoContextsAvailableRuntimeError(FSMRuntimeError):
                   (event, machineName, stateName, instanceName)
         super().__init__(message)
 
+class InvalidFanInExpectedRuntimeError(FSMRuntimeError):
+    """ Exception when the fan_in_expected context key does not hold a number of work packages. """
+    def __init__(self, key, value, machineName, stateName, instanceName):
+        """ Initialize exception """
+        message = 'Context key "%s" of %s is "%r", not an integer. (Machine %s, State %s, Instance %s)' % \
+                  (key, constants.STATE_FAN_IN_EXPECTED_ATTRIBUTE, value, machineName, stateName, instanceName)
+        super().__init__(message)
+
+class SpawnContextTooLargeRuntimeError(FSMRuntimeError):
+    """ Exception when a single context passed to startStateMachine(treeSpawnSize=...) is too large to store. """
+    def __init__(self, machineName, size):
+        """ Initialize exception """
+        message = 'A context to spawn is %d bytes pickled, more than the %d bytes of a _FantasmContextBlob. ' \
+                  '(Machine %s)' % (size, constants.CONTEXT_BLOB_MAX_SIZE, machineName)
+        super().__init__(message)
+
 class RequiredServicesUnavailableRuntimeError(FSMRuntimeError):
     """ Some of the required API services are not available. """
     def __init__(self, unavailableServices):
@@ -327,6 +343,38 @@ class InvalidLoggingError(ConfigurationError):
                   (loggingValue, constants.VALID_LOGGING_VALUES, machineName)
         super().__init__(message)
 
+class InvalidPayloadFormatError(ConfigurationError):
+    """ The payload_format value was not valid. """
+    def __init__(self, machineName, payloadFormat):
+        """ Initialize exception """
+        message = 'payload_format attribute "%s" is invalid (must be one of "%s"). (Machine %s)' % \
+                  (payloadFormat, constants.VALID_PAYLOAD_FORMAT_VALUES, machineName)
+        super().__init__(message)
+
+class InvalidRunOnceSemaphoreModeError(ConfigurationError):
+    """ The run_once_semaphore_mode value was not valid. """
+    def __init__(self, machineName, runOnceSemaphoreMode):
+        """ Initialize exception """
+        message = 'run_once_semaphore_mode attribute "%s" is invalid (must be one of "%s"). (Machine %s)' % \
+                  (runOnceSemaphoreMode, constants.VALID_RUN_ONCE_SEMAPHORE_MODE_VALUES, machineName)
+        super().__init__(message)
+
+class InvalidCompressionThresholdError(ConfigurationError):
+    """ The compression_threshold value was not a non-negative integer. """
+    def __init__(self, machineName, compressionThreshold):
+        """ Initialize exception """
+        message = 'compression_threshold "%s" is invalid. Must be a non-negative integer. (Machine %s)' % \
+                  (compressionThreshold, machineName)
+        super().__init__(message)
+
+class InvalidOffloadThresholdError(ConfigurationError):
+    """ The offload_threshold value was not a non-negative integer. """
+    def __init__(self, machineName, offloadThreshold):
+        """ Initialize exception """
+        message = 'offload_threshold "%s" is invalid. Must be a non-negative integer. (Machine %s)' % \
+                  (offloadThreshold, machineName)
+        super().__init__(message)
+
 class TransitionNameRequiredError(ConfigurationError):
     """ Each transition requires a name. """
     def __init__(self, machineName):
@@ -449,6 +497,13 @@ class InvalidExitInterfaceError(InvalidInterfaceError):
                   (machineName, stateName)
         super().__init__(message)
 
+class InvalidFanInCombinerInterfaceError(InvalidInterfaceError):
+    """ The specified state's fan_in_combiner class does not have a combine() method. """
+    def __init__(self, machineName, stateName):
+        message = 'The state\'s fan_in_combiner class does not have a combine() method. (Machine %s, State %s)' % \
+                  (machineName, stateName)
+        super().__init__(message)
+
 class InvalidFanInError(ConfigurationError):
     """ fan_in must be a positive integer. """
     def __init__(self, machineName, stateName, fanInPeriod):
@@ -465,6 +520,95 @@ class InvalidFanInGroupError(ConfigurationError):
                   (constants.STATE_FAN_IN_GROUP_ATTRIBUTE, fanInGroup, machineName, stateName)
         super().__init__(message)
 
+class InvalidFanInCombinerError(ConfigurationError):
+    """ fan_in_combiner requires fan_in. """
+    def __init__(self, machineName, stateName, fanInCombiner):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Requires fan_in attribute as well. (Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_COMBINER_ATTRIBUTE, fanInCombiner, machineName, stateName)
+        super().__init__(message)
+
+class InvalidFanInCleanupPeriodError(ConfigurationError):
+    """ fan_in_cleanup_period must be a positive integer. """
+    def __init__(self, machineName, stateName, fanInCleanupPeriod):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive integer, and requires fan_in attribute as well. ' \
+                  '(Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_CLEANUP_PERIOD_ATTRIBUTE, fanInCleanupPeriod, machineName, stateName)
+        super().__init__(message)
+
+class InvalidFanInExpectedError(ConfigurationError):
+    """ fan_in_expected must be a positive integer, or the name of a context key. """
+    def __init__(self, machineName, stateName, fanInExpected):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive integer or a context key name, and requires fan_in ' \
+                  'attribute as well. (Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_EXPECTED_ATTRIBUTE, fanInExpected, machineName, stateName)
+        super().__init__(message)
+
+class InvalidFanInAdaptiveError(ConfigurationError):
+    """ fan_in_adaptive requires fan_in. """
+    def __init__(self, machineName, stateName):
+        """ Initialize exception """
+        message = '%s requires fan_in attribute as well. (Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_ADAPTIVE_ATTRIBUTE, machineName, stateName)
+        super().__init__(message)
+
+class InvalidContinuationBatchesError(ConfigurationError):
+    """ continuation_batches must be a positive integer. """
+    def __init__(self, machineName, stateName, continuationBatches):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive integer, and requires continuation attribute as well. ' \
+                  '(Machine %s, State %s)' % \
+                  (constants.STATE_CONTINUATION_BATCHES_ATTRIBUTE, continuationBatches, machineName, stateName)
+        super().__init__(message)
+
+class InvalidContinuationSecondsError(ConfigurationError):
+    """ continuation_seconds must be a positive number. """
+    def __init__(self, machineName, stateName, continuationSeconds):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive number, and requires continuation attribute as well. ' \
+                  '(Machine %s, State %s)' % \
+                  (constants.STATE_CONTINUATION_SECONDS_ATTRIBUTE, continuationSeconds, machineName, stateName)
+        super().__init__(message)
+
+class InvalidFanInShardsError(ConfigurationError):
+    """ fan_in_shards must be a positive integer. """
+    def __init__(self, machineName, stateName, fanInShards):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive integer, and requires fan_in attribute as well. ' \
+                  '(Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_SHARDS_ATTRIBUTE, fanInShards, machineName, stateName)
+        super().__init__(message)
+
+class InvalidFanInEntityGroupsError(ConfigurationError):
+    """ fan_in_entity_groups must be a positive integer. """
+    def __init__(self, machineName, stateName, fanInEntityGroups):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive integer, and requires fan_in attribute as well. ' \
+                  '(Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_ENTITY_GROUPS_ATTRIBUTE, fanInEntityGroups, machineName, stateName)
+        super().__init__(message)
+
+class InvalidFanInReadLockCountdownError(ConfigurationError):
+    """ fan_in_read_lock_countdown must be a positive integer. """
+    def __init__(self, machineName, stateName, fanInReadLockCountdown):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive integer, and requires fan_in attribute as well. ' \
+                  '(Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_READ_LOCK_COUNTDOWN_ATTRIBUTE, fanInReadLockCountdown, machineName,
+                   stateName)
+        super().__init__(message)
+
+class InvalidFanInMaxContextsError(ConfigurationError):
+    """ fan_in_max_contexts must be a positive integer. """
+    def __init__(self, machineName, stateName, fanInMaxContexts):
+        """ Initialize exception """
+        message = '%s "%s" is invalid. Must be a positive integer, and requires fan_in attribute as well. ' \
+                  '(Machine %s, State %s)' % \
+                  (constants.STATE_FAN_IN_MAX_CONTEXTS_ATTRIBUTE, fanInMaxContexts, machineName, stateName)
+        super().__init__(message)
+
 class FanInContinuationNotSupportedError(ConfigurationError):
     """ Cannot have fan_in and continuation on the same state, because it hurts our head at the moment. """
     def __init__(self, machineName, stateName):
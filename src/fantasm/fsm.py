@@ -31,24 +31,29 @@ The Fan-out / Fan-in implementation is modeled after the presentation:
 """
 
 import base64
+import collections
 import copy
 import datetime
+import itertools
 import json
 import pickle
 import random
 import time
+import urllib.parse
+import zlib
 
 from google.appengine.api.taskqueue.taskqueue import (Task,
                                                       TaskAlreadyExistsError,
                                                       TaskRetryOptions,
                                                       TombstonedTaskError)
-from google.appengine.ext import db
+from google.appengine.ext import db, deferred
 
-from fantasm import config, constants, models
+from fantasm import config, constants, models, utils
 from fantasm.exceptions import (TRANSIENT_ERRORS, HaltMachineError,
+                                InvalidFanInExpectedRuntimeError, SpawnContextTooLargeRuntimeError,
                                 UnknownEventError, UnknownMachineError,
                                 UnknownStateError)
-from fantasm.lock import ReadWriteLock, RunOnceSemaphore
+from fantasm.lock import FanInArrivals, FanInCleanupBucket, ReadWriteLock, RunOnceSemaphore, getLockBackend
 from fantasm.log import Logger
 from fantasm.models import _FantasmFanIn, _FantasmInstance
 from fantasm.state import State
@@ -79,7 +84,12 @@ class FSM:
 
         # if the FSM is not using the currentConfig (.yaml was edited etc.)
         if not (FSM._CURRENT_CONFIG is currentConfig):
-            self._init(currentConfig=currentConfig)
+            if getattr(currentConfig, 'compiledTables', None):
+                # the tables were built ahead of time by "python -m fantasm.build compile"
+                self.config = currentConfig
+                self.machines, self.pseudoInits, self.pseudoFinals = currentConfig.compiledTables
+            else:
+                self._init(currentConfig=currentConfig)
             FSM._CURRENT_CONFIG = self.config
             FSM._MACHINES = self.machines
             FSM._PSEUDO_INITS = self.pseudoInits
@@ -176,6 +186,16 @@ class FSM:
         continuationCountdown = stateConfig.continuationCountdown
         fanInPeriod = stateConfig.fanInPeriod
         fanInGroup = stateConfig.fanInGroup
+        fanInMaxContexts = stateConfig.fanInMaxContexts
+        fanInCombiner = stateConfig.fanInCombiner
+        fanInReadLockCountdown = stateConfig.fanInReadLockCountdown
+        fanInShards = stateConfig.fanInShards
+        fanInCleanupPeriod = stateConfig.fanInCleanupPeriod
+        fanInExpected = stateConfig.fanInExpected
+        fanInAdaptive = stateConfig.fanInAdaptive
+        continuationBatches = stateConfig.continuationBatches
+        continuationSeconds = stateConfig.continuationSeconds
+        fanInEntityGroups = stateConfig.fanInEntityGroups
 
         return State(name,
                      entryAction,
@@ -187,7 +207,17 @@ class FSM:
                      isContinuation=isContinuation,
                      fanInPeriod=fanInPeriod,
                      fanInGroup=fanInGroup,
-                     continuationCountdown=continuationCountdown)
+                     continuationCountdown=continuationCountdown,
+                     fanInMaxContexts=fanInMaxContexts,
+                     fanInCombiner=fanInCombiner,
+                     fanInReadLockCountdown=fanInReadLockCountdown,
+                     fanInShards=fanInShards,
+                     fanInCleanupPeriod=fanInCleanupPeriod,
+                     fanInExpected=fanInExpected,
+                     fanInAdaptive=fanInAdaptive,
+                     continuationBatches=continuationBatches,
+                     continuationSeconds=continuationSeconds,
+                     fanInEntityGroups=fanInEntityGroups)
 
     def _getTransition(self, machineConfig, transitionConfig):
         """ Returns a Transition instance based on the machineConfig/transitionConfig
@@ -244,6 +274,11 @@ class FSM:
         queueName = machineConfig.queueName
         taskTarget = machineConfig.target
         useRunOnceSemaphore = machineConfig.useRunOnceSemaphore
+        payloadFormat = machineConfig.payloadFormat
+        compressionThreshold = machineConfig.compressionThreshold
+        offloadThreshold = machineConfig.offloadThreshold
+        instanceRows = machineConfig.instanceRows
+        runOnceSemaphoreMode = machineConfig.runOnceSemaphoreMode
 
         return FSMContext(initialState, currentState=currentState,
                           machineName=machineName, instanceName=instanceName,
@@ -254,7 +289,12 @@ class FSM:
                           obj=obj,
                           headers=headers,
                           globalTaskTarget=taskTarget,
-                          useRunOnceSemaphore=useRunOnceSemaphore)
+                          useRunOnceSemaphore=useRunOnceSemaphore,
+                          payloadFormat=payloadFormat,
+                          compressionThreshold=compressionThreshold,
+                          offloadThreshold=offloadThreshold,
+                          instanceRows=instanceRows,
+                          runOnceSemaphoreMode=runOnceSemaphoreMode)
 
 class FSMContext(dict):
     """ A finite state machine context instance. """
@@ -262,7 +302,10 @@ class FSMContext(dict):
     def __init__(self, initialState, currentState=None, machineName=None, instanceName=None,
                  retryOptions=None, url=None, queueName=None, data=None, contextTypes=None,
                  method='GET', persistentLogging=False, obj=None, headers=None, globalTaskTarget=None,
-                 useRunOnceSemaphore=True):
+                 useRunOnceSemaphore=True, payloadFormat=constants.DEFAULT_PAYLOAD_FORMAT,
+                 compressionThreshold=constants.DEFAULT_COMPRESSION_THRESHOLD,
+                 offloadThreshold=constants.DEFAULT_OFFLOAD_THRESHOLD, instanceRows=constants.DEFAULT_INSTANCE_ROWS,
+                 runOnceSemaphoreMode=constants.DEFAULT_RUN_ONCE_SEMAPHORE_MODE):
         """ Constructor
 
         @param initialState: a State instance
@@ -276,6 +319,12 @@ class FSMContext(dict):
         @param persistentLogging: if True, use persistent _FantasmLog model
         @param obj: an object that the FSMContext can operate on
         @param globalTaskTarget: the machine-level target configuration parameter
+        @param payloadFormat: how POST Tasks carry the context, one of constants.VALID_PAYLOAD_FORMAT_VALUES
+        @param compressionThreshold: compress POST Task bodies and fan-in work packages larger than this (bytes)
+        @param offloadThreshold: store context values larger than this (bytes, pickled) in _FantasmContextBlobs
+        @param instanceRows: if True, write a _FantasmInstance when the machine is started
+        @param runOnceSemaphoreMode: how FSMHandler guards against duplicate Tasks, one of
+                                     constants.VALID_RUN_ONCE_SEMAPHORE_MODE_VALUES
         """
         assert queueName
 
@@ -301,11 +350,183 @@ class FSMContext(dict):
         self.headers = headers
         self.globalTaskTarget = globalTaskTarget
         self.useRunOnceSemaphore = useRunOnceSemaphore
+        self.payloadFormat = payloadFormat
+        self.compressionThreshold = compressionThreshold
+        self.offloadThreshold = offloadThreshold
+        self.instanceRows = instanceRows
+        self.runOnceSemaphoreMode = runOnceSemaphoreMode
+        self._offloadedDigests = set() # shared with clones, so a fork/spawn fan-out writes each blob once
+        self._offloadedReferences = {} # shared with clones: id() of a value -> (value, ContextBlobReference or None)
 
         # the following is monkey-patched from handler.py for 'immediate mode'
         from google.appengine.api.taskqueue.taskqueue import Queue
         self.Queue = Queue # pylint: disable=C0103
 
+    # Copy-on-write: a clone copies a mutable value shared with a snapshot only when it is read (since the reader
+    # may mutate it) or replaced. A snapshot is shared by the clones, and by the context itself: the first clone
+    # deep-copies the mutable values the caller may still hold a reference to, and moves the context onto the
+    # copies, so that such a reference no longer reaches the snapshot.
+    _snapshot = None # (dict, frozenset of keys with mutable values)
+    _sharedKeys = frozenset() # keys whose values are still shared with a snapshot
+
+    # the next continuation batch of a continuation_batches state, held back by .continuation() so that .dispatch()
+    # runs it in the current request
+    _inlineContinuation = None
+
+    def _isolate(self, key, value):
+        """ Makes sure value (self[key]) is not shared with other contexts before handing it out. """
+        self._snapshot = None
+        if key in self._sharedKeys:
+            self._sharedKeys.discard(key)
+            value = copy.deepcopy(value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _isolateAll(self):
+        """ Makes sure no values are shared with other contexts, e.g., before handing out .items() """
+        self._snapshot = None
+        for key in list(self._sharedKeys):
+            self._isolate(key, dict.__getitem__(self, key))
+
+    def _resolveAll(self):
+        """ Makes sure no values are shared with other contexts or left in a _FantasmContextBlob, e.g., before
+        handing out .items()
+        """
+        self._isolateAll()
+        for key, value in list(dict.items(self)):
+            if value.__class__ is models.ContextBlobReference:
+                dict.__setitem__(self, key, value.resolve())
+
+    def _getSnapshot(self):
+        """ Returns the snapshot of the data for a clone, and the keys of its mutable values. """
+        if self._snapshot is not None:
+            return self._snapshot
+        mutableKeys = frozenset(key for (key, value) in dict.items(self)
+                                if value.__class__ not in _IMMUTABLE_VALUE_TYPES)
+        if not mutableKeys <= self._sharedKeys:
+            # some mutable values were set or handed out, so copy those once, and share the copies from now on
+            unshared = [key for key in mutableKeys if key not in self._sharedKeys]
+            dict.update(self, copy.deepcopy({key: dict.__getitem__(self, key) for key in unshared}))
+            self._sharedKeys = set(mutableKeys)
+        self._snapshot = (dict(self), mutableKeys)
+        return self._snapshot
+
+    def __getitem__(self, key):
+        """ see dict.__getitem__; resolves values offloaded to a _FantasmContextBlob on first read """
+        value = dict.__getitem__(self, key)
+        if value.__class__ in _IMMUTABLE_VALUE_TYPES:
+            return value
+        value = self._isolate(key, value)
+        if value.__class__ is models.ContextBlobReference:
+            value = value.resolve()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        """ see dict.__setitem__ """
+        dict.__setitem__(self, key, value)
+        self._snapshot = None
+        if self._sharedKeys:
+            self._sharedKeys.discard(key)
+
+    def __delitem__(self, key):
+        """ see dict.__delitem__ """
+        dict.__delitem__(self, key)
+        self._snapshot = None
+        if self._sharedKeys:
+            self._sharedKeys.discard(key)
+
+    def get(self, key, default=None):
+        """ see dict.get """
+        value = dict.get(self, key, default)
+        if value.__class__ in _IMMUTABLE_VALUE_TYPES or key not in self:
+            return value
+        return self[key]
+
+    def pop(self, key, *args):
+        """ see dict.pop """
+        if key not in self:
+            return dict.pop(self, key, *args)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        """ see dict.popitem """
+        self._resolveAll()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        """ see dict.setdefault """
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        """ see dict.update """
+        for arg in args:
+            if isinstance(arg, FSMContext):
+                arg._isolateAll() # pylint: disable=W0212
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        """ see dict.clear """
+        dict.clear(self)
+        self._snapshot = None
+        if self._sharedKeys:
+            self._sharedKeys.clear()
+
+    def items(self):
+        """ see dict.items """
+        self._resolveAll()
+        return dict.items(self)
+
+    def values(self):
+        """ see dict.values """
+        self._resolveAll()
+        return dict.values(self)
+
+    def copy(self):
+        """ see dict.copy """
+        self._resolveAll()
+        return dict.copy(self)
+
+    def _offloadValue(self, key, value):
+        """ Returns a ContextBlobReference if value is (or, per offload_threshold, should be) stored in a
+        _FantasmContextBlob rather than carried in the Task.
+
+        @param key: the context key of value
+        @param value: a context value
+        @return: a models.ContextBlobReference, or None
+        """
+        if value.__class__ is models.ContextBlobReference:
+            # never read in this request, so pass it along as-is, but keep the scrubber away from its blob
+            if value.digest not in self._offloadedDigests and \
+               (value.storedAt is None or time.time() - value.storedAt > constants.CONTEXT_BLOB_REFRESH_AGE):
+                value.refresh()
+            self._offloadedDigests.add(value.digest)
+            return value
+        if self.offloadThreshold is None or value is None or isinstance(value, (bool, int, float)):
+            return None
+        if isinstance(value, (str, bytes)) and len(value) <= self.offloadThreshold:
+            return None # cheap test before pickling
+
+        # a value that is immutable, or still shared with a snapshot, cannot have changed since it was last
+        # pickled, so the clones of a fan-out pickle it once between them
+        cacheable = value.__class__ in _IMMUTABLE_VALUE_TYPES or key in self._sharedKeys
+        if cacheable:
+            cached = self._offloadedReferences.get(id(value))
+            if cached is not None and cached[0] is value:
+                return cached[1]
+        data = pickle.dumps(value)
+        reference = None
+        if len(data) > self.offloadThreshold:
+            reference = models.ContextBlobReference.store(data, value=value, written=self._offloadedDigests)
+        if cacheable:
+            self._offloadedReferences[id(value)] = (value, reference) # holding value keeps its id() unique
+        return reference
+
     INSTANCE_NAME_DTFORMAT = '%Y%m%d%H%M%S'
 
     def _generateUniqueInstanceName(self):
@@ -354,7 +575,7 @@ class FSMContext(dict):
         assert self.currentState.name == FSM.PSEUDO_INIT
 
         url = self.buildUrl(self.currentState, FSM.PSEUDO_INIT)
-        params = self.buildParams(self.currentState, FSM.PSEUDO_INIT)
+        body = self.buildTaskBody(self.currentState, FSM.PSEUDO_INIT)
         if transactional:
             taskName = None
         else:
@@ -363,32 +584,67 @@ class FSMContext(dict):
         task = Task(name=taskName,
                     method=self.method,
                     url=url,
-                    params=params,
                     countdown=countdown,
-                    headers=self.headers,
                     retry_options=transition.retryOptions,
-                    target=self.globalTaskTarget)
+                    target=self.globalTaskTarget,
+                    **body)
         return task
 
-    def fork(self, data=None):
+    def fork(self, data=None, nextEvent=None):
         """ Forks the FSMContext.
 
         When an FSMContext is forked, an identical copy of the finite state machine is generated
         that will have the same event dispatched to it as the machine that called .fork(). The data
         parameter is useful for allowing each forked instance to operate on a different bit of data.
 
+        By default the forked FSMContexts are held until the action returns, and then queued all at once.
+        If the action knows the event it is going to return, it can pass it as nextEvent; the forked
+        FSMContexts are then turned into Tasks immediately and queued in batches of MAX_TASKS_PER_ADD
+        while the action is still running, so that memory stays bounded and the forked machines can start
+        before the action finishes.
+
         @param data: an option mapping of data to apply to the forked FSMContext
+        @param nextEvent: an optional event to stream the forked FSMContext with; must be the event the
+                          action returns
         """
         obj = self.__obj
+        stream = obj.get(constants.FORK_STREAM_PARAM)
         if obj.get(constants.FORKED_CONTEXTS_PARAM) is None:
             obj[constants.FORKED_CONTEXTS_PARAM] = []
         forkedContexts = obj.get(constants.FORKED_CONTEXTS_PARAM)
         data = copy.copy(data) or {}
-        data[constants.FORK_PARAM] = len(forkedContexts)
-        forkedContexts.append(self.clone(updateData=data))
+        data[constants.FORK_PARAM] = len(forkedContexts) + (stream.count if stream else 0)
+        context = self.clone(updateData=data)
+
+        if nextEvent is None:
+            forkedContexts.append(context)
+            return
+
+        if stream is None:
+            stream = obj[constants.FORK_STREAM_PARAM] = _ForkStream(self, nextEvent)
+        stream.add(context, nextEvent)
+
+    def _combineForks(self, contexts, nextEvent):
+        """ Combines the forked FSMContexts with the fan_in_combiner of the fan-in state that nextEvent leads to,
+        so that one work package is written per fan_in_group value instead of one per forked FSMContext.
+
+        @param contexts: a list of forked FSMContexts
+        @param nextEvent: the event to dispatch to the forked FSMContexts
+        @return: a list of the FSMContexts to dispatch nextEvent to
+        """
+        if not nextEvent:
+            return contexts
+        plan = self.currentState.getDispatchPlan(nextEvent)
+        if not (plan.isFanIn and plan.transition.target.fanInCombiner):
+            return contexts
+
+        combined = {}
+        for context in contexts:
+            _combineFork(combined, context, plan)
+        return list(combined.values())
 
     def spawn(self, machineName, contexts, countdown=0, method='POST',
-              _currentConfig=None, taskName=None):
+              _currentConfig=None, taskName=None, treeSpawnSize=None, instanceRows=False):
         """ Spawns new machines.
 
         @param machineName the machine to spawn
@@ -398,11 +654,14 @@ class FSMContext(dict):
         @param method the method ('GET' or 'POST') to invoke the machine with (default: POST)
         @param _currentConfig test injection for configuration
         @param taskName used for idempotency; will become the root of the task name for the actual task queued
+        @param treeSpawnSize see startStateMachine()
+        @param instanceRows see startStateMachine()
         """
         # using the current task name as a root to startStateMachine will make this idempotent
         taskName = taskName or self.__obj[constants.TASK_NAME_PARAM]
         startStateMachine(machineName, contexts, taskName=taskName, method=method, countdown=countdown,
-                          _currentConfig=_currentConfig, headers=self.headers)
+                          _currentConfig=_currentConfig, headers=self.headers, treeSpawnSize=treeSpawnSize,
+                          instanceRows=instanceRows)
 
     def initialize(self):
         """ Initializes the FSMContext. Queues a Task (so that we can benefit from auto-retry) to dispatch
@@ -414,9 +673,15 @@ class FSMContext(dict):
         """
         self[constants.STEPS_PARAM] = 0
         task = self.generateInitializationTask()
-        self.Queue(name=self.queueName).add(task)
-        key = db.Key.from_path(_FantasmInstance.kind(), self.instanceName, namespace='')
-        _FantasmInstance(key=key, instanceName=self.instanceName).put()
+
+        # queue the Task and write the _FantasmInstance concurrently
+        addRpc = self.Queue(name=self.queueName).add_async(task)
+        putRpc = db.put_async(_FantasmInstance.build(self.instanceName)) if self.instanceRows else None
+        try:
+            addRpc.get_result()
+        finally:
+            if putRpc:
+                putRpc.get_result()
 
         return FSM.PSEUDO_INIT
 
@@ -427,6 +692,13 @@ class FSMContext(dict):
         @param obj: an object that the FSMContext can operate on
         @return: an event string to dispatch to the FSMContext
         """
+        nextEvent = self._dispatch(event, obj)
+        if self._inlineContinuation is not None:
+            self._dispatchInlineContinuations(event, obj)
+        return nextEvent
+
+    def _dispatch(self, event, obj):
+        """ Moves the machine according to an event, see dispatch(). """
 
         self.__obj = self.__obj or obj # hold the obj object for use during this context
 
@@ -438,11 +710,23 @@ class FSMContext(dict):
         try:
             nextEvent = self.currentState.dispatch(self, event, obj)
 
+            stream = obj.pop(constants.FORK_STREAM_PARAM, None)
+            if stream:
+                if nextEvent != stream.nextEvent:
+                    self.logger.critical(
+                                     'Forked contexts were streamed with event "%s", but the action returned "%s". ' +
+                                     '(Machine %s, State %s)',
+                                     stream.nextEvent,
+                                     nextEvent,
+                                     self.machineName,
+                                     self.currentState.name)
+                stream.flush()
+
             if obj.get(constants.FORKED_CONTEXTS_PARAM):
                 # pylint: disable=W0212
                 # - accessing the protected method is fine here, since it is an instance of the same class
                 tasks = []
-                for context in obj[constants.FORKED_CONTEXTS_PARAM]:
+                for context in self._combineForks(obj[constants.FORKED_CONTEXTS_PARAM], nextEvent):
                     context[constants.STEPS_PARAM] = int(context.get(constants.STEPS_PARAM, '0')) + 1
                     task = context.queueDispatch(nextEvent, queue=False)
                     if task: # fan-in magic
@@ -516,18 +800,23 @@ class FSMContext(dict):
 
         return nextEvent
 
-    def continuation(self, nextToken):
+    def continuation(self, nextToken, shard=None, snapshot=None):
         """ Performs a continuation be re-queueing an FSMContext Task with a slightly modified continuation
         token. self.startingState and self.startingEvent are used in the re-queue, so this can be seen as a
         'fork' of the current context.
 
         @param nextToken: the next continuation token
+        @param shard: starts the independent chain of continuation Tasks of this key range, see
+                      ShardedDatastoreContinuationFSMAction
+        @param snapshot: a clone of this FSMContext to continue from instead, for a continuation queued after the
+                         action ran, see NDBPrefetchingContinuationFSMAction
         """
-        assert not self.get(constants.INDEX_PARAM) # fan-out after fan-in is not allowed
-        step = str(self[constants.STEPS_PARAM]) # needs to be a str key into a json dict
+        source = self if snapshot is None else snapshot
+        assert not source.get(constants.INDEX_PARAM) # fan-out after fan-in is not allowed
+        step = str(source[constants.STEPS_PARAM]) # needs to be a str key into a json dict
 
         # make a copy and set the currentState to the startingState of this context
-        context = self.clone()
+        context = source.clone()
         context.currentState = self.startingState
 
         # update the generation and continuation params
@@ -535,7 +824,21 @@ class FSMContext(dict):
         gen[step] = gen.get(step, 0) + 1
         context[constants.GEN_PARAM] = gen
         context[constants.CONTINUATION_PARAM] = nextToken
+        if shard is not None:
+            context[constants.CONTINUATION_SHARD_PARAM] = shard
+
+        # with continuation_batches, the next batch is run by .dispatch(), after this one
+        if shard is None and self.currentState.continuationBatches > 1:
+            self._inlineContinuation = context
+            return
+
+        self._queueContinuation(context)
+
+    def _queueContinuation(self, context):
+        """ Queues the Task of a continuation, see .continuation().
 
+        @param context: the FSMContext of the next continuation batch
+        """
         try:
             # pylint: disable=W0212
             # - accessing the protected method is fine here, since it is an instance of the same class
@@ -553,6 +856,63 @@ class FSMContext(dict):
                           self.machineName,
                           self.currentState.name)
 
+    def _dispatchInlineContinuations(self, event, obj):
+        """ Runs the continuation batches of a continuation_batches state in the current request, one after the
+        other, until continuation_batches batches have run or continuation_seconds have passed, and then queues the
+        Task of the next batch. Each batch runs with the FSMContext and Task name its own Task would have had, so
+        the Task names of its events and fan-in work packages are the same as without continuation_batches.
+
+        The batch count the Task stops at is recorded before the Task of the next batch is queued, and every
+        attempt of the Task stops at the batch recorded first, so the next continuation Task keeps its name. The
+        batches completed so far are recorded in the lock backend too, and a retry of a Task that recorded no stop
+        (e.g., one that ran into the request deadline) stops after as many batches, or sooner on time.
+
+        A batch that fails fails the whole Task, and its retry runs the batches before it again; their actions run
+        again, but the Tasks they queue keep their names.
+
+        @param event: the event that was dispatched to this FSMContext
+        @param obj: the obj of this FSMContext
+        """
+        state = self.currentState
+        startedAt = time.time()
+        taskName = obj.get(constants.TASK_NAME_PARAM)
+        semaphore = RunOnceSemaphore('inline-continuation-' + taskName, self) if taskName else None
+        progressKey = taskName and 'inline-continuation-batches-' + taskName
+        stop, batches = None, state.continuationBatches
+        if semaphore and obj.get(constants.RETRY_COUNT_PARAM, 0) > 0:
+            recorded = semaphore.readRunOnceSemaphore(transactional=False)
+            stop = int(recorded) if recorded else None
+            completed = getLockBackend().get(progressKey)
+            if completed:
+                batches = min(batches, int(completed))
+
+        context, batch = self, 1
+        while context._inlineContinuation is not None:
+            pending = context._inlineContinuation
+            context._inlineContinuation = None
+
+            if stop is None and (batch >= batches or time.time() - startedAt >= state.continuationSeconds):
+                stop = batch
+                if semaphore:
+                    # the first stop point recorded wins, should another attempt of this Task have stopped already
+                    _, recorded = semaphore.writeRunOnceSemaphore(payload=str(batch), transactional=False)
+                    stop = int(recorded)
+            if stop is not None and batch >= stop:
+                if batch == stop:
+                    context._queueContinuation(pending)
+                # otherwise, another attempt stopped sooner and queued the Task of the next batch
+                break
+
+            batch += 1
+            pendingObj = obj.__class__()
+            pendingObj[constants.RETRY_COUNT_PARAM] = obj.get(constants.RETRY_COUNT_PARAM, 0)
+            pendingObj[constants.TASK_NAME_PARAM] = pending.getTaskName(event)
+            pending.__obj = pendingObj
+            pending._dispatch(event, pendingObj)
+            context = pending
+            if progressKey:
+                getLockBackend().set(progressKey, batch)
+
     def setQueue(self, queueName):
         """ Used to override the queue defined in fsm.yaml, e.g., for dynamic queue selection. """
         if self.headers is None:
@@ -569,17 +929,18 @@ class FSMContext(dict):
         assert nextEvent is not None
 
         # self.currentState is already transitioned away from self.startingState
-        transition = self.currentState.getTransition(nextEvent)
+        plan = self.currentState.getDispatchPlan(nextEvent)
+        transition = plan.transition
         queueName = transition.queueName
-        if self.headers and self.headers.get(constants.HTTP_REQUEST_HEADER_QUEUENAME):
-            queueName = self.headers[constants.HTTP_REQUEST_HEADER_QUEUENAME]
-        if transition.target.isFanIn:
-            task = self._queueDispatchFanIn(nextEvent, fanInPeriod=transition.target.fanInPeriod,
+        if self.headers:
+            queueName = self.headers.get(constants.HTTP_REQUEST_HEADER_QUEUENAME) or queueName
+        if plan.isFanIn:
+            task = self._queueDispatchFanIn(nextEvent, fanInPeriod=plan.fanInPeriod,
                                             retryOptions=transition.retryOptions,
                                             queueName=queueName, taskTarget=transition.taskTarget)
         else:
             countdown = transition.countdown
-            if isinstance(countdown, tuple): # (minumum, maximum), randomly choose
+            if plan.randomCountdown: # (minumum, maximum), randomly choose
                 countdown = random.randint(countdown[0], countdown[1])
             task = self._queueDispatchNormal(nextEvent, queue=queue, countdown=countdown,
                                              retryOptions=transition.retryOptions,
@@ -603,11 +964,11 @@ class FSMContext(dict):
         assert queueName
 
         url = self.buildUrl(self.currentState, nextEvent)
-        params = self.buildParams(self.currentState, nextEvent)
+        body = self.buildTaskBody(self.currentState, nextEvent)
         taskName = self.getTaskName(nextEvent)
 
-        task = Task(name=taskName, method=self.method, url=url, params=params, countdown=countdown,
-                    retry_options=retryOptions, headers=self.headers, target=taskTarget)
+        task = Task(name=taskName, method=self.method, url=url, countdown=countdown,
+                    retry_options=retryOptions, target=taskTarget, **body)
         if queue:
             self.Queue(name=queueName).add(task)
             if not task.was_enqueued:
@@ -626,20 +987,32 @@ class FSMContext(dict):
         @return: a taskqueue.Task instance which may or may not have been queued already
         """
         assert nextEvent is not None
-        assert not self.get(constants.INDEX_PARAM) # fan-in after fan-in is not allowed
         assert queueName
 
+        # a fan-in after a fan-in is only allowed to merge the shards of a fan_in_shards fan-in
+        if self.pop(constants.FAN_IN_SHARD_PARAM, None) is not None:
+            self.pop(constants.INDEX_PARAM, None)
+        assert not self.get(constants.INDEX_PARAM) # fan-in after fan-in is not allowed
+
         # we pop this off here because we do not want the fan-out/continuation param as part of the
         # task name, otherwise we loose the fan-in - each fan-in gets one work unit.
         self.pop(constants.GEN_PARAM, None)
         fork = self.pop(constants.FORK_PARAM, None)
+        actualTaskName = self.__obj[constants.TASK_NAME_PARAM]
+        keyName = '-'.join([str(i) for i in [actualTaskName, fork] if i]) or None
 
         # transfer the fan-in-group into the context (under a fixed value key) so that states beyond
         # the fan-in get unique Task names
         # FIXME: this will likely change once we formalize what to do post fan-in
-        transition = self.currentState.getTransition(nextEvent)
-        if self.get(transition.target.fanInGroup) is not None:
-            self[constants.FAN_IN_GROUP_PARAM] = self[transition.target.fanInGroup]
+        target = self.currentState.getTransition(nextEvent).target
+        fanInGroup = target.fanInGroup
+        if self.get(fanInGroup) is not None:
+            self[constants.FAN_IN_GROUP_PARAM] = self[fanInGroup]
+
+        # with fan_in_shards, the shard (and so the lock, work index and fan-in Task) is picked by the work
+        # package key name, which is the same on retry; the shard is part of the Task names, like the group
+        if target.fanInShards:
+            self[constants.FAN_IN_SHARD_PARAM] = zlib.crc32((keyName or '').encode('utf-8')) % target.fanInShards
 
         taskNameBase = self.getTaskName(nextEvent, fanIn=True)
         rwlock = ReadWriteLock(taskNameBase, self)
@@ -665,60 +1038,75 @@ class FSMContext(dict):
         workIndex = '%s-%d' % (taskNameBase, knuthHash(index))
 
         # on retry, we want to ensure we get the same work index for this task
-        actualTaskName = self.__obj[constants.TASK_NAME_PARAM]
         indexKeyName = 'workIndex-' + '-'.join([str(i) for i in [actualTaskName, fork] if i]) or None
         semaphore = RunOnceSemaphore(indexKeyName, self)
 
-        # check if the workIndex changed during retry
-        semaphoreWritten = False
-        if self.__obj[constants.RETRY_COUNT_PARAM] > 0:
-            # see comment (A) in self._queueDispatchFanIn(...)
-            time.sleep(constants.DATASTORE_ASYNCRONOUS_INDEX_WRITE_WAIT_TIME)
-            payload = semaphore.readRunOnceSemaphore(payload=workIndex, transactional=False)
-            if payload:
-                semaphoreWritten = True
-                if payload != workIndex:
-                    self.logger.info("Work index changed from '%s' to '%s' on retry.", payload, workIndex)
-                    workIndex = payload
-
         # update this here so it gets written down into the work package too
         self[constants.INDEX_PARAM] = index
 
-        # write down two models, one actual work package, one idempotency package
-        keyName = '-'.join([str(i) for i in [actualTaskName, fork] if i]) or None
-        key = db.Key.from_path(_FantasmFanIn.kind(), keyName, namespace='')
-        work = _FantasmFanIn(context=self, workIndex=workIndex, key=key)
-
-        # close enough to idempotent, but could still write only one of the entities
-        # FIXME: could be made faster using a bulk put, but this interface is cleaner
-        if not semaphoreWritten:
-            semaphore.writeRunOnceSemaphore(payload=workIndex, transactional=False)
-
-        # put the work item
-        db.put(work)
-
-        # (A) now the datastore is asynchronously writing the indices, so the work package may
-        #     not show up in a query for a period of time. there is a corresponding time.sleep()
-        #     in the fan-in of self.mergeJoinDispatch(...)
-
-        # release the lock - memcache.decr()
-        rwlock.releaseWriteLock(index)
+        # write down two models, one idempotency package, one actual work package. the work package is stored
+        # under a workIndex parent key (see _FantasmFanIn.buildKey()), so both are written in one transaction
+        # that first reads the idempotency package: every write of this fork, on retry or concurrently after the
+        # index moved, then agrees on the workIndex and so overwrites the same work package. the ancestor queries
+        # in self.mergeJoinDispatch(...) see it as soon as the transaction commits
+        def buildWork(payload):
+            """ the work package under the workIndex the idempotency package agreed on """
+            key = _FantasmFanIn.buildKey(payload, keyName, entityGroups=target.fanInEntityGroups)
+            work = _FantasmFanIn(context=self, workIndex=payload, key=key)
+            work.compressionThreshold = self.compressionThreshold
+            return [work]
+        created, payload = semaphore.writeRunOnceSemaphoreWithEntities(buildWork, payload=workIndex)
+        semaphoreWritten = not created
+        if payload != workIndex:
+            self.logger.info("Work index changed from '%s' to '%s' on write.", workIndex, payload)
+            workIndex = payload
+
+        # the continuation shard is written down in the work package, for checkFanInForTotalResultsCount(), but is
+        # not carried beyond the fan-in
+        self.pop(constants.CONTINUATION_SHARD_PARAM, None)
+        self.pop(constants.CONTINUATION_SHARDS_PARAM, None)
+
+        # release the lock - memcache.decr() - while the Task is queued
+        rpcs = [rwlock.releaseWriteLockAsync(index)]
 
         try:
 
             # insert a task to run in the future and process a bunch of work packages
             now = time.time()
             url = self.buildUrl(self.currentState, nextEvent)
-            params = self.buildParams(self.currentState, nextEvent)
+            body = self.buildTaskBody(self.currentState, nextEvent)
             taskName = '%s-%d' % (taskNameBase, index)
+
+            # with fan_in_expected, the writer of the last expected work package fires the fan-in right away; the
+            # Task queued below still fires after the period, in case the count never gets there
+            expected = self._getFanInExpected(target)
+            if expected or target.fanInAdaptive:
+                arrivals = FanInArrivals(workIndex)
+                if target.fanInAdaptive:
+                    arrivals.recordSpan(now)
+                    fanInPeriod = self._getAdaptiveFanInPeriod(nextEvent, fanInPeriod)
+                if expected:
+                    # a retry of a writer whose work package was written already must not count it again
+                    if not semaphoreWritten:
+                        arrivals.arrive()
+                    if arrivals.count() >= expected:
+                        try:
+                            self.Queue(name=queueName).add(Task(name=taskName + '-expected',
+                                                                method=self.method,
+                                                                url=url,
+                                                                retry_options=retryOptions,
+                                                                target=taskTarget,
+                                                                **body))
+                        except (TaskAlreadyExistsError, TombstonedTaskError):
+                            pass
+
             task = Task(name=taskName,
                         method=self.method,
                         url=url,
-                        params=params,
                         eta=datetime.datetime.utcfromtimestamp(now) + datetime.timedelta(seconds=fanInPeriod),
-                        headers=self.headers,
                         retry_options=retryOptions,
-                        target=taskTarget)
+                        target=taskTarget,
+                        **body)
             self.Queue(name=queueName).add(task)
             if not task.was_enqueued:
                 self.logger.critical('Task "%s" was not enqueued.', taskName)
@@ -727,6 +1115,10 @@ class FSMContext(dict):
         except (TaskAlreadyExistsError, TombstonedTaskError):
             pass # Fan-in magic
 
+        finally:
+            for rpc in rpcs:
+                rpc.get_result()
+
 
     def mergeJoinDispatch(self, event, obj):
         """ Performs a merge join on the pending fan-in dispatches.
@@ -751,21 +1143,44 @@ class FSMContext(dict):
         if self._getTaskRetryLimit() is not None:
             raiseOnFail = (self._getTaskRetryLimit() > self.__obj[constants.RETRY_COUNT_PARAM])
 
-        rwlock = ReadWriteLock(taskNameBase, self)
-        rwlock.acquireReadLock(index, raiseOnFail=raiseOnFail)
-
-        # and return the FSMContexts list
-        class FSMContextList(list):
-            """ A list that supports .logger.info(), .logger.warning() etc.for fan-in actions """
-            def __init__(self, context, contexts, guarded=False):
-                """ setup a self.logger for fan-in actions """
-                super().__init__(contexts)
-                self.logger = Logger(context)
-                self.instanceName = context.instanceName
-                self.guarded = guarded
+        # the read lock was acquired by the Task that fanned in the first chunk (see _queueFanInChunk())
+        chunk = self.get(constants.FAN_IN_CHUNK_PARAM)
+        target = self.currentState.getTransition(event).target
+
+        # with fan_in_expected, two Tasks fire each fan-in (see _queueDispatchFanIn()), the first one claims it
+        if target.fanInExpected and not chunk and not self.get(constants.FAN_IN_READ_LOCK_WAIT_PARAM):
+            backend = getLockBackend()
+            claimKey = '%s-%d-claim' % (taskNameBase, index)
+            backend.add(claimKey, self.__obj[constants.TASK_NAME_PARAM])
+            claimedBy = backend.get(claimKey)
+            if claimedBy not in (None, self.__obj[constants.TASK_NAME_PARAM]):
+                self.logger.info("Fan-in '%s' was already fired by Task '%s'.", claimKey, claimedBy)
+                obj[constants.TERMINATED_PARAM] = True
+                contexts = FSMContextList(self, None)
+                contexts.guard()
+                return contexts
 
-        # see comment (A) in self._queueDispatchFanIn(...)
-        time.sleep(constants.DATASTORE_ASYNCRONOUS_INDEX_WRITE_WAIT_TIME)
+        rwlock = ReadWriteLock(taskNameBase, self)
+        # follow-up fan_in_max_contexts chunks skip the read lock, which the first chunk already acquired
+        if not chunk:
+            if target.fanInReadLockCountdown:
+                # with fan_in_read_lock_countdown, wait for the writers in re-queued Tasks rather than in this one
+                waits = self.get(constants.FAN_IN_READ_LOCK_WAIT_PARAM, 0)
+                if not waits:
+                    rwlock.closeWriteLock(index)
+                if not rwlock.writersDone(index):
+                    if waits < constants.FAN_IN_READ_LOCK_MAX_WAITS:
+                        self.logger.debug("Re-queuing to acquire read lock '%s' (%d times)...",
+                                          rwlock.lockKey(index), waits + 1)
+                        self._requeueFanIn({constants.FAN_IN_READ_LOCK_WAIT_PARAM: waits + 1},
+                                           countdown=target.fanInReadLockCountdown)
+                        obj[constants.TERMINATED_PARAM] = True
+                        contexts = FSMContextList(self, None)
+                        contexts.guard()
+                        return contexts
+                    rwlock.giveUpReadLock(index, raiseOnFail=raiseOnFail)
+            else:
+                rwlock.acquireReadLock(index, raiseOnFail=raiseOnFail)
 
         # the following step ensure that fan-in only ever operates one time over a list of data
         # the entity is created in State.dispatch(...) _after_ all the actions have executed
@@ -773,21 +1188,154 @@ class FSMContext(dict):
         khash = knuthHash(index)
         self.logger.debug('knuthHash of index: %s', khash)
         workIndex = '%s-%d' % (taskNameBase, khash)
-        if obj[constants.RETRY_COUNT_PARAM] > 0:
-            semaphore = RunOnceSemaphore(workIndex, self)
+
+        # with fan_in_adaptive, the next fan-ins wait in proportion to how long the work packages of this one took
+        # to arrive, up to the fan_in period
+        if target.fanInAdaptive and not chunk:
+            span = FanInArrivals(workIndex).span()
+            if span is not None:
+                period = min(target.fanInPeriod,
+                             max(constants.FAN_IN_ADAPTIVE_MIN_PERIOD, constants.FAN_IN_ADAPTIVE_FACTOR * span))
+                getLockBackend().set(self._getAdaptiveFanInPeriodKey(event), period)
+
+        # with fan_in_max_contexts, each Task fans in one chunk of the work packages (see _queueFanInChunk())
+        startAfter = self.pop(constants.FAN_IN_CURSOR_PARAM, None)
+        semaphoreName = '%s-chunk-%d' % (workIndex, chunk) if chunk else workIndex
+        maxContexts = target.fanInMaxContexts
+        nextCursor = None
+        if maxContexts:
+            lastKey = None
+            keys = _FantasmFanIn.fetchWorkIndex(workIndex, keysOnly=True, startAfter=startAfter,
+                                                entityGroups=target.fanInEntityGroups)
+            for i, key in enumerate(itertools.islice(keys, maxContexts + 1)):
+                if i == maxContexts:
+                    nextCursor = lastKey.name()
+                lastKey = key
+
+        contexts = FSMContextList(self, workIndex, startAfter=startAfter, maxContexts=maxContexts,
+                                  nextCursor=nextCursor, semaphoreName=semaphoreName,
+                                  entityGroups=target.fanInEntityGroups)
+        if target.fanInExpected and not chunk:
+            # the claim above is only kept in the LockBackend, so the Task that fired the fan-in second also checks
+            # for the semaphore written by the one that fanned it in
+            semaphore = RunOnceSemaphore(semaphoreName, self)
+            if semaphore.readRunOnceSemaphore():
+                self.logger.info("Fan-in idempotency guard for workIndex '%s', not processing any work items.",
+                                 semaphoreName)
+                contexts.guard() # don't operate over the data again
+        elif obj[constants.RETRY_COUNT_PARAM] > 0:
+            semaphore = RunOnceSemaphore(semaphoreName, self)
             if semaphore.readRunOnceSemaphore(payload=self.__obj[constants.TASK_NAME_PARAM]):
                 self.logger.info("Fan-in idempotency guard for workIndex '%s', not processing any work items.",
-                                 workIndex)
-                return FSMContextList(self, [], guarded=True) # don't operate over the data again
+                                 semaphoreName)
+                contexts.guard() # don't operate over the data again
+
+        return contexts
+
+    def _getFanInExpected(self, target):
+        """ Returns the fan_in_expected number of work packages of a fan-in State, or None
+
+        @param target: the fan-in State
+        """
+        expected = target.fanInExpected
+        if not isinstance(expected, str):
+            return expected
+        value = self.get(expected)
+        if value is None:
+            return None
+        try:
+            return int(value) # a str after an urlencoded (or a float after a json) hop
+        except (TypeError, ValueError):
+            raise InvalidFanInExpectedRuntimeError(expected, value, self.machineName, target.name,
+                                                   self.instanceName)
+
+    def _getAdaptiveFanInPeriodKey(self, event):
+        """ Returns the LockBackend key of the fan_in_adaptive period of the fan-ins of an event; shared by all
+        the instances of the machine
+
+        @param event: the event that transitions to the fan-in State
+        """
+        return 'fantasm-fan-in-period-%s-%s-%s' % (self.machineName, self.currentState.name, event)
+
+    def _getAdaptiveFanInPeriod(self, event, fanInPeriod):
+        """ Returns the fan_in_adaptive period of the fan-ins of an event
+
+        @param event: the event that transitions to the fan-in State
+        @param fanInPeriod: the fan_in period, the upper bound of the adaptive period
+        """
+        period = getLockBackend().get(self._getAdaptiveFanInPeriodKey(event))
+        return fanInPeriod if period is None else min(period, fanInPeriod)
+
+    def _queueFanInChunk(self, cursor):
+        """ Queues a Task to fan in the next fan_in_max_contexts work packages of the current work index, i.e.,
+        the ones after the cursor.
+
+        @param cursor: the key name of the last work package of the current chunk
+        """
+        self._requeueFanIn({constants.FAN_IN_CURSOR_PARAM: cursor,
+                            constants.FAN_IN_CHUNK_PARAM: self.get(constants.FAN_IN_CHUNK_PARAM, 0) + 1,
+                            constants.FAN_IN_READ_LOCK_WAIT_PARAM: None})
+
+    def _requeueFanIn(self, updateData, countdown=0):
+        """ Queues a Task to run the current fan-in again. self.startingState and self.startingEvent are used in
+        the re-queue, as in self.continuation(...).
+
+        @param updateData: a dict of the data to apply to the re-queued FSMContext; None values are removed
+        @param countdown: the number of seconds to countdown before the re-queued Task fires
+        """
+        context = self.clone()
+        context.currentState = self.startingState
+        for key, value in updateData.items():
+            if value is None:
+                context.pop(key, None)
+            else:
+                context[key] = value
+
+        try:
+            # pylint: disable=W0212
+            # - accessing the protected method is fine here, since it is an instance of the same class
+            transition = self.startingState.getTransition(self.startingEvent)
+            context._queueDispatchNormal(self.startingEvent, queue=True, countdown=countdown,
+                                         queueName=transition.queueName, retryOptions=transition.retryOptions,
+                                         taskTarget=transition.taskTarget)
+
+        except (TaskAlreadyExistsError, TombstonedTaskError):
+            self.logger.info('Unable to re-queue fan-in Task as it already exists. (Machine %s, State %s)',
+                          self.machineName,
+                          self.currentState.name)
+
+    def _queueFanInCleanup(self, workIndex, fanInState):
+        """ Queues a Task to delete the work packages of a processed fan-in. With fan_in_cleanup_period, the
+        workIndex is added to the FanInCleanupBucket of the current period instead, and only the first fan-in of
+        the period queues a Task; it fires once the period is over, and cleans up the whole bucket.
 
-        # fetch all the work packages in the current group for processing
-        query = _FantasmFanIn.all(namespace='') \
-                             .filter('workIndex =', workIndex) \
-                             .order('__key__')
+        @param workIndex: the workIndex of the processed fan-in
+        @param fanInState: the fan-in State
+        """
+        params = {constants.WORK_INDEX_PARAM: workIndex}
+        taskName = self.__obj[constants.TASK_NAME_PARAM] + '-cleanup'
+        countdown = 0
 
-        # construct a list of FSMContexts
-        contexts = [self.clone(replaceData=r.context) for r in query]
-        return FSMContextList(self, contexts)
+        period = fanInState.fanInCleanupPeriod
+        if period:
+            now = time.time()
+            bucket = FanInCleanupBucket.forPeriod(self.machineName, fanInState.name, period, now)
+            slot = bucket.add(workIndex)
+            if slot is not None:
+                if slot > 1 and not self.__obj[constants.RETRY_COUNT_PARAM]:
+                    return # the cleanup Task was queued by the first fan-in of the period
+                params = {constants.FAN_IN_CLEANUP_BUCKET_PARAM: bucket.key}
+                taskName = bucket.key
+                # fire a period after the end of this one, for the stragglers that were added late
+                countdown = int((now // period + 2) * period - now)
+
+        params[constants.FAN_IN_ENTITY_GROUPS_PARAM] = fanInState.fanInEntityGroups
+        try:
+            task = Task(name=taskName, url=constants.DEFAULT_CLEANUP_URL, params=params, countdown=countdown)
+            self.Queue(name=constants.DEFAULT_CLEANUP_QUEUE_NAME).add(task)
+
+        except (TaskAlreadyExistsError, TombstonedTaskError):
+            self.logger.info("Fan-in cleanup Task already exists.")
 
     def _getTaskRetryLimit(self):
         """ Method that returns the maximum number of retries for this particular dispatch
@@ -838,9 +1386,7 @@ class FSMContext(dict):
         @return: a url that can be used to build a taskqueue.Task instance to .dispatch(event)
         """
         assert state and event
-        return self.url + '{}/{}/{}/'.format(state.name,
-                                         event,
-                                         state.getTransition(event).target.name)
+        return self.url + state.getDispatchPlan(event).path
 
     def buildParams(self, state, event):
         """ Builds the taskqueue params.
@@ -853,8 +1399,13 @@ class FSMContext(dict):
         params = {constants.STATE_PARAM: state.name,
                   constants.EVENT_PARAM: event,
                   constants.INSTANCE_NAME_PARAM: self.instanceName}
-        for key, value in list(self.items()):
+        blobs = {}
+        for key, value in list(dict.items(self)): # read-only, so no need to copy shared values
             if key not in constants.NON_CONTEXT_PARAMS:
+                reference = self._offloadValue(key, value)
+                if reference is not None:
+                    blobs[key] = [reference.digest, reference.storedAt]
+                    continue
                 if self.contextTypes.get(key) is json.loads:
                     value = json.dumps(value, cls=models.Encoder)
                 if self.contextTypes.get(key) is pickle.loads:
@@ -884,23 +1435,100 @@ class FSMContext(dict):
                     key = key + '[]' # used to preserve lists of length=1 - see handler.py for inverse
 
                 params[key] = value
+        if blobs:
+            params[constants.CONTEXT_BLOBS_PARAM] = json.dumps(blobs, sort_keys=True)
         return params
 
+    def buildPayload(self, state, event):
+        """ Builds a single JSON task body holding the typed context, for payload_format: json.
+
+        Values are encoded with models.Encoder, so ints, floats, bools, dicts, lists, datetimes and keys
+        arrive in FSMHandler already typed. Any other context_types (i.e., pickle and custom classes), as well
+        as values that are not of their str/int/float/bool context_types, are sent as strings and listed under
+        PAYLOAD_CAST_KEY, to be cast as in the urlencoded format; so only keys declared as pickle are ever
+        unpickled. bytes arrive as str, unless they are not UTF-8, in which case they are sent base64 encoded.
+
+        @param state: the State to dispatch to
+        @param event: the event to dispatch
+        @return: a JSON string suitable to use as a POST task payload; see decodePayload()
+        """
+        assert state and event
+        context = {}
+        cast = []
+        for key, value in list(dict.items(self)): # read-only, so no need to copy shared values
+            if key in constants.NON_CONTEXT_PARAMS:
+                continue
+            contextType = self.contextTypes.get(key)
+            reference = self._offloadValue(key, value)
+            if reference is not None:
+                value = reference # models.Encoder writes the digest only
+            elif contextType is pickle.loads:
+                value = base64.urlsafe_b64encode(pickle.dumps(value)).decode() # as buildParams() sends it
+                cast.append(key)
+            elif (contextType is not None and contextType not in _JSON_NATIVE_CONTEXT_TYPES) or \
+                 not _isPayloadValueTyped(contextType, value):
+                value = [_toPayloadString(v) for v in value] if isinstance(value, (list, tuple)) else \
+                        _toPayloadString(value)
+                cast.append(key)
+            elif isinstance(value, bytes):
+                try:
+                    value = value.decode('utf-8') # as the urlencoded format would deliver it
+                except UnicodeDecodeError:
+                    value = {constants.PAYLOAD_BYTES_KEY: base64.urlsafe_b64encode(value).decode()}
+            context[key] = value
+        payload = {constants.STATE_PARAM: state.name,
+                   constants.EVENT_PARAM: event,
+                   constants.INSTANCE_NAME_PARAM: self.instanceName,
+                   constants.PAYLOAD_CONTEXT_KEY: context}
+        if cast:
+            payload[constants.PAYLOAD_CAST_KEY] = cast
+        return json.dumps(payload, cls=models.Encoder)
+
+    def buildTaskBody(self, state, event):
+        """ Builds the body-related keyword arguments for a taskqueue.Task, according to payload_format and
+        compression_threshold.
+
+        @param state: the State to dispatch to
+        @param event: the event to dispatch
+        @return: a dict of params/payload and headers keyword arguments
+        """
+        if self.method != 'POST':
+            return {'params': self.buildParams(state, event), 'headers': self.headers}
+
+        if self.payloadFormat == constants.PAYLOAD_FORMAT_JSON:
+            contentType = constants.JSON_CONTENT_TYPE
+            payload = self.buildPayload(state, event)
+        else:
+            params = self.buildParams(state, event)
+            if self.compressionThreshold is None:
+                return {'params': params, 'headers': self.headers}
+            contentType = 'application/x-www-form-urlencoded'
+            payload = urllib.parse.urlencode(params, doseq=True)
+
+        payload = payload.encode('utf-8')
+        if self.compressionThreshold is not None and len(payload) > self.compressionThreshold:
+            payload = constants.COMPRESSED_PAYLOAD_PREFIX + \
+                      utils.compress(payload, constants.COMPRESSION_METRIC_TASK)
+        headers = dict(self.headers or {})
+        headers['Content-Type'] = contentType
+        return {'payload': payload, 'headers': headers}
+
     def getTaskName(self, nextEvent, instanceName=None, fanIn=False):
         """ Returns a task name that is unique for a specific dispatch
 
         @param nextEvent: the event to dispatch
         @return: a task name that can be used to build a taskqueue.Task instance to .dispatch(nextEvent)
         """
-        transition = self.currentState.getTransition(nextEvent)
-        parts = []
-        parts.append(instanceName or self.instanceName)
+        plan = self.currentState.getDispatchPlan(nextEvent)
+        parts = [instanceName or self.instanceName]
 
         if self.get(constants.GEN_PARAM):
             for (step, gen) in list(self[constants.GEN_PARAM].items()):
                 parts.append('continuation-{}-{}'.format(step, gen))
         if self.get(constants.FORK_PARAM):
             parts.append('fork-' + str(self[constants.FORK_PARAM]))
+        if (not fanIn) and self.get(constants.CONTINUATION_SHARD_PARAM) is not None:
+            parts.append('continuation-shard-' + str(self[constants.CONTINUATION_SHARD_PARAM]))
         # post-fan-in we need to store the workIndex in the task name to avoid duplicates, since
         # we popped the generation off during fan-in
         # FIXME: maybe not pop the generation in fan-in?
@@ -908,12 +1536,16 @@ class FSMContext(dict):
         # FIXME: i wish this was easier to get right :-)
         if (not fanIn) and self.get(constants.INDEX_PARAM):
             parts.append('work-index-' + str(self[constants.INDEX_PARAM]))
-        parts.append(self.currentState.name)
-        parts.append(nextEvent)
-        parts.append(transition.target.name)
+        if (not fanIn) and self.get(constants.FAN_IN_CHUNK_PARAM):
+            parts.append('chunk-' + str(self[constants.FAN_IN_CHUNK_PARAM]))
+        if (not fanIn) and self.get(constants.FAN_IN_READ_LOCK_WAIT_PARAM):
+            parts.append('read-lock-wait-' + str(self[constants.FAN_IN_READ_LOCK_WAIT_PARAM]))
+        parts.append(plan.taskNameSuffix)
         parts.append('step-' + str(self[constants.STEPS_PARAM]))
         if self.get(constants.FAN_IN_GROUP_PARAM) is not None:
             parts.append('group-' + str(self[constants.FAN_IN_GROUP_PARAM]))
+        if self.get(constants.FAN_IN_SHARD_PARAM) is not None:
+            parts.append('shard-' + str(self[constants.FAN_IN_SHARD_PARAM]))
         return '--'.join(parts)
 
     def clone(self, instanceName=None, updateData=None, replaceData=None):
@@ -926,68 +1558,284 @@ class FSMContext(dict):
         """
         assert (not updateData) or (not replaceData), "cannot update and replace data at the same time"
 
-        #context = copy.deepcopy(self)
-        # shallow copy the context
-        context = copy.copy(self)
-
-        # deepcopy the dictionary portion of the context
-        deepcopy_dict = copy.deepcopy(dict(self))
-        context.update(deepcopy_dict)
+        # share the attributes, and a snapshot of the data (see _getSnapshot())
+        context = self.__class__.__new__(self.__class__)
+        context.__dict__.update(self.__dict__)
+        context._snapshot = None
+        if replaceData:
+            context._sharedKeys = frozenset()
+            dict.update(context, replaceData)
+        else:
+            snapshot, mutableKeys = self._getSnapshot()
+            context._sharedKeys = set(mutableKeys)
+            dict.update(context, snapshot)
 
         if instanceName:
             context.instanceName = instanceName
         if updateData:
             context.update(updateData)
-        if replaceData:
-            context.clear()
-            context.update(replaceData)
         return context
 
+class FSMContextList(list):
+    """ The FSMContexts of a fan-in, as passed to the fan-in state's actions (see FSMContext.mergeJoinDispatch()).
+    Supports .logger.info(), .logger.warning() etc. for fan-in actions.
+
+    The work packages are read into the list the first time it is used, so every iteration sees the same
+    FSMContexts, with the changes the entry action or an earlier loop made to them. With fan_in_max_contexts, they
+    are instead read lazily, a page at a time, each time the list is iterated over, so memory stays bounded
+    however many there are; len(), indexing and comparisons then read them all into memory once.
+    """
+
+    def __init__(self, context, workIndex, startAfter=None, maxContexts=None, nextCursor=None,
+                 semaphoreName=None, entityGroups=constants.DEFAULT_FAN_IN_ENTITY_GROUPS):
+        """ Constructor
+
+        @param context: the fan-in FSMContext
+        @param workIndex: the workIndex of the work packages
+        @param startAfter: only read the work packages with key names after this one
+        @param maxContexts: read at most this many work packages
+        @param nextCursor: the key name to start the next chunk after, if there are more than maxContexts
+        @param semaphoreName: the name of the fan-in's RunOnceSemaphore
+        @param entityGroups: the fan_in_entity_groups of the work packages
+        """
+        super().__init__()
+        self.logger = Logger(context)
+        self.instanceName = context.instanceName
+        self.guarded = False
+        self.workIndex = workIndex
+        self.nextCursor = nextCursor
+        self.semaphoreName = semaphoreName or workIndex
+        self._context = context
+        self._startAfter = startAfter
+        self._maxContexts = maxContexts
+        self._entityGroups = entityGroups
+        self._loaded = False
+
+    def guard(self):
+        """ Makes this an empty list, for a fan-in that was already processed """
+        self.guarded = True
+        self._loaded = True
+
+    def _iterate(self, keysOnly=False):
+        """ Yields the FSMContexts (or the db.Keys) of the work packages """
+        works = _FantasmFanIn.fetchWorkIndex(self.workIndex, keysOnly=keysOnly, startAfter=self._startAfter,
+                                             entityGroups=self._entityGroups)
+        for work in itertools.islice(works, self._maxContexts):
+            yield work if keysOnly else self._context.clone(replaceData=work.context)
+
+    def _load(self):
+        """ Reads all the FSMContexts into the list """
+        if not self._loaded:
+            self.extend(self._iterate())
+            self._loaded = True
+
+    def __iter__(self):
+        if self._loaded or not self._maxContexts:
+            self._load()
+            return super().__iter__()
+        return self._iterate()
+
+    def __bool__(self):
+        if self._loaded or not self._maxContexts:
+            self._load()
+            return super().__len__() > 0
+        return next(self._iterate(keysOnly=True), None) is not None
+
+    def __len__(self):
+        self._load()
+        return super().__len__()
+
+    def __getitem__(self, index):
+        self._load()
+        return super().__getitem__(index)
+
+    def __contains__(self, value):
+        return any(context == value for context in self)
+
+    def __eq__(self, other):
+        self._load()
+        if isinstance(other, FSMContextList):
+            other._load()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        self._load()
+        return super().__repr__()
+
+class _ForkStream:
+    """ Queues the Tasks of streamed forks (see FSMContext.fork()) in batches of MAX_TASKS_PER_ADD, as
+    the forked FSMContexts are produced. Only the current batch of Tasks is held in memory. """
+
+    def __init__(self, context, nextEvent):
+        """ Constructor
+
+        @param context: the FSMContext that is forking
+        @param nextEvent: the event to dispatch to each of the forked FSMContexts
+        """
+        from google.appengine.api.taskqueue.taskqueue import MAX_TASKS_PER_ADD
+        self.context = context
+        self.nextEvent = nextEvent
+        self.queueName = context.currentState.getTransition(nextEvent).queueName
+        self.batchSize = MAX_TASKS_PER_ADD
+        self.tasks = []
+        self.count = 0
+        plan = context.currentState.getDispatchPlan(nextEvent)
+        self.plan = plan if (plan.isFanIn and plan.transition.target.fanInCombiner) else None
+        self.combined = {} # with a fan_in_combiner, one FSMContext per fan_in_group value, dispatched in .flush()
+
+    def add(self, context, nextEvent):
+        """ Builds the Task for a forked FSMContext, and queues the current batch if it is full.
+
+        @param context: the forked FSMContext
+        @param nextEvent: the event to dispatch to the forked FSMContext
+        """
+        assert nextEvent == self.nextEvent, 'all streamed forks must use the same event'
+        self.count += 1
+        context[constants.STEPS_PARAM] = int(context.get(constants.STEPS_PARAM, '0')) + 1
+        if self.plan:
+            _combineFork(self.combined, context, self.plan)
+            return
+        task = context.queueDispatch(nextEvent, queue=False)
+        if task and not task.was_enqueued: # fan-in always queues
+            self.tasks.append(task)
+        if len(self.tasks) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """ Queues the current batch of Tasks. """
+        combined, self.combined = self.combined, {}
+        for context in combined.values():
+            context.queueDispatch(self.nextEvent) # fan-in always queues
+
+        tasks, self.tasks = self.tasks, []
+        if not tasks:
+            return
+        try:
+            _queueTasks(self.context.Queue, self.queueName, tasks)
+
+        except (TaskAlreadyExistsError, TombstonedTaskError):
+            # the Task names are deterministic, so when the forking Task is retried the batches that made it
+            # the first time around are rejected here, and the rest of the batch is still queued
+            self.context.logger.info(
+                             'Some fork Tasks %s were already queued. (Machine %s, State %s)',
+                             [task.name for task in tasks if not task.was_enqueued],
+                             self.context.machineName,
+                             self.context.currentState.name)
+
+def _combineFork(combined, context, plan):
+    """ Combines a forked FSMContext into the one already held for its fan_in_group value, if any.
+
+    @param combined: a dict of fan_in_group value to FSMContext, updated in place
+    @param context: a forked FSMContext
+    @param plan: the DispatchPlan of the fan-in, which has a fan_in_combiner
+    """
+    group = context.get(plan.fanInGroup) if plan.fanInGroup else None
+    group = None if group is None else str(group) # the value ends up in the Task name, see getTaskName()
+    if group in combined:
+        plan.transition.target.fanInCombiner.combine(combined[group], context)
+    else:
+        combined[group] = context
+
+# FSMContext values of these types are never copied by FSMContext.clone()
+_IMMUTABLE_VALUE_TYPES = frozenset([str, bytes, int, float, bool, type(None), datetime.datetime, datetime.date,
+                                    db.Key])
+
+# context_types that JSON (with models.Encoder/models.decode) round-trips without a cast
+_JSON_NATIVE_CONTEXT_TYPES = (str, int, float, bool, utils.boolConverter, json.loads, config.deserializeNDBKey)
+
+# the classes of the values a JSON payload delivers as these context_types would cast them
+_JSON_NATIVE_VALUE_CLASSES = {str: (str,), int: (int, bool), float: (float,), bool: (bool,),
+                              utils.boolConverter: (bool,)}
+
+def _isPayloadValueTyped(contextType, value):
+    """ Returns True if value (or each of its items) arrives from a JSON payload as contextType casts it. """
+    classes = _JSON_NATIVE_VALUE_CLASSES.get(contextType)
+    if classes is None:
+        return True
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return all(v is None or v.__class__ in classes for v in values)
+
+def _toPayloadString(value):
+    """ Returns value as the urlencoded format would deliver it, for FSMContext.putTypedValue() to cast. """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+def _decodePayloadValue(dct):
+    """ object_hook for decodePayload(); unwraps non-UTF-8 bytes, then defers to models.decode """
+    if constants.PAYLOAD_BYTES_KEY in dct:
+        return base64.urlsafe_b64decode(dct[constants.PAYLOAD_BYTES_KEY].encode())
+    return models.decode(dct)
+
+def decodePayload(body):
+    """ Decodes a JSON task body built by FSMContext.buildPayload().
+
+    @param body: the JSON string
+    @return: a tuple of (requestData, context, cast) where requestData is a dict of lists, like
+        urllib.parse.parse_qs() returns, holding the non-context params; context is a dict of typed context values;
+        and cast is a list of context keys that still need to be cast with FSMContext.putTypedValue(); the
+        caller must only cast keys that have context_types, as the body arrives over HTTP
+    """
+    payload = json.loads(body, object_hook=_decodePayloadValue)
+    context = payload.pop(constants.PAYLOAD_CONTEXT_KEY, {})
+    cast = payload.pop(constants.PAYLOAD_CAST_KEY, [])
+    requestData = {key: [value] for key, value in payload.items()}
+    return requestData, context, cast
+
 # pylint: disable=C0103
-def _queueTasks(Queue, queueName, tasks, transactional=False):
+def _queueTasks(Queue, queueName, tasks, transactional=False,
+                maxInFlight=constants.MAX_TASK_ADD_RPCS_IN_FLIGHT):
     """
     Add a list of Tasks to the supplied Queue/queueName
 
-    @param Queue: taskqueue.Queue or other object with .add() method
+    The Tasks are added in groups of MAX_TASKS_PER_ADD, with up to maxInFlight groups being added
+    concurrently. All groups are added even if some of them fail. If some Tasks were already queued,
+    the exception raised has an .alreadyEnqueuedTasks attribute listing exactly those Tasks.
+
+    @param Queue: taskqueue.Queue or other object with .add_async() method
     @param queueName: a queue name from queue.yaml
     @param tasks: a list of taskqueue.Tasks
     @param transactional: tasks are only queued if transaction commits successfully; default False
+    @param maxInFlight: the maximum number of concurrent add RPCs
 
     @raise TaskAlreadyExistsError:
     @raise TombstonedTaskError:
     """
 
     from google.appengine.api.taskqueue.taskqueue import MAX_TASKS_PER_ADD
-    taskAlreadyExists, tombstonedTask = None, None
+    queue = Queue(name=queueName)
+    rpcs = collections.deque()
+    errors = []
 
-    # queue the Tasks in groups of MAX_TASKS_PER_ADD
-    i = 0
-    for i in range(len(tasks)):
-        someTasks = tasks[i * MAX_TASKS_PER_ADD : (i+1) * MAX_TASKS_PER_ADD]
-        if not someTasks:
-            break
-
-        # queue them up, and loop back for more, even if there are failures
+    def waitForOldest():
+        """ Waits for the oldest add RPC, and keeps its error (if any) """
         try:
-            Queue(name=queueName).add(someTasks, transactional=transactional)
-
-        except TaskAlreadyExistsError as e:
-            taskAlreadyExists = e
-
-        except TombstonedTaskError as e:
-            tombstonedTask = e
-
-    if taskAlreadyExists:
-        # pylint: disable=E0702
-        raise taskAlreadyExists
-
-    if tombstonedTask:
-        # pylint: disable=E0702
-        raise tombstonedTask
+            rpcs.popleft().get_result()
+        except (TaskAlreadyExistsError, TombstonedTaskError) as e:
+            errors.append(e)
+
+    # queue the Tasks in groups of MAX_TASKS_PER_ADD, even if there are failures
+    for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        if len(rpcs) >= maxInFlight:
+            waitForOldest()
+        rpcs.append(queue.add_async(tasks[i : i + MAX_TASKS_PER_ADD], transactional=transactional))
+    while rpcs:
+        waitForOldest()
+
+    if errors:
+        # TaskAlreadyExistsError takes precedence over TombstonedTaskError
+        error = ([e for e in errors if isinstance(e, TaskAlreadyExistsError)] or errors)[0]
+        error.alreadyEnqueuedTasks = [task for task in tasks if not task.was_enqueued]
+        raise error
 
 def startStateMachine(machineName, contexts, taskName=None, method='POST', countdown=0,
                       _currentConfig=None, headers=None, raiseIfTaskExists=False, transactional=False,
-                      queueName=None):
+                      queueName=None, treeSpawnSize=None, instanceRows=False):
     """ Starts a new machine(s), by simply queuing a task.
 
     @param machineName the name of the machine in the FSM to start
@@ -1002,6 +1850,11 @@ def startStateMachine(machineName, contexts, taskName=None, method='POST', count
     @param queueName: The queue to use for the machine. Note this queue is only used _after_ the initialization task,
                       which will still be queued up on the machine default. This allows a single switch to halt
                       new machines, but still allows for dynamically running machines on non-default queues.
+    @param treeSpawnSize: if there are more contexts than this, they are stored in slices of this size (or
+                          smaller, to fit in a _FantasmContextBlob), and a tree of spawner Tasks (see
+                          _spawnTree()) queues the machines instead of this request
+    @param instanceRows: if True, write the _FantasmInstances of the machines in one multi-put, while the Tasks
+                         are queued; ignored if transactional, or if the machine has instance_rows: False
 
     @param _currentConfig used for test injection (default None - use fsm.yaml definitions)
     """
@@ -1026,26 +1879,124 @@ def startStateMachine(machineName, contexts, taskName=None, method='POST', count
                          queueName, headers[constants.HTTP_REQUEST_HEADER_QUEUENAME])
         headers[constants.HTTP_REQUEST_HEADER_QUEUENAME] = queueName
 
-    instances = [fsm.createFSMInstance(machineName, data=context, method=method, headers=headers)
-                 for context in contexts]
+    if treeSpawnSize and len(contexts) > treeSpawnSize:
+        # the initialization tasks are queued by a tree of spawner tasks, on the machine's default queue and target
+        machineConfig = (_currentConfig or config.currentConfiguration()).machines[machineName]
+        initialQueueName = machineConfig.queueName
+        references = models.ContextBlobReference.storeMulti(
+            _pickleSpawnSlices(machineName, contexts, countdown, treeSpawnSize))
+        tasks = _buildSpawnTasks(machineName, references, '', taskName, method, headers, initialQueueName,
+                                 transactional=transactional, instanceRows=instanceRows,
+                                 spawnTarget=machineConfig.target)
+        putRpc = None
+
+    else:
+        instances = [fsm.createFSMInstance(machineName, data=context, method=method, headers=headers)
+                     for context in contexts]
+
+        tasks = []
+        for i, instance in enumerate(instances):
+            tname = None
+            if taskName:
+                tname = '%s--startStateMachine-%d' % (taskName, i)
+            task = instance.generateInitializationTask(countdown=countdown[i], taskName=tname,
+                                                       transactional=transactional)
+            tasks.append(task)
+
+        initialQueueName = instances[0].queueName # same machineName, same queues
+
+        putRpc = None
+        if instanceRows and instances[0].instanceRows and not transactional:
+            putRpc = db.put_async([_FantasmInstance.build(instance.instanceName) for instance in instances])
 
-    tasks = []
-    for i, instance in enumerate(instances):
-        tname = None
-        if taskName:
-            tname = '%s--startStateMachine-%d' % (taskName, i)
-        task = instance.generateInitializationTask(countdown=countdown[i], taskName=tname, transactional=transactional)
-        tasks.append(task)
-
-    initialQueueName = instances[0].queueName # same machineName, same queues
     try:
         from google.appengine.api.taskqueue.taskqueue import Queue
         _queueTasks(Queue, initialQueueName, tasks, transactional=transactional)
     except (TaskAlreadyExistsError, TombstonedTaskError):
-        # FIXME: what happens if _some_ of the tasks were previously enqueued?
-        # normal result for idempotency
+        # normal result for idempotency; the tasks that were not previously enqueued have still been queued
+        # (see the .alreadyEnqueuedTasks attribute of the exception)
         import logging
         logging.info('Unable to queue new machine %s with taskName %s as it has been previously enqueued.',
                       machineName, taskName)
         if raiseIfTaskExists:
             raise
+    finally:
+        if putRpc:
+            putRpc.get_result()
+
+def _pickleSpawnSlices(machineName, contexts, countdowns, size):
+    """ Returns the pickled (contexts, countdowns) slices of up to size contexts each; a slice too large for a
+    _FantasmContextBlob is split in halves until it fits.
+
+    @param machineName: the machine to start
+    @param contexts: see startStateMachine()
+    @param countdowns: a countdown per context
+    @param size: the treeSpawnSize
+    @return: a list of pickles
+    """
+    datas = []
+    for i in range(0, len(contexts), size):
+        data = pickle.dumps((contexts[i : i + size], countdowns[i : i + size]))
+        if len(data) <= constants.CONTEXT_BLOB_MAX_SIZE:
+            datas.append(data)
+        elif size > 1:
+            datas.extend(_pickleSpawnSlices(machineName, contexts[i : i + size], countdowns[i : i + size],
+                                            -(-size // 2)))
+        else:
+            raise SpawnContextTooLargeRuntimeError(machineName, len(data))
+    return datas
+
+def _buildSpawnTasks(machineName, references, path, taskName, method, headers, spawnQueueName,
+                     transactional=False, instanceRows=False, spawnTarget=None):
+    """ Returns the Tasks that run _spawnTree() for up to TREE_SPAWN_FAN_OUT groups of the slices
+
+    @param machineName: the machine to start
+    @param references: a list of models.ContextBlobReference to slices of (contexts, countdowns)
+    @param path: the position of the calling spawner in the tree (e.g., '3-1'); '' for startStateMachine()
+    @param taskName: the taskName passed to startStateMachine(); the root of all the task names
+    @param method: see startStateMachine()
+    @param headers: see startStateMachine()
+    @param spawnQueueName: the queue to run the spawner Tasks on
+    @param transactional: see startStateMachine()
+    @param instanceRows: see startStateMachine()
+    @param spawnTarget: the target to run the spawner Tasks on (the machine's target)
+    @return: a list of taskqueue.Tasks
+    """
+    # a transaction can only add a handful of (unnamed) Tasks, so a transactional root has a single child
+    fanOut = 1 if transactional else constants.TREE_SPAWN_FAN_OUT
+    groupSize = -(-len(references) // fanOut)
+    tasks = []
+    for i in range(0, len(references), groupSize):
+        childPath = '%s-%d' % (path, i // groupSize) if path else str(i // groupSize)
+        payload = deferred.serialize(_spawnTree, machineName, references[i : i + groupSize], childPath,
+                                     taskName, method, headers, spawnQueueName, instanceRows=instanceRows,
+                                     spawnTarget=spawnTarget)
+        tasks.append(Task(name=None if transactional else (taskName and '%s--spawn-%s' % (taskName, childPath)),
+                          url=constants.DEFAULT_SPAWN_URL,
+                          payload=payload,
+                          target=spawnTarget))
+    return tasks
+
+def _spawnTree(machineName, references, path, taskName, method, headers, spawnQueueName, instanceRows=False,
+               spawnTarget=None):
+    """ Runs in a spawner Task (see startStateMachine(treeSpawnSize=...)); starts the machines for a single
+    slice of contexts, or splits a number of slices over another level of spawner Tasks.
+
+    @param: see _buildSpawnTasks()
+    """
+    if len(references) == 1:
+        contexts, countdowns = references[0].resolve()
+        startStateMachine(machineName, contexts, taskName=taskName and '%s--spawn-%s' % (taskName, path),
+                          method=method, countdown=countdowns, headers=headers, instanceRows=instanceRows)
+        return
+
+    tasks = _buildSpawnTasks(machineName, references, path, taskName, method, headers, spawnQueueName,
+                             instanceRows=instanceRows, spawnTarget=spawnTarget)
+    try:
+        from google.appengine.api.taskqueue.taskqueue import Queue
+        _queueTasks(Queue, spawnQueueName, tasks)
+    except (TaskAlreadyExistsError, TombstonedTaskError):
+        # normal result for idempotency
+        import logging
+        logging.info('Unable to queue spawner tasks for machine %s with taskName %s as they have been '
+                     'previously enqueued.', machineName, taskName)
@@ -22,10 +22,12 @@ import logging
 import sys
 import time
 import traceback
+import zlib
 from urllib.parse import parse_qs
 import six
 
-from google.appengine.ext import db, deferred
+from google.appengine.api.taskqueue.taskqueue import Queue, Task
+from google.appengine.ext import deferred
 
 try:
     from google.appengine.api.capabilities import CapabilitySet
@@ -42,10 +44,10 @@ from fantasm.constants import (EVENT_PARAM, HTTP_REQUEST_HEADER_PREFIX,
 from fantasm.exceptions import (TRANSIENT_ERRORS, FSMRuntimeError,
                                 RequiredServicesUnavailableRuntimeError,
                                 UnknownMachineError)
-from fantasm.fsm import FSM
-from fantasm.lock import RunOnceSemaphore
-from fantasm.models import Encoder, _FantasmFanIn
-from fantasm.utils import NoOpQueue
+from fantasm.fsm import FSM, decodePayload
+from fantasm.lock import FanInCleanupBucket, RunOnceSemaphore
+from fantasm.models import ContextBlobReference, Encoder, _FantasmFanIn
+from fantasm.utils import Metrics, NoOpQueue
 
 REQUIRED_SERVICES = ("memcache", "datastore_v3", "taskqueue")
 
@@ -113,17 +115,41 @@ class FSMLogHandler:
 
 
 class FSMFanInCleanupHandler:
-    """The handler used for logging"""
+    """The handler used to delete the work packages of processed fan-ins"""
 
     def __call__(self, environ, start_response):
-        """Runs the serialized function"""
+        """Deletes the work packages of the workIndexes, and/or of the FanInCleanupBucket, of the request"""
         if environ["REQUEST_METHOD"] == "POST":
             body = environ["wsgi.input"].read()
             if isinstance(body, bytes):
                 body = body.decode()
-            workIndex = parse_qs(body).get(constants.WORK_INDEX_PARAM, [None])[0]
-            q = _FantasmFanIn.all(namespace="").filter("workIndex =", workIndex)
-            db.delete(q)
+            params = parse_qs(body)
+            workIndexes = params.get(constants.WORK_INDEX_PARAM, [])
+            for bucketKey in params.get(constants.FAN_IN_CLEANUP_BUCKET_PARAM, []):
+                workIndexes.extend(FanInCleanupBucket(bucketKey).workIndexes())
+            entityGroups = int(params.get(constants.FAN_IN_ENTITY_GROUPS_PARAM,
+                                          [constants.DEFAULT_FAN_IN_ENTITY_GROUPS])[0])
+            remaining = _FantasmFanIn.deleteWorkIndexes(workIndexes,
+                                                        constants.FAN_IN_CLEANUP_BATCH_SIZE,
+                                                        constants.FAN_IN_CLEANUP_MAX_BATCHES,
+                                                        entityGroups=entityGroups)
+            if remaining:
+                # too many work packages for one request, the next Task picks up where this one stopped
+                params = {constants.WORK_INDEX_PARAM: remaining, constants.FAN_IN_ENTITY_GROUPS_PARAM: entityGroups}
+                task = Task(url=constants.DEFAULT_CLEANUP_URL, params=params)
+                Queue(name=constants.DEFAULT_CLEANUP_QUEUE_NAME).add(task)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b""]
+
+
+class FSMSpawnHandler:
+    """The handler used for the spawner tasks of startStateMachine(treeSpawnSize=...)"""
+
+    def __call__(self, environ, start_response):
+        """Runs the serialized function"""
+        if environ["REQUEST_METHOD"] == "POST":
+            body = environ["wsgi.input"].read()
+            deferred.run(body)
         start_response("200 OK", [("Content-Type", "text/plain")])
         return [b""]
 
@@ -208,9 +234,18 @@ class FSMHandler:
                     headers[key] = value.strip()
 
         method = environ["REQUEST_METHOD"]
+        payloadContext = None
         if method == "POST":
-            request_body = six.ensure_str(environ["wsgi.input"].read())
-            requestData = parse_qs(request_body)
+            request_body = environ["wsgi.input"].read()
+            if request_body.startswith(constants.COMPRESSED_PAYLOAD_PREFIX):
+                # compression_threshold
+                request_body = zlib.decompress(request_body[len(constants.COMPRESSED_PAYLOAD_PREFIX):])
+            request_body = six.ensure_str(request_body)
+            if environ.get("CONTENT_TYPE", "").startswith(constants.JSON_CONTENT_TYPE):
+                # payload_format: json - the context arrives already typed
+                requestData, payloadContext, payloadCast = decodePayload(request_body)
+            else:
+                requestData = parse_qs(request_body)
         if method == "GET":
             requestData = parse_qs(environ["QUERY_STRING"])
         method = requestData.get("method", [method])[0]
@@ -247,11 +282,17 @@ class FSMHandler:
 
         # Taskqueue can invoke multiple tasks of the same name occassionally. Here, we'll use
         # a datastore transaction as a semaphore to determine if we should actually execute this or not.
+        # With run_once_semaphore_mode: fast, memcache.add() replaces the transaction.
         if taskName and fsm.useRunOnceSemaphore:
             semaphoreKey = "{}--{}".format(taskName, retryCount)
             semaphore = RunOnceSemaphore(semaphoreKey, None)
-            if not semaphore.writeRunOnceSemaphore(payload="fantasm")[0]:
+            if fsm.runOnceSemaphoreMode == constants.RUN_ONCE_SEMAPHORE_MODE_FAST:
+                created = semaphore.addRunOnceSemaphore(payload="fantasm")
+            else:
+                created = semaphore.writeRunOnceSemaphore(payload="fantasm")[0]
+            if not created:
                 # we can simply return here, this is a duplicate fired task
+                Metrics.incr(constants.RUN_ONCE_SEMAPHORE_METRIC + ".duplicates")
                 logging.warn(
                     'A duplicate task "%s" has been queued by taskqueue infrastructure. Ignoring.',
                     taskName,
@@ -267,22 +308,33 @@ class FSMHandler:
             fsm.Queue = NoOpQueue  # don't queue anything else
 
         # pull all the data off the url and stuff into the context
-        for key, value in list(requestData.items()):
-            if key in NON_CONTEXT_PARAMS:
-                continue  # these are special, don't put them in the data
+        if payloadContext is not None:
+            fsm.update(payloadContext)
+            for key in payloadCast:
+                if key in fsm.contextTypes: # never cast (i.e., unpickle) a key the yaml does not declare
+                    fsm.putTypedValue(key, fsm[key])
+        else:
+            # offload_threshold - read from the datastore only if an action reads them
+            blobs = json.loads(requestData.get(constants.CONTEXT_BLOBS_PARAM, ['{}'])[0])
+            for key, (digest, storedAt) in blobs.items():
+                fsm[key] = ContextBlobReference(digest, storedAt=storedAt)
 
-            # deal with ...a=1&a=2&a=3...
-            value = requestData.get(key, None)
+            for key, value in list(requestData.items()):
+                if key in NON_CONTEXT_PARAMS:
+                    continue  # these are special, don't put them in the data
 
-            if len(value) == 1 and not str(key).endswith('[]'):
-                value = value[0]
-            if str(key).endswith('[]'):
-                key = key[:-2]
+                # deal with ...a=1&a=2&a=3...
+                value = requestData.get(key, None)
 
-            if key in list(fsm.contextTypes.keys()):
-                fsm.putTypedValue(key, value)
-            else:
-                fsm[key] = value
+                if len(value) == 1 and not str(key).endswith('[]'):
+                    value = value[0]
+                if str(key).endswith('[]'):
+                    key = key[:-2]
+
+                if key in list(fsm.contextTypes.keys()):
+                    fsm.putTypedValue(key, value)
+                else:
+                    fsm[key] = value
 
         if not (fsmState or fsmEvent):
 
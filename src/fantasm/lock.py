@@ -16,19 +16,154 @@ Copyright 2010 VendAsta Technologies Inc.
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import collections
 import random
+import threading
 import time
 import logging
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
 
+from fantasm import constants
 from fantasm.models import _FantasmTaskSemaphore
 from fantasm.exceptions import FanInWriteLockFailureRuntimeError
 from fantasm.exceptions import FanInReadLockFailureRuntimeError
+from fantasm.utils import Metrics, _NoOpRPC
 
 # a variety of locking mechanisms to enforce idempotency (of the framework) in the face of retries
 
+class LockBackend:
+    """ Defines the interface of the counter store behind ReadWriteLock, with memcache semantics: missing keys
+    read as None, and counters never go below 0. See setLockBackend(). """
+
+    def get(self, key):
+        """ Returns the value of key, or None """
+        raise NotImplementedError()
+
+    def add(self, key, value):
+        """ Sets key to value, unless key is already set """
+        raise NotImplementedError()
+
+    def getMulti(self, keys):
+        """ Returns a dict of the values of the keys that are set """
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        """ Sets key to value """
+        raise NotImplementedError()
+
+    def incr(self, key, delta=1, initialValue=None):
+        """ Increments the counter key, starting it at initialValue if it is missing
+
+        @return: the new value, or None if key is missing and there is no initialValue
+        """
+        raise NotImplementedError()
+
+    def decr(self, key, delta=1):
+        """ Decrements the counter key
+
+        @return: the new value, or None if key is missing
+        """
+        raise NotImplementedError()
+
+    def decrAsync(self, key, delta=1):
+        """ Decrements the counter key, without waiting for the result
+
+        @return: an RPC whose .get_result() is the return value of .decr()
+        """
+        raise NotImplementedError()
+
+class MemcacheLockBackend(LockBackend):
+    """ The default LockBackend; the counters are shared by all the instances of the application. """
+
+    def get(self, key):
+        """ see LockBackend.get """
+        return memcache.get(key, namespace=None)
+
+    def add(self, key, value):
+        """ see LockBackend.add """
+        memcache.add(key, value, namespace=None)
+
+    def getMulti(self, keys):
+        """ see LockBackend.getMulti """
+        return memcache.get_multi(keys, namespace=None)
+
+    def set(self, key, value):
+        """ see LockBackend.set """
+        memcache.set(key, value, namespace=None)
+
+    def incr(self, key, delta=1, initialValue=None):
+        """ see LockBackend.incr """
+        return memcache.incr(key, delta, initial_value=initialValue, namespace=None)
+
+    def decr(self, key, delta=1):
+        """ see LockBackend.decr """
+        return memcache.decr(key, delta, namespace=None)
+
+    def decrAsync(self, key, delta=1):
+        """ see LockBackend.decrAsync """
+        return memcache.Client().decr_async(key, delta, namespace=None)
+
+class InProcessLockBackend(LockBackend):
+    """ A LockBackend that keeps the counters in a dict, for local runs and tests where every Task runs in
+    the same process. The counters are not shared between instances, so never use it in production. """
+
+    def __init__(self):
+        """ Constructor """
+        self.counters = {}
+        self.mutex = threading.Lock()
+
+    def get(self, key):
+        """ see LockBackend.get """
+        return self.counters.get(key)
+
+    def add(self, key, value):
+        """ see LockBackend.add """
+        with self.mutex:
+            self.counters.setdefault(key, value)
+
+    def getMulti(self, keys):
+        """ see LockBackend.getMulti """
+        return dict((key, self.counters[key]) for key in keys if key in self.counters)
+
+    def set(self, key, value):
+        """ see LockBackend.set """
+        with self.mutex:
+            self.counters[key] = value
+
+    def incr(self, key, delta=1, initialValue=None):
+        """ see LockBackend.incr """
+        with self.mutex:
+            if key not in self.counters:
+                if initialValue is None:
+                    return None
+                self.counters[key] = initialValue
+            self.counters[key] = max(0, self.counters[key] + delta)
+            return self.counters[key]
+
+    def decr(self, key, delta=1):
+        """ see LockBackend.decr """
+        return self.incr(key, -delta)
+
+    def decrAsync(self, key, delta=1):
+        """ see LockBackend.decrAsync """
+        return _NoOpRPC(result=self.decr(key, delta))
+
+_lockBackend = MemcacheLockBackend()
+
+def setLockBackend(backend):
+    """ Sets the LockBackend of every ReadWriteLock in this process, e.g., setLockBackend(InProcessLockBackend())
+
+    @param backend: a LockBackend instance
+    """
+    global _lockBackend # pylint: disable=W0603
+    _lockBackend = backend
+
+def getLockBackend():
+    """ Returns the LockBackend of every ReadWriteLock in this process """
+    return _lockBackend
+
 class ReadWriteLock:
     """ A read/write lock that allows
 
@@ -62,18 +197,19 @@ class ReadWriteLock:
         return self.taskNameBase + '-' + ReadWriteLock.LOCK_PARAM + '-' + str(index)
 
     def currentIndex(self):
-        """ Returns the current lock index from memcache, or sets it if it is missing
+        """ Returns the current lock index from the lock backend, or sets it if it is missing
 
         @return: an int, the current index
         """
+        backend = getLockBackend()
         indexKey = self.indexKey()
-        index = memcache.get(indexKey, namespace=None)
+        index = backend.get(indexKey)
         if index is None:
             # using 'random.randint' here instead of '1' helps when the index is ejected from memcache
             # instead of restarting at the same counter, we jump (likely) far way from existing task job
             # names.
-            memcache.add(indexKey, random.randint(1, 2**32), namespace=None)
-            index = memcache.get(indexKey, namespace=None)
+            backend.add(indexKey, random.randint(1, 2**32))
+            index = backend.get(indexKey)
         return index
 
     def acquireWriteLock(self, index, nextEvent=None, raiseOnFail=True):
@@ -84,8 +220,8 @@ class ReadWriteLock:
         """
         acquired = True
         lockKey = self.lockKey(index)
-        writers = memcache.incr(lockKey, initial_value=2**16, namespace=None)
-        if writers < 2**16:
+        writers = getLockBackend().incr(lockKey, initialValue=constants.WRITE_LOCK_OFFSET)
+        if writers < constants.WRITE_LOCK_OFFSET:
             self.context.logger.error("Gave up waiting for write lock '%s'.", lockKey)
             acquired = False
             if raiseOnFail:
@@ -104,48 +240,81 @@ class ReadWriteLock:
         released = True
 
         lockKey = self.lockKey(index)
-        memcache.decr(lockKey, namespace=None)
+        getLockBackend().decr(lockKey)
 
         return released
 
-    def acquireReadLock(self, index, nextEvent=None, raiseOnFail=False):
-        """ Acquires the read lock
+    def releaseWriteLockAsync(self, index):
+        """ Releases the write lock, without waiting for the lock backend
 
         @param index: an int, the current index
+        @return: an RPC; call .get_result() on it before the request ends
         """
-        acquired = True
+        return getLockBackend().decrAsync(self.lockKey(index))
 
-        lockKey = self.lockKey(index)
-        indexKey = self.indexKey()
+    def closeWriteLock(self, index):
+        """ Stops new writers from using the index. The first step of acquiring the read lock.
+
+        @param index: an int, the current index
+        """
+        backend = getLockBackend()
 
         # tell writers to use another index
-        memcache.incr(indexKey, namespace=None)
+        backend.incr(self.indexKey())
 
         # tell writers they missed the boat
-        memcache.decr(lockKey, 2**15, namespace=None)
+        backend.decr(self.lockKey(index), constants.READ_LOCK_OFFSET)
+
+    def writersDone(self, index):
+        """ Checks, without waiting, whether the writers that got in before .closeWriteLock() are all done
+
+        @param index: an int, the current index
+        @return: True if the read lock can be acquired
+        """
+        counter = getLockBackend().get(self.lockKey(index))
+        # counter is None --> ejected from memcache, or no writers
+        # int(counter) <= READ_LOCK_OFFSET --> writers have all called .releaseWriteLock()
+        return counter is None or int(counter) <= constants.READ_LOCK_OFFSET
+
+    def giveUpReadLock(self, index, nextEvent=None, raiseOnFail=False):
+        """ Gives up on waiting for the writers
+
+        @param index: an int, the current index
+        @return: False, the read lock was not acquired
+        """
+        # FIXME: is there anything else that can be done? will work packages be lost? maybe queue another task
+        #        to sweep up later?
+        self.context.logger.critical("Gave up waiting for all fan-in work items with read lock '%s'.",
+                                     self.lockKey(index))
+        if raiseOnFail:
+            raise FanInReadLockFailureRuntimeError(nextEvent,
+                                                   self.context.machineName,
+                                                   self.context.currentState.name,
+                                                   self.context.instanceName)
+        return False
+
+    def acquireReadLock(self, index, nextEvent=None, raiseOnFail=False):
+        """ Acquires the read lock, busy-waiting for the writers
+
+        @param index: an int, the current index
+        """
+        self.closeWriteLock(index)
 
         # busy wait for writers
         for i in range(ReadWriteLock.BUSY_WAIT_ITERS):
-            counter = memcache.get(lockKey, namespace=None)
-            # counter is None --> ejected from memcache, or no writers
-            # int(counter) <= 2**15 --> writers have all called memcache.decr
-            if counter is None or int(counter) <= 2**15:
+            if self.writersDone(index):
                 break
             time.sleep(ReadWriteLock.BUSY_WAIT_ITER_SECS)
-            self.context.logger.debug("Tried to acquire read lock '%s' %d times...", lockKey, i + 1)
+            self.context.logger.debug("Tried to acquire read lock '%s' %d times...", self.lockKey(index), i + 1)
 
-        # FIXME: is there anything else that can be done? will work packages be lost? maybe queue another task
-        #        to sweep up later?
         if i >= (ReadWriteLock.BUSY_WAIT_ITERS - 1): # pylint: disable=W0631
-            self.context.logger.critical("Gave up waiting for all fan-in work items with read lock '%s'.", lockKey)
-            acquired = False
-            if raiseOnFail:
-                raise FanInReadLockFailureRuntimeError(nextEvent,
-                                                       self.context.machineName,
-                                                       self.context.currentState.name,
-                                                       self.context.instanceName)
+            return self.giveUpReadLock(index, nextEvent=nextEvent, raiseOnFail=raiseOnFail)
 
-        return acquired
+        return True
+
+# the semaphore keys added by RunOnceSemaphore.addRunOnceSemaphores() in this process, most recent last
+_recentSemaphoreKeys = collections.OrderedDict()
+_recentSemaphoreKeysLock = threading.Lock()
 
 class RunOnceSemaphore:
     """ A object used to enforce run-once semantics """
@@ -204,17 +373,97 @@ class RunOnceSemaphore:
         else:
             return txn()
 
-    def readRunOnceSemaphore(self, payload=None, transactional=True):
-        """ Reads the semaphore
+    def addRunOnceSemaphore(self, payload=None):
+        """ Writes the semaphore, with the 'fast' run_once_semaphore_mode; see addRunOnceSemaphores()
 
-        @return: True if the semaphore exists
+        @return: True if the semaphore was created and work can continue
+        """
+        return not self.addRunOnceSemaphores([self.semaphoreKey], payload=payload, logger=self.logger)
+
+    @classmethod
+    def addRunOnceSemaphores(cls, semaphoreKeys, payload=None, logger=None):
+        """ Writes a batch of semaphores, with the 'fast' run_once_semaphore_mode: the semaphores added recently by
+        this process are found without an RPC, and the rest are added with a single memcache.add_multi(). Only the
+        semaphores memcache fails to add, and does not have either, are written to the datastore (with a
+        transaction each, as in writeRunOnceSemaphore()).
+
+        @param semaphoreKeys: a list of semaphore keys
+        @param payload: the payload of the semaphores
+        @param logger: a logging module or object
+        @return: a set of the semaphoreKeys that were already written, i.e., whose work must not be done again
+        """
+        assert payload
+        logger = logger or logging
+        with _recentSemaphoreKeysLock:
+            existing = set(key for key in semaphoreKeys if key in _recentSemaphoreKeys)
+        Metrics.incr(constants.RUN_ONCE_SEMAPHORE_METRIC + '.lruHits', len(existing))
+
+        keys = [key for key in semaphoreKeys if key not in existing]
+        notAdded = memcache.add_multi(dict((key, payload) for key in keys), namespace=None) if keys else []
+        if notAdded:
+            cached = memcache.get_multi(notAdded, namespace=None)
+            existing.update(cached)
+            for key in notAdded:
+                if key not in cached:
+                    # memcache is unavailable, or evicted the key in between; the datastore has the final word
+                    Metrics.incr(constants.RUN_ONCE_SEMAPHORE_METRIC + '.datastoreFallbacks')
+                    if not cls(key, None).writeRunOnceSemaphore(payload=payload)[0]:
+                        existing.add(key)
+
+        with _recentSemaphoreKeysLock:
+            for key in semaphoreKeys:
+                _recentSemaphoreKeys[key] = True
+                _recentSemaphoreKeys.move_to_end(key)
+            while len(_recentSemaphoreKeys) > constants.RUN_ONCE_SEMAPHORE_LRU_SIZE:
+                _recentSemaphoreKeys.popitem(last=False)
+
+        for key in existing:
+            logger.debug('Run-once semaphore already written. Semaphore key: "%s".', key)
+        return existing
+
+    def writeRunOnceSemaphoreWithEntities(self, buildEntities, payload=None):
+        """ Writes the semaphore like writeRunOnceSemaphore(), and the entities that depend on its payload in the
+        same (cross-group) transaction and datastore put, so that every writer agrees on the payload.
+
+        @param buildEntities: a function of the payload of the semaphore (the given one, or the one written
+                              before) that returns the list of entities to put
+        @return: a tuple of (bool, obj) as writeRunOnceSemaphore()
         """
         assert payload
 
+        # check memcache; the entities of an existing semaphore are written again, as on retry
+        cached = memcache.get(self.semaphoreKey, namespace=None)
+        if cached:
+            db.put(buildEntities(cached))
+            return (False, cached)
+
+        # check datastore
+        def txn():
+            """ lock in transaction to avoid races between Tasks """
+            key = db.Key.from_path(_FantasmTaskSemaphore.kind(), self.semaphoreKey, namespace='')
+            entity = db.get(key)
+            if not entity:
+                db.put([_FantasmTaskSemaphore(key=key, payload=payload)] + buildEntities(payload))
+                return (True, payload)
+            db.put(buildEntities(entity.payload))
+            return (False, entity.payload)
+
+        created, written = db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+        if created:
+            self.logger.debug('Setting run-once semaphore. Semaphore key: "%s", payload: "%s".', self.semaphoreKey, written)
+        memcache.set(self.semaphoreKey, written, namespace=None)
+        return (created, written)
+
+    def readRunOnceSemaphore(self, payload=None, transactional=True):
+        """ Reads the semaphore
+
+        @param payload: the expected payload, a different one is logged; None reads the payload, whatever it is
+        @return: the payload if the semaphore exists, else None
+        """
         # check memcache
         cached = memcache.get(self.semaphoreKey, namespace=None)
         if cached:
-            if cached != payload:
+            if payload is not None and cached != payload:
                 self.logger.critical("Run-once semaphore memcache payload read error. Semaphore key: '%s', actual payload: '%s', expected payload: '%s'.", self.semaphoreKey, cached, payload)
             return cached
 
@@ -224,7 +473,7 @@ class RunOnceSemaphore:
             key = db.Key.from_path(_FantasmTaskSemaphore.kind(), self.semaphoreKey, namespace='')
             entity = db.get(key)
             if entity:
-                if entity.payload != payload:
+                if payload is not None and entity.payload != payload:
                     self.logger.critical("Run-once semaphore datastore payload read error. Semaphore key: '%s', actual payload: '%s', expected payload: '%s'.", self.semaphoreKey, entity.payload, payload)
                 return entity.payload
 
@@ -234,3 +483,88 @@ class RunOnceSemaphore:
         else:
             return txn()
 
+class FanInCleanupBucket:
+    """ Collects the workIndexes of the fan-ins of a state over one fan_in_cleanup_period, so that a single
+    cleanup Task deletes the work packages of all of them. The workIndexes are kept in the LockBackend; the
+    work packages of an evicted workIndex are left to the scrubber. """
+
+    def __init__(self, key):
+        """ Constructor
+
+        @param key: the LockBackend key of the bucket, also used as the name of its cleanup Task
+        """
+        self.key = key
+
+    @classmethod
+    def forPeriod(cls, machineName, stateName, period, now):
+        """ Returns the FanInCleanupBucket of the period that now falls in
+
+        @param machineName: the name of the machine
+        @param stateName: the name of the fan-in state
+        @param period: the fan_in_cleanup_period, in seconds
+        @param now: a time.time() value
+        """
+        return cls('fantasm-cleanup-%s-%s-%d' % (machineName, stateName, int(now // period)))
+
+    def add(self, workIndex):
+        """ Adds a workIndex to the bucket
+
+        @param workIndex: the workIndex of a processed fan-in
+        @return: the 1-based slot of the workIndex in the bucket, or None if the LockBackend is unavailable
+        """
+        backend = getLockBackend()
+        slot = backend.incr(self.key + '-count', initialValue=0)
+        if slot is not None:
+            backend.add('%s-%d' % (self.key, slot), workIndex)
+        return slot
+
+    def workIndexes(self):
+        """ Returns the workIndexes added to the bucket, in slot order """
+        backend = getLockBackend()
+        count = backend.get(self.key + '-count') or 0
+        keys = ['%s-%d' % (self.key, slot) for slot in range(1, count + 1)]
+        values = backend.getMulti(keys)
+        return [values[key] for key in keys if values.get(key)]
+
+class FanInArrivals:
+    """ Tracks the work packages written to a workIndex in the LockBackend: their number, in a counter sharded
+    over FAN_IN_ARRIVAL_COUNTER_SHARDS keys so that the writers do not all increment the same key, and the span
+    between the first and the latest of them. Used by fan_in_expected and fan_in_adaptive. """
+
+    def __init__(self, workIndex):
+        """ Constructor
+
+        @param workIndex: the workIndex of a fan-in
+        """
+        self.workIndex = workIndex
+        self.shardKeys = ['%s-arrived-%d' % (workIndex, shard)
+                          for shard in range(constants.FAN_IN_ARRIVAL_COUNTER_SHARDS)]
+
+    def arrive(self):
+        """ Counts a work package """
+        getLockBackend().incr(random.choice(self.shardKeys), initialValue=0)
+
+    def count(self):
+        """ Returns the number of work packages counted so far """
+        return sum(getLockBackend().getMulti(self.shardKeys).values())
+
+    def recordSpan(self, now):
+        """ Records the arrival time of a work package
+
+        @param now: a time.time() value
+        """
+        backend = getLockBackend()
+        firstKey = self.workIndex + '-first-arrival'
+        backend.add(firstKey, int(now))
+        first = backend.get(firstKey)
+        if first is None:
+            return
+        span = int(now) - first
+        current = backend.get(self.workIndex + '-span')
+        if current is None or span > current:
+            # not atomic, but concurrent writers can only make the span a bit too long
+            backend.incr(self.workIndex + '-span', span - (current or 0), initialValue=0)
+
+    def span(self):
+        """ Returns the seconds between the first and the latest work package, or None if not recorded """
+        return getLockBackend().get(self.workIndex + '-span')
@@ -17,12 +17,21 @@ Copyright 2010 VendAsta Technologies Inc.
    limitations under the License.
 """
 
+import base64
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
+import pickle
+import time
+import zlib
 
 from google.appengine.api import datastore_types
 from google.appengine.ext import db, ndb
 
+from fantasm import constants, utils
+
 
 def decode(dct):
     """ Special handler for db.Key/ndb.Key/datetime.datetime decoding """
@@ -38,6 +47,8 @@ def decode(dct):
         return ndb.Key(urlsafe=dct['key']) # turns into an ndb.Key across serialization
     if '__datetime.datetime__' in dct:
         return datetime.datetime(**dct['datetime'])
+    if '__ContextBlobReference__' in dct:
+        return ContextBlobReference(dct['key'], storedAt=dct.get('storedAt'))
     return dct
 
 
@@ -49,14 +60,17 @@ class Encoder(json.JSONEncoder): # pylint: disable=W0232
         """ see json.JSONEncoder.default """
         if isinstance(obj, set):
             return {'__set__': True, 'key': list(obj)}
+        if isinstance(obj, ContextBlobReference):
+            return {'__ContextBlobReference__': True, 'key': obj.digest, 'storedAt': obj.storedAt}
         if isinstance(obj, db.Key):
             return {'__db.Key__': True, 'key': str(obj)}
         if isinstance(obj, db.Model):
             return {'__db.Model__': True, 'key': str(obj.key())} # turns into a db.Key across serialization
         if isinstance(obj, ndb.Key):
-            return {'__ndb.Key__': True, 'key': str(obj.urlsafe())}
+            return {'__ndb.Key__': True, 'key': obj.urlsafe().decode()}
         if isinstance(obj, ndb.Model):
-            return {'__ndb.Model__': True, 'key': str(obj.key.urlsafe())}  # turns into a ndb.Key across serialization
+            # turns into a ndb.Key across serialization
+            return {'__ndb.Model__': True, 'key': obj.key.urlsafe().decode()}
         if isinstance(obj, ndb.model._BaseValue):
             return obj.b_val
         if isinstance(obj, datetime.datetime) and \
@@ -73,13 +87,27 @@ class Encoder(json.JSONEncoder): # pylint: disable=W0232
 class JSONProperty(db.Property):
     """
     From Google appengine cookbook... a Property for storing dicts in the datastore
+
+    Values whose JSON is longer than compressionThreshold characters are stored zlib-compressed (and base64-encoded,
+    behind constants.COMPRESSED_JSON_PREFIX). A model instance may override the property's compressionThreshold
+    with a compressionThreshold attribute of its own.
     """
     data_type = datastore_types.Text
 
+    def __init__(self, *args, compressionThreshold=None, **kwargs):
+        """
+        @param compressionThreshold: compress values whose JSON is longer than this; None never compresses
+        """
+        super().__init__(*args, **kwargs)
+        self.compressionThreshold = compressionThreshold
+
     def get_value_for_datastore(self, modelInstance):
         """ see Property.get_value_for_datastore """
         value = super().get_value_for_datastore(modelInstance)
-        return db.Text(self._deflate(value))
+        compressionThreshold = getattr(modelInstance, 'compressionThreshold', None)
+        if compressionThreshold is None:
+            compressionThreshold = self.compressionThreshold
+        return db.Text(self._deflate(value, compressionThreshold=compressionThreshold))
 
     def validate(self, value):
         """ see Property.validate """
@@ -93,23 +121,126 @@ class JSONProperty(db.Property):
         """ decodes string -> dict """
         if value is None:
             return {}
-        if isinstance(value, str) or isinstance(value, str):
+        if isinstance(value, str):
+            if value.startswith(constants.COMPRESSED_JSON_PREFIX):
+                value = value[len(constants.COMPRESSED_JSON_PREFIX):]
+                value = zlib.decompress(base64.b64decode(value)).decode('utf-8')
             return json.loads(value, object_hook=decode)
         return value
 
-    def _deflate(self, value):
+    def _deflate(self, value, compressionThreshold=None):
         """ encodes dict -> string """
-        return json.dumps(value, cls=Encoder)
+        value = json.dumps(value, cls=Encoder)
+        if compressionThreshold is not None and len(value) > compressionThreshold:
+            compressed = utils.compress(value.encode('utf-8'), constants.COMPRESSION_METRIC_JSON_PROPERTY)
+            value = constants.COMPRESSED_JSON_PREFIX + base64.b64encode(compressed).decode()
+        return value
 
 
 class _FantasmFanIn( db.Model ):
-    """ A model used to store FSMContexts for fan in """
+    """ A model used to store FSMContexts for fan in
+
+    Work packages are stored under one of fan_in_entity_groups parent keys per workIndex (see buildKey()),
+    so that the fan-in can read them with strongly consistent ancestor queries (see fetchWorkIndex()). The
+    parent entities are never written. The datastore sustains about one write per second per entity group,
+    so the work packages of one workIndex can be written at about fan_in_entity_groups per second; writes
+    beyond that are retried as datastore contention errors. Raise fan_in_entity_groups, or use a shorter
+    fan_in period, fan_in_shards or a fan_in_combiner to spread (or cut down) the writes of a busy fan-in.
+    """
     workIndex = db.StringProperty()
     context = JSONProperty(indexed=False)
+    compressionThreshold = None # not stored; set from the machine's compression_threshold before put()
     # FIXME: createdTime only needed for scrubbing, but indexing might be a performance hit
     #        http://ikaisays.com/2011/01/25/app-engine-datastore-tip-monotonically-increasing-values-are-bad/
     createdTime = db.DateTimeProperty(auto_now_add=True)
 
+    @staticmethod
+    def parentKeys(workIndex, entityGroups=constants.DEFAULT_FAN_IN_ENTITY_GROUPS):
+        """ Returns the parent keys of the work packages of a workIndex
+
+        @param workIndex: the workIndex
+        @param entityGroups: the fan_in_entity_groups of the fan-in state
+        @return: a list of db.Keys, one per entity group
+        """
+        return [db.Key.from_path(constants.FAN_IN_ENTITY_GROUP_KIND, '%s-%d' % (workIndex, group), namespace='')
+                for group in range(entityGroups)]
+
+    @classmethod
+    def buildKey(cls, workIndex, keyName, entityGroups=constants.DEFAULT_FAN_IN_ENTITY_GROUPS):
+        """ Returns the key of a work package; keyName picks the entity group, so writes are spread out.
+
+        @param workIndex: the workIndex
+        @param keyName: the key name of the work package (unique within the workIndex)
+        @param entityGroups: the fan_in_entity_groups of the fan-in state
+        @return: a db.Key
+        """
+        group = zlib.crc32(keyName.encode('utf-8')) % entityGroups if keyName else 0
+        return db.Key.from_path(cls.kind(), keyName, parent=cls.parentKeys(workIndex, entityGroups)[group],
+                                namespace='')
+
+    @classmethod
+    def fetchWorkIndex(cls, workIndex, keysOnly=False, startAfter=None,
+                       entityGroups=constants.DEFAULT_FAN_IN_ENTITY_GROUPS):
+        """ Yields the work packages of a workIndex, in key name order, using strongly consistent queries.
+
+        With constants.FAN_IN_READ_ROOT_WORK_PACKAGES, the work packages written without a parent key (by
+        versions before 2.1.0) are read too, with an (eventually consistent) query on workIndex.
+
+        @param workIndex: the workIndex
+        @param keysOnly: yield db.Keys instead of _FantasmFanIn instances
+        @param startAfter: only yield the work packages with key names after this one
+        @param entityGroups: the fan_in_entity_groups of the fan-in state
+        @return: a generator of _FantasmFanIn instances (or db.Keys)
+        """
+        def getKey(entity):
+            """ the db.Key of a query result """
+            return entity if keysOnly else entity.key()
+        def sortKey(entity):
+            """ key name order, across the entity groups """
+            key = getKey(entity)
+            return (key.name() or '', key.id() or 0)
+        queries = []
+        for parent in cls.parentKeys(workIndex, entityGroups):
+            query = cls.all(namespace='', keys_only=keysOnly).ancestor(parent)
+            if startAfter:
+                query.filter('__key__ >', db.Key.from_path(cls.kind(), startAfter, parent=parent, namespace=''))
+            queries.append(query.order('__key__'))
+        results = [query.run(batch_size=constants.FAN_IN_QUERY_BATCH_SIZE) for query in queries]
+        if constants.FAN_IN_READ_ROOT_WORK_PACKAGES:
+            query = cls.all(namespace='', keys_only=keysOnly).filter('workIndex =', workIndex)
+            if startAfter:
+                query.filter('__key__ >', db.Key.from_path(cls.kind(), startAfter, namespace=''))
+            roots = query.order('__key__').run(batch_size=constants.FAN_IN_QUERY_BATCH_SIZE)
+            results.append(entity for entity in roots if getKey(entity).parent() is None)
+        return heapq.merge(*results, key=sortKey)
+
+    @classmethod
+    def deleteWorkIndexes(cls, workIndexes, batchSize, maxBatches,
+                          entityGroups=constants.DEFAULT_FAN_IN_ENTITY_GROUPS):
+        """ Deletes the work packages of some workIndexes, with keys-only queries and batched async deletes.
+
+        @param workIndexes: a list of workIndexes
+        @param batchSize: the number of work packages per db.delete_async()
+        @param maxBatches: the maximum number of db.delete_async() calls
+        @param entityGroups: the fan_in_entity_groups of the fan-in state
+        @return: the workIndexes that still have work packages, from the one the batches ran out on
+        """
+        rpcs = []
+        try:
+            for i, workIndex in enumerate(workIndexes):
+                keys = cls.fetchWorkIndex(workIndex, keysOnly=True, entityGroups=entityGroups)
+                while True:
+                    batch = list(itertools.islice(keys, batchSize))
+                    if not batch:
+                        break
+                    if len(rpcs) >= maxBatches:
+                        return workIndexes[i:]
+                    rpcs.append(db.delete_async(batch))
+            return []
+        finally:
+            for rpc in rpcs:
+                rpc.get_result()
+
 class _FantasmInstance( db.Model ):
     """ A model used to to store FSMContext instances """
     instanceName = db.StringProperty()
@@ -117,6 +248,14 @@ class _FantasmInstance( db.Model ):
     #        http://ikaisays.com/2011/01/25/app-engine-datastore-tip-monotonically-increasing-values-are-bad/
     createdTime = db.DateTimeProperty(auto_now_add=True)
 
+    @classmethod
+    def build(cls, instanceName):
+        """ Returns an unsaved _FantasmInstance for a machine instance
+
+        @param instanceName: the instance name of the machine
+        """
+        return cls(key=db.Key.from_path(cls.kind(), instanceName, namespace=''), instanceName=instanceName)
+
 class _FantasmLog( db.Model ):
     """ A model used to store log messages """
     taskName = db.StringProperty()
@@ -137,3 +276,184 @@ class _FantasmTaskSemaphore( db.Model ):
     #        http://ikaisays.com/2011/01/25/app-engine-datastore-tip-monotonically-increasing-values-are-bad/
     createdTime = db.DateTimeProperty(auto_now_add=True)
     payload = db.StringProperty(indexed=False)
+
+class _FantasmContextBlob( db.Model ):
+    """ A model used to store a large FSMContext value once, keyed by the sha1 of its pickle; see offload_threshold """
+    value = db.BlobProperty()
+    # indexed, since the scrubber (scrubber.DeleteOldEntities) queries createdTime < before; the digest key names
+    # are random, and a blob is written once per value (and a day), so the index takes few monotonic writes
+    createdTime = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def read(cls, keyName):
+        """ Returns the bytes of the _FantasmContextBlob keyName, or None if it does not exist. """
+        blob = db.get(db.Key.from_path(cls.kind(), keyName, namespace=''))
+        return None if blob is None else bytes(blob.value)
+
+    @classmethod
+    @db.non_transactional
+    def writeOnce(cls, keyName, data):
+        """ Writes data to the _FantasmContextBlob keyName, unless it already exists, in a transaction.
+
+        @param keyName: the key name of the _FantasmContextBlob
+        @param data: the bytes to write
+        @return: the bytes of the _FantasmContextBlob, i.e., data or the bytes written first
+        """
+        key = db.Key.from_path(cls.kind(), keyName, namespace='')
+        def txn():
+            """ lock in transaction to avoid races between Tasks """
+            blob = db.get(key)
+            if blob is None:
+                blob = cls(key=key, value=db.Blob(data))
+                blob.put()
+            return bytes(blob.value)
+        return db.run_in_transaction(txn)
+
+class ContextBlobReference:
+    """ Stands in for an FSMContext value that was offloaded to a _FantasmContextBlob. FSMContext resolves it
+    the first time the value is read, and passes it along unresolved if it is never read.
+    """
+
+    def __init__(self, digest, value=None, storedAt=None):
+        """
+        @param digest: the key name of the _FantasmContextBlob
+        @param value: the value, if it is already known
+        @param storedAt: the time.time() the createdTime of the _FantasmContextBlob was last set, if known
+        """
+        self.digest = digest
+        self._value = value
+        self.storedAt = storedAt
+
+    @classmethod
+    def store(cls, data, value=None, written=None):
+        """ Writes a pickled value to a _FantasmContextBlob, unless it is already in written.
+
+        @param data: the pickled value
+        @param value: the value itself
+        @param written: a set of digests already written (e.g., during the current request); updated
+        @return: a ContextBlobReference to the stored value
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        if written is None or digest not in written:
+            # always put, even if another machine stored the same value: this resets createdTime, so the
+            # scrubber does not delete a blob that is still in use
+            _FantasmContextBlob(key=db.Key.from_path(_FantasmContextBlob.kind(), digest, namespace=''),
+                                value=db.Blob(data)).put()
+            if written is not None:
+                written.add(digest)
+        return cls(digest, value=value, storedAt=time.time())
+
+    @classmethod
+    @db.non_transactional
+    def storeMulti(cls, datas):
+        """ Writes a number of pickled values to _FantasmContextBlobs, concurrently. The writes are never part
+        of the caller's transaction; unused _FantasmContextBlobs are removed by the scrubber.
+
+        @param datas: a list of pickled values
+        @return: a list of ContextBlobReferences to the stored values
+        """
+        references, rpcs = [], []
+        for data in datas:
+            digest = hashlib.sha1(data).hexdigest()
+            rpcs.append(db.put_async(_FantasmContextBlob(key=db.Key.from_path(_FantasmContextBlob.kind(), digest,
+                                                                               namespace=''),
+                                                         value=db.Blob(data))))
+            references.append(cls(digest, storedAt=time.time()))
+        for rpc in rpcs:
+            rpc.get_result()
+        return references
+
+    def resolve(self):
+        """ Returns the value, reading it from the datastore on the first call. """
+        if self._value is None:
+            blob = db.get(db.Key.from_path(_FantasmContextBlob.kind(), self.digest, namespace=''))
+            if blob is None:
+                raise KeyError('_FantasmContextBlob "%s" was not found.' % self.digest)
+            self._value = pickle.loads(blob.value)
+        return self._value
+
+    @db.non_transactional
+    def refresh(self):
+        """ Resets the createdTime of the _FantasmContextBlob, so the scrubber keeps it while it is passed along. """
+        blob = db.get(db.Key.from_path(_FantasmContextBlob.kind(), self.digest, namespace=''))
+        if blob is None:
+            raise KeyError('_FantasmContextBlob "%s" was not found.' % self.digest)
+        blob.createdTime = datetime.datetime.utcnow()
+        blob.put()
+        self.storedAt = time.time()
+
+    def __getstate__(self):
+        """ Only the digest travels (e.g., when an FSMContext is cloned or pickled). """
+        return {'digest': self.digest, '_value': None, 'storedAt': self.storedAt}
+
+    def __eq__(self, other):
+        return isinstance(other, ContextBlobReference) and self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return 'ContextBlobReference(%r)' % self.digest
+
+class StoredList:
+    """ A list written once to _FantasmContextBlobs, a zlib-compressed pickle per chunk of items, so that a reader
+    only reads the chunks of the items it needs; see StoredListContinuationFSMAction.
+    """
+
+    def __init__(self, digest, length, chunkSize):
+        """
+        @param digest: the sha1 of the chunks; the key names of the chunks are '<digest>-<chunk number>'
+        @param length: the number of items in the list
+        @param chunkSize: the number of items per chunk
+        """
+        self.digest = digest
+        self.length = length
+        self.chunkSize = chunkSize
+
+    @classmethod
+    @db.non_transactional
+    def store(cls, items, chunkSize):
+        """ Writes a list to _FantasmContextBlobs, concurrently. Storing the same list again writes the same
+        entities; unused _FantasmContextBlobs are removed by the scrubber.
+
+        @param items: the list
+        @param chunkSize: the number of items per chunk
+        @return: a StoredList
+        """
+        datas = [utils.compress(pickle.dumps(items[i : i + chunkSize]), constants.COMPRESSION_METRIC_STORED_LIST)
+                 for i in range(0, len(items), chunkSize)]
+        sha1 = hashlib.sha1(str(chunkSize).encode('utf-8'))
+        for data in datas:
+            sha1.update(data)
+        storedList = cls(sha1.hexdigest(), len(items), chunkSize)
+
+        entities = [_FantasmContextBlob(key=storedList._chunkKey(chunk), value=db.Blob(data))
+                    for (chunk, data) in enumerate(datas)]
+        rpcs = [db.put_async(entities[i : i + constants.STORED_LIST_PUT_BATCH_SIZE])
+                for i in range(0, len(entities), constants.STORED_LIST_PUT_BATCH_SIZE)]
+        for rpc in rpcs:
+            rpc.get_result()
+        return storedList
+
+    def slice(self, start, stop):
+        """ Returns items[start:stop], reading only the chunks that hold them.
+
+        @param start: the index of the first item
+        @param stop: the index after the last item
+        """
+        stop = min(stop, self.length)
+        if start >= stop:
+            return []
+        first, last = start // self.chunkSize, (stop - 1) // self.chunkSize
+        blobs = db.get([self._chunkKey(chunk) for chunk in range(first, last + 1)])
+        items = []
+        for chunk, blob in enumerate(blobs, first):
+            if blob is None:
+                raise KeyError('_FantasmContextBlob "%s" was not found.' % self._chunkKey(chunk).name())
+            items.extend(pickle.loads(zlib.decompress(blob.value)))
+        offset = first * self.chunkSize
+        return items[start - offset : stop - offset]
+
+    def _chunkKey(self, chunk):
+        """ Returns the key of a chunk. """
+        return db.Key.from_path(_FantasmContextBlob.kind(), '%s-%d' % (self.digest, chunk), namespace='')
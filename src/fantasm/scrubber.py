@@ -22,7 +22,8 @@ from google.appengine.ext import db
 from fantasm.action import DatastoreContinuationFSMAction
 # W0611: 23: Unused import _FantasmLog
 # we're importing these here so that db has a chance to see them before we query them
-from fantasm.models import _FantasmInstance, _FantasmLog, _FantasmTaskSemaphore # pylint: disable=W0611
+from fantasm.models import _FantasmInstance, _FantasmLog, _FantasmTaskSemaphore, \
+                           _FantasmContextBlob # pylint: disable=W0611
 from fantasm.constants import CONTINUATION_RESULTS_KEY
 
 # W0613: Unused argument 'obj'
@@ -44,7 +45,8 @@ class EnumerateFantasmModels:
         ('_FantasmInstance', 'createdTime'),
         ('_FantasmLog', 'time'),
         ('_FantasmTaskSemaphore', 'createdTime'),
-        ('_FantasmFanIn', 'createdTime')
+        ('_FantasmFanIn', 'createdTime'),
+        ('_FantasmContextBlob', 'createdTime')
     )
 
     def continuation(self, context, obj, token=None):
@@ -16,21 +16,48 @@ Copyright 2010 VendAsta Technologies Inc.
    See the License for the specific language governing permissions and
    limitations under the License.
 """
-from google.appengine.api.taskqueue.taskqueue import Task, TaskAlreadyExistsError, TombstonedTaskError
+import collections
 
 from fantasm import constants
 from fantasm.transition import Transition
 from fantasm.exceptions import UnknownEventError, InvalidEventNameRuntimeError, FanInNoContextsAvailableRuntimeError, \
                                TRANSIENT_ERRORS, HaltMachineError
-from fantasm.utils import knuthHash
 from fantasm.lock import RunOnceSemaphore
 
+# The per-(state, event) parts of a dispatch that do not depend on the FSMContext instance; built once when the
+# Transition is added to the State, so that the per-hop code only needs to fill in the instance-specific parts.
+# The queue name, task target, retry options and countdown are read from .transition, which is itself a
+# precompiled singleton.
+DispatchPlan = collections.namedtuple('DispatchPlan', ['transition', 'path', 'taskNameSuffix', 'randomCountdown',
+                                                       'isFanIn', 'fanInPeriod', 'fanInGroup'])
+
+def buildDispatchPlan(state, transition, event):
+    """ Builds the DispatchPlan for dispatching event from state.
+
+    @param state: the State being dispatched from
+    @param transition: the Transition bound to event
+    @param event: a string event
+    @return: a DispatchPlan instance
+    """
+    target = transition.target
+    return DispatchPlan(transition=transition,
+                        path='{}/{}/{}/'.format(state.name, event, target.name),
+                        taskNameSuffix='--'.join([state.name, event, target.name]),
+                        randomCountdown=isinstance(transition.countdown, tuple),
+                        isFanIn=target.isFanIn,
+                        fanInPeriod=target.fanInPeriod,
+                        fanInGroup=target.fanInGroup)
+
 class State:
     """ A state object for a machine. """
 
     def __init__(self, name, entryAction, doAction, exitAction, machineName=None,
                  isFinalState=False, isInitialState=False, isContinuation=False, fanInPeriod=constants.NO_FAN_IN,
-                 fanInGroup=None, continuationCountdown=0):
+                 fanInGroup=None, continuationCountdown=0, fanInMaxContexts=None, fanInCombiner=None,
+                 fanInReadLockCountdown=None, fanInShards=None, fanInCleanupPeriod=None, fanInExpected=None,
+                 fanInAdaptive=False, continuationBatches=constants.DEFAULT_CONTINUATION_BATCHES,
+                 continuationSeconds=constants.DEFAULT_CONTINUATION_SECONDS,
+                 fanInEntityGroups=constants.DEFAULT_FAN_IN_ENTITY_GROUPS):
         """
         @param name: the name of the State instance
         @param entryAction: an FSMAction instance
@@ -43,6 +70,24 @@ class State:
         @param fanInPeriod: integer (seconds) representing how long these states should collect before dispatching
         @param fanInGroup: name of value in context to use for grouping fan-in tasks.
         @param continuationCountdown: the number of seconds to countdown when executing a continuation task
+        @param fanInMaxContexts: the maximum number of contexts to fan in per Task; the rest are handed to
+                                 follow-up Tasks over the same work index
+        @param fanInCombiner: an FSMFanInCombiner instance that merges forked contexts before they are written
+                              down as work packages
+        @param fanInReadLockCountdown: the number of seconds after which a fan-in Task whose writers are still
+                                       in flight re-queues itself, instead of busy-waiting for them
+        @param fanInShards: the number of independent fan-ins (each with its own lock, work index and Task) to
+                            spread the fanned-in contexts over
+        @param fanInCleanupPeriod: the number of seconds over which the work indexes of the processed fan-ins are
+                                   collected into one cleanup Task
+        @param fanInExpected: the number of work packages (or the context key with the number of work packages)
+                              after which the fan-in Task fires, without waiting for the fan_in period
+        @param fanInAdaptive: if True, the fan_in period is the upper bound of a period that follows the arrival
+                              span of the previous fan-ins
+        @param continuationBatches: the number of continuation batches to process in one Task, one after the other
+        @param continuationSeconds: the number of seconds after which a Task with continuationBatches stops taking
+                                    on more batches, and queues the next continuation Task
+        @param fanInEntityGroups: the number of entity groups the work packages of a work index are spread over
         """
         assert not (exitAction and isContinuation) # TODO: revisit this with jcollins, we want to get it right
         assert not (exitAction and fanInPeriod > constants.NO_FAN_IN) # TODO: revisit this with jcollins
@@ -59,7 +104,18 @@ class State:
         self.isFanIn = fanInPeriod != constants.NO_FAN_IN
         self.fanInPeriod = fanInPeriod
         self.fanInGroup = fanInGroup
+        self.fanInMaxContexts = fanInMaxContexts
+        self.fanInCombiner = fanInCombiner
+        self.fanInReadLockCountdown = fanInReadLockCountdown
+        self.fanInShards = fanInShards
+        self.fanInCleanupPeriod = fanInCleanupPeriod
+        self.fanInExpected = fanInExpected
+        self.fanInAdaptive = fanInAdaptive
+        self.continuationBatches = continuationBatches
+        self.continuationSeconds = continuationSeconds
+        self.fanInEntityGroups = fanInEntityGroups
         self._eventToTransition = {}
+        self._eventToDispatchPlan = {}
 
     def addTransition(self, transition, event):
         """ Adds a transition for an event.
@@ -74,6 +130,7 @@ class State:
         assert not (self.exitAction and transition.target.isFanIn) # TODO: revisit
 
         self._eventToTransition[event] = transition
+        self._eventToDispatchPlan[event] = buildDispatchPlan(self, transition, event)
 
     def getTransition(self, event):
         """ Gets the Transition for a given event.
@@ -90,6 +147,18 @@ class State:
                              event, self.machineName, self.name)
             raise UnknownEventError(event, self.machineName, self.name)
 
+    def getDispatchPlan(self, event):
+        """ Gets the DispatchPlan for a given event.
+
+        @param event: a string event
+        @return: a DispatchPlan instance associated with the event
+        @raise an UnknownEventError if event is unknown (i.e., no transition is bound to it).
+        """
+        plan = self._eventToDispatchPlan.get(event)
+        if plan is None:
+            self.getTransition(event) # raises UnknownEventError
+        return plan
+
     def dispatch(self, context, event, obj):
         """ Fires the transition and executes the next States's entry, do and exit actions.
 
@@ -117,9 +186,10 @@ class State:
         # join the contexts of a fan-in
         contextOrContexts = context
         if transition.target.isFanIn:
-            taskNameBase = context.getTaskName(event, fanIn=True)
             contextOrContexts = context.mergeJoinDispatch(event, obj)
             obj[constants.FANNED_IN_CONTEXT] = context
+            if obj.get(constants.TERMINATED_PARAM):
+                return None # the fan-in Task re-queued itself to wait for the writers
             if not contextOrContexts and not contextOrContexts.guarded:
                 # by implementation, EVERY fan-in should have at least one work package available to it, this
                 # is likely caused by an index writing delay, and it is suitable to simply retry this task
@@ -170,6 +240,8 @@ class State:
             try:
                 context.currentAction = context.currentState.doAction
                 nextEvent = context.currentState.doAction.execute(contextOrContexts, obj)
+                if context.currentState.isContinuation and hasattr(context.currentState.doAction, 'recordBatchTime'):
+                    context.currentState.doAction.recordBatchTime(contextOrContexts, obj)
             except HaltMachineError:
                 raise # let it bubble up quietly
             except Exception as e:
@@ -184,20 +256,18 @@ class State:
 
             # this prevents fan-in from re-counting the data if there is an Exception
             # or DeadlineExceeded _after_ doAction.execute(...) succeeds
-            index = context.get(constants.INDEX_PARAM) or contextOrContexts[0].get(constants.INDEX_PARAM)
-            workIndex = '%s-%d' % (taskNameBase, knuthHash(index))
-            semaphore = RunOnceSemaphore(workIndex, context)
+            semaphore = RunOnceSemaphore(contextOrContexts.semaphoreName, context)
             semaphore.writeRunOnceSemaphore(payload=obj[constants.TASK_NAME_PARAM])
 
-            try:
-                # at this point we have processed the work items, delete them
-                task = Task(name=obj[constants.TASK_NAME_PARAM] + '-cleanup',
-                            url=constants.DEFAULT_CLEANUP_URL,
-                            params={constants.WORK_INDEX_PARAM: workIndex})
-                context.Queue(name=constants.DEFAULT_CLEANUP_QUEUE_NAME).add(task)
+            if contextOrContexts.nextCursor:
+                # more than fan_in_max_contexts work items, the next chunk is fanned in by another Task
+                # pylint: disable=W0212
+                context._queueFanInChunk(contextOrContexts.nextCursor)
 
-            except (TaskAlreadyExistsError, TombstonedTaskError):
-                context.logger.info("Fan-in cleanup Task already exists.")
+            else:
+                # at this point we have processed the work items, delete them
+                # pylint: disable=W0212
+                context._queueFanInCleanup(contextOrContexts.workIndex, transition.target)
 
             if context.get('UNITTEST_RAISE_AFTER_FAN_IN'): # only way to generate this failure
                 if not contextOrContexts.guarded:
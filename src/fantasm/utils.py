@@ -16,6 +16,9 @@ Copyright 2010 VendAsta Technologies Inc.
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import collections
+import zlib
+
 from google.appengine.api.taskqueue.taskqueue import Queue
 
 class NoOpQueue( Queue ):
@@ -24,6 +27,28 @@ class NoOpQueue( Queue ):
     def add(self, task, transactional=False):
         """ see taskqueue.Queue.add """
         pass
+
+    def add_async(self, task, transactional=False, rpc=None):
+        """ see taskqueue.Queue.add_async """
+        return _NoOpRPC()
+
+class _NoOpRPC:
+    """ A completed UserRPC, for NoOpQueue.add_async() and the like """
+
+    def __init__(self, result=None):
+        """ Constructor
+
+        @param result: the result of the RPC
+        """
+        self.result = result
+
+    def wait(self):
+        """ see apiproxy_stub_map.UserRPC.wait """
+        pass
+
+    def get_result(self):
+        """ see apiproxy_stub_map.UserRPC.get_result """
+        return self.result
        
 def knuthHash(number):
     """A decent hash function for integers."""
@@ -32,3 +57,58 @@ def knuthHash(number):
 def boolConverter(boolStr):
     """ A converter that maps some common bool string to True """
     return {'1': True, 'True': True, 'true': True}.get(boolStr, False)
+
+class Metrics:
+    """ Process-local counters, e.g., for the compression ratios of task payloads and fan-in work packages.
+
+    Counters are named '<kind>.<counter>'; see compress() for the ones it maintains.
+    """
+    _counters = collections.defaultdict(int)
+
+    @classmethod
+    def incr(cls, name, delta=1):
+        """ Increments a counter.
+
+        @param name: the counter name
+        @param delta: the amount to increment by
+        """
+        cls._counters[name] += delta
+
+    @classmethod
+    def get(cls, name):
+        """ Returns the value of a counter (0 if never incremented). """
+        return cls._counters.get(name, 0)
+
+    @classmethod
+    def ratio(cls, kind):
+        """ Returns the overall compressed/raw size ratio for a kind of compressed data, or None.
+
+        @param kind: e.g., constants.COMPRESSION_METRIC_TASK
+        """
+        rawBytes = cls.get(kind + '.rawBytes')
+        if not rawBytes:
+            return None
+        return float(cls.get(kind + '.compressedBytes')) / rawBytes
+
+    @classmethod
+    def snapshot(cls):
+        """ Returns a copy of all the counters. """
+        return dict(cls._counters)
+
+    @classmethod
+    def reset(cls):
+        """ Resets all the counters. """
+        cls._counters.clear()
+
+def compress(data, kind):
+    """ zlib-compresses data, recording '<kind>.count', '<kind>.rawBytes' and '<kind>.compressedBytes' in Metrics.
+
+    @param data: the bytes to compress
+    @param kind: the metrics prefix
+    @return: the compressed bytes
+    """
+    compressed = zlib.compress(data)
+    Metrics.incr(kind + '.count')
+    Metrics.incr(kind + '.rawBytes', len(data))
+    Metrics.incr(kind + '.compressedBytes', len(compressed))
+    return compressed
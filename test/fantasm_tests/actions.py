@@ -375,3 +375,14 @@ class FSCEE_FinalState:
         self.count = 0
     def execute(self, context, obj):
         self.count += 1
+
+class ForkFiveCounters:
+    def execute(self, context, obj):
+        for i in range(5):
+            context.fork(data={'counter': 1, 'group': i % 2})
+        context[FORK_PARAM] = -1 # the forking context writes its own work package too
+        return 'next-event'
+
+class SumCountersCombiner:
+    def combine(self, context, other):
+        context['counter'] += other['counter']
@@ -0,0 +1,101 @@
+""" Microbenchmarks for fantasm hot paths. These are not unit tests; run them by hand, e.g.,
+
+    PYTHONPATH=src:test python -m fantasm_tests.benchmarks
+"""
+
+import os
+import time
+import timeit
+
+from fantasm import config
+from fantasm.constants import MACHINE_STATES_ATTRIBUTE
+from fantasm.fsm import FSM
+
+# pylint: disable=C0111, W0212
+# - docstrings not reqd in benchmarks
+# - benchmarks need access to protected members
+
+YAML_FILENAME = os.path.join(os.path.dirname(__file__), 'yaml', 'test-TaskQueueFSMTests.yaml')
+
+def _report(name, func, number, repeat=5):
+    """ Prints the best-of-repeat cost of func() in microseconds. """
+    seconds = min(timeit.repeat(func, number=number, repeat=repeat))
+    print('%-40s %8.2f us/op' % (name, seconds * 1e6 / number))
+
+def _context():
+    factory = FSM(currentConfig=config.loadYaml(filename=YAML_FILENAME))
+    context = factory.createFSMInstance('TaskQueueFSMTests', instanceName='instanceName', method='POST',
+                                        obj={}, headers={})
+    context.currentState = context.initialState
+    context['__step__'] = 1
+    context['foo'] = 'bar'
+    return context
+
+def benchmarkDispatchHop(number=20000):
+    """ The per-hop cost of turning an event into a Task, without touching the task queue. """
+    context = _context()
+    state = context.currentState
+    _report('buildUrl', lambda: context.buildUrl(state, 'next-event'), number)
+    _report('getTaskName', lambda: context.getTaskName('next-event'), number)
+    _report('queueDispatch(queue=False)', lambda: context.queueDispatch('next-event', queue=False), number // 10)
+
+def benchmarkFork(children=(10, 1000, 10000)):
+    """ The cost of FSMContext.fork(), with a context of a typical size. """
+    for number in children:
+        context = _context()
+        context['items'] = list(range(100))
+        context['config'] = {'key%d' % i: {'value': i, 'tags': ['a', 'b']} for i in range(20)}
+        for i in range(20):
+            context['key%d' % i] = 'value%d' % i
+
+        def fork():
+            context._FSMContext__obj = {}
+            for i in range(number):
+                context.fork(data={'i': i})
+
+        seconds = min(timeit.repeat(fork, number=1, repeat=3))
+        print('%-40s %8.0f forks/s' % ('fork x %d' % number, number / seconds))
+
+def benchmarkContinuationBatches(results=500, batchSize=10, batches=(1, 5, 25), repeat=3):
+    """ The cost of a datastore continuation over a number of results, run as one Task per batch
+    (continuation_batches: 1) or as N batches per Task, with the App Engine stubs of the unit tests. The stubs
+    run the Tasks right away, so this leaves out the task queue latency between two continuation Tasks. """
+    from fantasm_tests.helpers import runQueuedTasks
+    from fantasm_tests.test_fsm import NDBTestModel
+    from fantasm_tests.test_integration import RunTasksBaseTest
+
+    class ContinuationBatches(RunTasksBaseTest):
+        FILENAME = 'test-NDBDatastoreFSMContinuationTests.yaml'
+        MACHINE_NAME = 'NDBInlineFSMContinuationTests'
+        def runTest(self):
+            pass
+
+    def run(number):
+        fixture = ContinuationBatches()
+        fixture.setUp()
+        try:
+            for i in range(10, results):
+                NDBTestModel(id=str(i)).put()
+            state = fixture.factory.machines[fixture.MACHINE_NAME][MACHINE_STATES_ATTRIBUTE]['state-continuation']
+            state.continuationBatches = number
+            fixture.machineConfig.states['state-continuation'].action.batchSize = batchSize
+            startedAt = time.time()
+            fixture.context.initialize() # queues the first task
+            ran = runQueuedTasks(queueName=fixture.context.queueName)
+            return time.time() - startedAt, ran
+        finally:
+            fixture.tearDown()
+
+    for number in batches:
+        seconds, ran = min(run(number) for _ in range(repeat))
+        continuations = len([name for name in ran if '--state-initial--' in name])
+        print('%-40s %8.0f results/s, %d continuation Tasks' % ('continuation_batches: %d' % number,
+                                                                 results / seconds, continuations))
+
+def main():
+    benchmarkDispatchHop()
+    benchmarkFork()
+    benchmarkContinuationBatches()
+
+if __name__ == '__main__':
+    main()
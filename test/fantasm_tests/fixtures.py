@@ -53,7 +53,6 @@ class AppEngineTestCase(unittest.TestCase):
         self.__capabilities = capability_stub.CapabilityServiceStub()
         apiproxy_stub_map.apiproxy.RegisterStub('capability_service', self.__capabilities)
 
-        constants.DATASTORE_ASYNCRONOUS_INDEX_WRITE_WAIT_TIME = 0.0
         constants.DEFAULT_LOG_QUEUE_NAME = constants.DEFAULT_QUEUE_NAME
 
     def tearDown(self):
@@ -16,7 +16,7 @@ from minimock import mock
 
 from fantasm import config, constants
 from fantasm.fsm import FSM
-from fantasm.handlers import FSMFanInCleanupHandler, FSMHandler, FSMLogHandler
+from fantasm.handlers import FSMFanInCleanupHandler, FSMHandler, FSMLogHandler, FSMSpawnHandler
 from fantasm.log import Logger  # pylint: disable=W0611
 
 # pylint: disable=C0111, C0103, W0613, W0612
@@ -41,6 +41,21 @@ class TaskDouble:
         """Adds this Task to a queue. See Queue.add."""
         return TaskQueueDouble(queue_name).add(self, transactional=transactional)
 
+class RPCDouble:
+    """ RPCDouble is a mock for a completed google.appengine.api.apiproxy_stub_map.UserRPC """
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+
+    def wait(self):
+        pass
+
+    def get_result(self):
+        if self.error:
+            raise self.error
+        return self.result
+
 class TaskQueueDouble:
     """ TaskQueueDouble is a mock for google.appengine.api.lab.taskqueue.Queue """
 
@@ -68,6 +83,21 @@ class TaskQueueDouble:
                 self.tasknames.add(task.name)
                 self.tasks.append((task, transactional))
 
+    def add_async(self, task_or_tasks, transactional=False, rpc=None):
+        """ mock for google.appengine.api.taskqueue.add_async; like the real thing, all the new Tasks are
+        added and marked as enqueued, and the error for the duplicates is raised by .get_result() """
+        tasks = task_or_tasks if isinstance(task_or_tasks, list) else [task_or_tasks]
+        error = None
+        for task in tasks:
+            if task.name in self.tasknames:
+                error = TaskAlreadyExistsError()
+                continue
+            if task.url != constants.DEFAULT_LOG_URL: # avoid fragile unit tests
+                self.tasknames.add(task.name)
+                self.tasks.append((task, transactional))
+            task._Task__enqueued = True
+        return RPCDouble(result=task_or_tasks, error=error)
+
     def purge(self):
         """ purge all tasks in queue """
         self.tasks = []
@@ -178,6 +208,9 @@ def runQueuedTasks(queueName='default', assertTasks=True, tasksOverride=None, sp
             elif task['url'] == constants.DEFAULT_LOG_URL:
                 record = False
                 handler = FSMLogHandler()
+            elif task['url'] == constants.DEFAULT_SPAWN_URL:
+                record = False
+                handler = FSMSpawnHandler()
             else:
                 handler = FSMHandler()
             parts = task['url'].split('?')
@@ -187,7 +220,8 @@ def runQueuedTasks(queueName='default', assertTasks=True, tasksOverride=None, sp
             if len(parts) == 2:
                 environ['QUERY_STRING'] = parts[1]
             if task['method'] == 'POST':
-                environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+                contentTypes = [v for (k, v) in task.get('headers', []) if k.lower() == 'content-type']
+                environ['CONTENT_TYPE'] = (contentTypes or ['application/x-www-form-urlencoded'])[0]
             environ['REQUEST_METHOD'] = task['method']
 
             if task['method'] == 'POST':
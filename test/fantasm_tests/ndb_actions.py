@@ -1,6 +1,8 @@
 """ FSMActions used in unit tests """
 
-from fantasm.action import NDBDatastoreContinuationFSMAction
+from fantasm.action import NDBDatastoreContinuationFSMAction, NDBPrefetchingContinuationFSMAction, \
+                           ShardedDatastoreContinuationFSMAction
+from google.appengine.ext.ndb import key as ndb_key
 from google.appengine.ext.ndb import model as ndb_model
 from fantasm.constants import FORK_PARAM
 from fantasm.constants import CONTINUATION_RESULT_KEY
@@ -40,10 +42,11 @@ class TestDatastoreContinuationFSMAction(NDBDatastoreContinuationFSMAction):
         self.fails = 0
         self.failat = 0
         self.cfailat = 0
+        self.batchSize = 2
     def getQuery(self, context, obj):
         return NDBTestModel.query().order(NDBTestModel.prop1)
     def getBatchSize(self, context, obj):
-        return 2
+        return self.batchSize
     def continuation(self, context, obj, token=None):
         self.ccount += 1
         if self.ccount == self.cfailat:
@@ -62,6 +65,31 @@ class TestDatastoreContinuationFSMAction(NDBDatastoreContinuationFSMAction):
             raise Exception()
         return 'next-event'
 
+class TestPrefetchingContinuationFSMAction(TestDatastoreContinuationFSMAction, NDBPrefetchingContinuationFSMAction):
+    pass
+
+class TestShardedContinuationFSMAction(TestDatastoreContinuationFSMAction, ShardedDatastoreContinuationFSMAction):
+    def __init__(self):
+        super().__init__()
+        self.splitKeys = None
+        self.seen = []
+    def getQuery(self, context, obj):
+        return NDBTestModel.query()
+    def getSplitKeys(self, context, obj):
+        if self.splitKeys is None:
+            return super().getSplitKeys(context, obj)
+        return [ndb_key.Key('NDBTestModel', name) for name in self.splitKeys]
+    def execute(self, context, obj):
+        self.seen.extend(result.key.id() for result in obj[CONTINUATION_RESULTS_KEY])
+        return super().execute(context, obj)
+
+class CountShardedResultsFanIn(CountExecuteCallsFinal):
+    TOTALS = []
+    def execute(self, context, obj):
+        CountShardedResultsFanIn.TOTALS.append(
+            ShardedDatastoreContinuationFSMAction.checkFanInForTotalResultsCount(context, obj))
+        return super().execute(context, obj)
+
 class TestContinuationAndForkFSMAction(NDBDatastoreContinuationFSMAction):
     def __init__(self):
         super().__init__()
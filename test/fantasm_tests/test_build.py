@@ -0,0 +1,138 @@
+""" Tests for fantasm.build """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fantasm
+from fantasm import build, config, constants
+from fantasm.fsm import FSM
+
+# pylint: disable=C0111, W0212
+# - docstrings not reqd in unit tests
+# - accessing protected config members a lot in these tests
+
+class CompileYamlTests(unittest.TestCase):
+
+    FILENAME = 'test-TaskQueueFSMTests.yaml'
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'fsm.yaml')
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'yaml', self.FILENAME), self.filename)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+        config._config = None
+
+    def test_compileYaml_writes_artifact(self):
+        outputFilename = build.compileYaml(filename=self.filename)
+        self.assertEqual(self.filename + constants.COMPILED_YAML_SUFFIX, outputFilename)
+        self.assertTrue(os.path.exists(outputFilename))
+
+    def test_loadCompiledYaml_no_artifact(self):
+        self.assertEqual(None, config.loadCompiledYaml(filename=self.filename))
+
+    def test_loadCompiledYaml(self):
+        build.compileYaml(filename=self.filename)
+        configuration = config.loadCompiledYaml(filename=self.filename)
+        self.assertTrue(configuration.compiledTables)
+        self.assertEqual(sorted(config.loadYaml(filename=self.filename).machines.keys()),
+                         sorted(configuration.machines.keys()))
+
+    def test_loadCompiledYaml_shares_actions_with_tables(self):
+        build.compileYaml(filename=self.filename)
+        configuration = config.loadCompiledYaml(filename=self.filename)
+        machines = configuration.compiledTables[0]
+        state = machines['TaskQueueFSMTests'][constants.MACHINE_STATES_ATTRIBUTE]['state-initial']
+        self.assertTrue(state.doAction is configuration.machines['TaskQueueFSMTests'].states['state-initial'].action)
+
+    def test_loadCompiledYaml_stale(self):
+        build.compileYaml(filename=self.filename)
+        with open(self.filename, 'a') as f:
+            f.write('\n# edited\n')
+        self.assertEqual(None, config.loadCompiledYaml(filename=self.filename))
+
+    def test_loadCompiledYaml_old_version(self):
+        build.compileYaml(filename=self.filename)
+        codeVersion = config._getCodeVersion()
+        config._codeVersion = '2.0.1-' + codeVersion.split('-')[1]
+        try:
+            self.assertEqual(None, config.loadCompiledYaml(filename=self.filename))
+        finally:
+            config._codeVersion = codeVersion
+
+    def test_loadCompiledYaml_changed_sources(self):
+        build.compileYaml(filename=self.filename)
+        codeVersion = config._getCodeVersion()
+        config._codeVersion = codeVersion.split('-')[0] + '-' + '0' * 40
+        try:
+            self.assertEqual(None, config.loadCompiledYaml(filename=self.filename))
+        finally:
+            config._codeVersion = codeVersion
+
+    def test_getCodeVersion(self):
+        config._codeVersion = None
+        self.assertTrue(config._getCodeVersion().startswith(fantasm.__version__ + '-'))
+
+    def test_loadCompiledYaml_corrupt(self):
+        with open(config.compiledFilename(self.filename), 'wb') as f:
+            f.write(b'not a pickle')
+        self.assertEqual(None, config.loadCompiledYaml(filename=self.filename))
+
+    def test_loadCompiledYaml_moved_application(self):
+        build.compileYaml(filename=self.filename)
+        moved = tempfile.mkdtemp()
+        try:
+            shutil.copy(self.filename, moved)
+            shutil.copy(config.compiledFilename(self.filename), moved)
+            configuration = config.loadCompiledYaml(filename=os.path.join(moved, 'fsm.yaml'))
+            self.assertTrue(configuration.compiledTables)
+        finally:
+            shutil.rmtree(moved)
+
+    def test_currentConfiguration_uses_artifact(self):
+        build.compileYaml(filename=self.filename)
+        config._config = None
+        configuration = config.currentConfiguration(filename=self.filename)
+        self.assertTrue(configuration.compiledTables)
+
+    def test_FSM_uses_compiled_tables(self):
+        build.compileYaml(filename=self.filename)
+        configuration = config.loadCompiledYaml(filename=self.filename)
+        factory = FSM(currentConfig=configuration)
+        self.assertTrue(factory.machines is configuration.compiledTables[0])
+        context = factory.createFSMInstance('TaskQueueFSMTests')
+        self.assertEqual('pseudo-init', context.currentState.name)
+        self.assertEqual('state-initial', context.initialState.name)
+
+    def test_main(self):
+        self.assertEqual(0, build.main(['compile', self.filename, '-o', self.filename + '.out']))
+        self.assertTrue(os.path.exists(self.filename + '.out'))
+
+    def test_main_validate(self):
+        self.assertEqual(0, build.main(['validate', self.filename]))
+
+    def test_validateYaml_lazy_actions(self):
+        with open(self.filename) as f:
+            yamlString = f.read()
+        with open(self.filename, 'w') as f:
+            f.write('lazy_actions: True\n' + yamlString)
+        configuration = build.validateYaml(filename=self.filename)
+        action = configuration.machines['TaskQueueFSMTests'].states['state-initial'].action
+        self.assertTrue(isinstance(action, config._LazyAction))
+        self.assertTrue(action._instance)
+
+    def test_compileYaml_lazy_actions_are_not_pickled_resolved(self):
+        with open(self.filename) as f:
+            yamlString = f.read()
+        with open(self.filename, 'w') as f:
+            f.write('lazy_actions: True\n' + yamlString)
+        build.compileYaml(filename=self.filename)
+        configuration = config.loadCompiledYaml(filename=self.filename)
+        action = configuration.machines['TaskQueueFSMTests'].states['state-initial'].action
+        self.assertEqual(None, action._instance)
+        self.assertEqual(0, action.count)
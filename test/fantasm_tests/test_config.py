@@ -33,6 +33,9 @@ class MockEntryNoExecute:
     pass
 class MockExitNoExecute:
     pass
+class MockFanInCombiner:
+    def combine(self, context, other):
+        pass
 
 class TestMachineDictionaryProcessing(unittest.TestCase):
 
@@ -72,6 +75,71 @@ class TestMachineDictionaryProcessing(unittest.TestCase):
         fsm = config._MachineConfig(self.machineDict)
         self.assertEqual(constants.DEFAULT_USE_RUN_ONCE_SEMAPHORE, fsm.useRunOnceSemaphore)
 
+    def test_payloadFormat_hasDefaultValue(self):
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(constants.PAYLOAD_FORMAT_URLENCODED, fsm.payloadFormat)
+
+    def test_payloadFormatParsed(self):
+        self.machineDict[constants.MACHINE_PAYLOAD_FORMAT_ATTRIBUTE] = constants.PAYLOAD_FORMAT_JSON
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(constants.PAYLOAD_FORMAT_JSON, fsm.payloadFormat)
+
+    def test_invalidPayloadFormatRaisesError(self):
+        self.machineDict[constants.MACHINE_PAYLOAD_FORMAT_ATTRIBUTE] = 'msgpack'
+        self.assertRaises(exceptions.InvalidPayloadFormatError, config._MachineConfig, self.machineDict)
+
+    def test_compressionThreshold_hasDefaultValue(self):
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(None, fsm.compressionThreshold)
+
+    def test_compressionThresholdParsed(self):
+        self.machineDict[constants.MACHINE_COMPRESSION_THRESHOLD_ATTRIBUTE] = '65536'
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(65536, fsm.compressionThreshold)
+
+    def test_invalidCompressionThresholdRaisesError(self):
+        self.machineDict[constants.MACHINE_COMPRESSION_THRESHOLD_ATTRIBUTE] = 'abc'
+        self.assertRaises(exceptions.InvalidCompressionThresholdError, config._MachineConfig, self.machineDict)
+
+    def test_negativeCompressionThresholdRaisesError(self):
+        self.machineDict[constants.MACHINE_COMPRESSION_THRESHOLD_ATTRIBUTE] = -1
+        self.assertRaises(exceptions.InvalidCompressionThresholdError, config._MachineConfig, self.machineDict)
+
+    def test_offloadThreshold_hasDefaultValue(self):
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(None, fsm.offloadThreshold)
+
+    def test_offloadThresholdParsed(self):
+        self.machineDict[constants.MACHINE_OFFLOAD_THRESHOLD_ATTRIBUTE] = 10000
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(10000, fsm.offloadThreshold)
+
+    def test_invalidOffloadThresholdRaisesError(self):
+        self.machineDict[constants.MACHINE_OFFLOAD_THRESHOLD_ATTRIBUTE] = 'abc'
+        self.assertRaises(exceptions.InvalidOffloadThresholdError, config._MachineConfig, self.machineDict)
+
+    def test_instanceRows_hasDefaultValue(self):
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(True, fsm.instanceRows)
+
+    def test_instanceRowsParsed(self):
+        self.machineDict[constants.MACHINE_INSTANCE_ROWS_ATTRIBUTE] = False
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(False, fsm.instanceRows)
+
+    def test_runOnceSemaphoreMode_hasDefaultValue(self):
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(constants.RUN_ONCE_SEMAPHORE_MODE_STRICT, fsm.runOnceSemaphoreMode)
+
+    def test_runOnceSemaphoreModeParsed(self):
+        self.machineDict[constants.MACHINE_RUN_ONCE_SEMAPHORE_MODE_ATTRIBUTE] = 'fast'
+        fsm = config._MachineConfig(self.machineDict)
+        self.assertEqual(constants.RUN_ONCE_SEMAPHORE_MODE_FAST, fsm.runOnceSemaphoreMode)
+
+    def test_invalidRunOnceSemaphoreModeRaisesError(self):
+        self.machineDict[constants.MACHINE_RUN_ONCE_SEMAPHORE_MODE_ATTRIBUTE] = 'sloppy'
+        self.assertRaises(exceptions.InvalidRunOnceSemaphoreModeError, config._MachineConfig, self.machineDict)
+
     def test_queueParsed(self):
         queueName = 'SomeQueue'
         self.machineDict[constants.QUEUE_NAME_ATTRIBUTE] = queueName
@@ -430,6 +498,176 @@ class TestStateDictionaryProcessing(unittest.TestCase):
         state = self.fsm.addState(self.stateDict)
         self.assertEqual(state.fanInPeriod, 10)
 
+    def test_faninCombinerDefault(self):
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInCombiner, None)
+
+    def test_faninCombinerParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_COMBINER_ATTRIBUTE] = 'MockFanInCombiner'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(fantasm_tests.test_config.MockFanInCombiner, state.fanInCombiner.__class__)
+
+    def test_faninCombinerRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_COMBINER_ATTRIBUTE] = 'MockFanInCombiner'
+        self.assertRaises(exceptions.InvalidFanInCombinerError, self.fsm.addState, self.stateDict)
+
+    def test_faninCombinerRequiresCombineMethod(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_COMBINER_ATTRIBUTE] = 'MockAction'
+        self.assertRaises(exceptions.InvalidFanInCombinerInterfaceError, self.fsm.addState, self.stateDict)
+
+    def test_faninReadLockCountdownDefault(self):
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInReadLockCountdown, None)
+
+    def test_faninReadLockCountdownParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_READ_LOCK_COUNTDOWN_ATTRIBUTE] = '2'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInReadLockCountdown, 2)
+
+    def test_faninReadLockCountdownRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_READ_LOCK_COUNTDOWN_ATTRIBUTE] = 2
+        self.assertRaises(exceptions.InvalidFanInReadLockCountdownError, self.fsm.addState, self.stateDict)
+
+    def test_faninShardsParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_SHARDS_ATTRIBUTE] = '16'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInShards, 16)
+
+    def test_faninShardsRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_SHARDS_ATTRIBUTE] = 16
+        self.assertRaises(exceptions.InvalidFanInShardsError, self.fsm.addState, self.stateDict)
+
+    def test_faninEntityGroupsDefault(self):
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInEntityGroups, constants.DEFAULT_FAN_IN_ENTITY_GROUPS)
+
+    def test_faninEntityGroupsParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_ENTITY_GROUPS_ATTRIBUTE] = '32'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInEntityGroups, 32)
+
+    def test_faninEntityGroupsInvalid(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_ENTITY_GROUPS_ATTRIBUTE] = 0
+        self.assertRaises(exceptions.InvalidFanInEntityGroupsError, self.fsm.addState, self.stateDict)
+
+    def test_faninEntityGroupsRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_ENTITY_GROUPS_ATTRIBUTE] = 16
+        self.assertRaises(exceptions.InvalidFanInEntityGroupsError, self.fsm.addState, self.stateDict)
+
+    def test_faninCleanupPeriodDefault(self):
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInCleanupPeriod, None)
+
+    def test_faninCleanupPeriodParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_CLEANUP_PERIOD_ATTRIBUTE] = '300'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInCleanupPeriod, 300)
+
+    def test_faninCleanupPeriodRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_CLEANUP_PERIOD_ATTRIBUTE] = 300
+        self.assertRaises(exceptions.InvalidFanInCleanupPeriodError, self.fsm.addState, self.stateDict)
+
+    def test_faninCleanupPeriodMustBePositive(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_CLEANUP_PERIOD_ATTRIBUTE] = 0
+        self.assertRaises(exceptions.InvalidFanInCleanupPeriodError, self.fsm.addState, self.stateDict)
+
+    def test_faninExpectedDefault(self):
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInExpected, None)
+        self.assertEqual(state.fanInAdaptive, False)
+
+    def test_faninExpectedParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_EXPECTED_ATTRIBUTE] = '100'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInExpected, 100)
+
+    def test_faninExpectedContextKey(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_EXPECTED_ATTRIBUTE] = 'num-items'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInExpected, 'num-items')
+
+    def test_faninExpectedMustBePositive(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_EXPECTED_ATTRIBUTE] = -1
+        self.assertRaises(exceptions.InvalidFanInExpectedError, self.fsm.addState, self.stateDict)
+
+    def test_faninExpectedRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_EXPECTED_ATTRIBUTE] = 100
+        self.assertRaises(exceptions.InvalidFanInExpectedError, self.fsm.addState, self.stateDict)
+
+    def test_faninAdaptiveParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_ADAPTIVE_ATTRIBUTE] = True
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInAdaptive, True)
+
+    def test_faninAdaptiveRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_ADAPTIVE_ATTRIBUTE] = True
+        self.assertRaises(exceptions.InvalidFanInAdaptiveError, self.fsm.addState, self.stateDict)
+
+    def test_faninMaxContextsDefault(self):
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInMaxContexts, None)
+
+    def test_faninMaxContextsParsed(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_MAX_CONTEXTS_ATTRIBUTE] = '1000'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.fanInMaxContexts, 1000)
+
+    def test_faninMaxContextsRequiresFanIn(self):
+        self.stateDict[constants.STATE_FAN_IN_MAX_CONTEXTS_ATTRIBUTE] = 1000
+        self.assertRaises(exceptions.InvalidFanInMaxContextsError, self.fsm.addState, self.stateDict)
+
+    def test_faninMaxContextsMustBePositive(self):
+        self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
+        self.stateDict[constants.STATE_FAN_IN_MAX_CONTEXTS_ATTRIBUTE] = 0
+        self.assertRaises(exceptions.InvalidFanInMaxContextsError, self.fsm.addState, self.stateDict)
+
+    def test_continuationBatchesDefault(self):
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.continuationBatches, constants.DEFAULT_CONTINUATION_BATCHES)
+        self.assertEqual(state.continuationSeconds, constants.DEFAULT_CONTINUATION_SECONDS)
+
+    def test_continuationBatchesParsed(self):
+        self.stateDict[constants.STATE_CONTINUATION_ATTRIBUTE] = True
+        self.stateDict[constants.STATE_ACTION_ATTRIBUTE] = 'MockActionWithContinuation'
+        self.stateDict[constants.STATE_CONTINUATION_BATCHES_ATTRIBUTE] = '5'
+        self.stateDict[constants.STATE_CONTINUATION_SECONDS_ATTRIBUTE] = '30.5'
+        state = self.fsm.addState(self.stateDict)
+        self.assertEqual(state.continuationBatches, 5)
+        self.assertEqual(state.continuationSeconds, 30.5)
+
+    def test_continuationBatchesMustBePositive(self):
+        self.stateDict[constants.STATE_CONTINUATION_ATTRIBUTE] = True
+        self.stateDict[constants.STATE_ACTION_ATTRIBUTE] = 'MockActionWithContinuation'
+        self.stateDict[constants.STATE_CONTINUATION_BATCHES_ATTRIBUTE] = 0
+        self.assertRaises(exceptions.InvalidContinuationBatchesError, self.fsm.addState, self.stateDict)
+
+    def test_continuationBatchesRequiresContinuation(self):
+        self.stateDict[constants.STATE_CONTINUATION_BATCHES_ATTRIBUTE] = 5
+        self.assertRaises(exceptions.InvalidContinuationBatchesError, self.fsm.addState, self.stateDict)
+
+    def test_continuationSecondsMustBePositive(self):
+        self.stateDict[constants.STATE_CONTINUATION_ATTRIBUTE] = True
+        self.stateDict[constants.STATE_ACTION_ATTRIBUTE] = 'MockActionWithContinuation'
+        self.stateDict[constants.STATE_CONTINUATION_SECONDS_ATTRIBUTE] = 'abc'
+        self.assertRaises(exceptions.InvalidContinuationSecondsError, self.fsm.addState, self.stateDict)
+
+    def test_continuationSecondsRequiresContinuation(self):
+        self.stateDict[constants.STATE_CONTINUATION_SECONDS_ATTRIBUTE] = 30
+        self.assertRaises(exceptions.InvalidContinuationSecondsError, self.fsm.addState, self.stateDict)
+
     def test_faninCombinedWithContinuationRaisesException(self):
         self.stateDict[constants.STATE_FAN_IN_ATTRIBUTE] = 10
         self.stateDict[constants.STATE_CONTINUATION_ATTRIBUTE] = True
@@ -1135,6 +1373,84 @@ state_machines:
       initial: True
 """)
 
+class TestLazyActions(unittest.TestCase):
+
+    def _test(self, yamlString):
+        import yaml
+        return config.Configuration(yaml.safe_load(yamlString))
+
+    YAML = """
+lazy_actions: True
+state_machines:
+- name: machineName
+  namespace: fantasm_tests.test_config
+  states:
+    - name: state1
+      entry: MockEntry
+      action: %s
+      initial: True
+      transitions:
+      - event: next
+        to: state2
+        action: MockAction
+    - name: state2
+      action: MockAction
+      transitions:
+      - event: next
+        to: state3
+    - name: state3
+      action: MockActionWithContinuation
+      continuation: True
+      final: True
+"""
+
+    def test_actionsAreNotResolvedAtLoad(self):
+        configuration = self._test(self.YAML % 'MockAction')
+        state = configuration.machines['machineName'].states['state1']
+        self.assertTrue(isinstance(state.action, config._LazyAction))
+        self.assertEqual(None, state.action._instance)
+
+    def test_actionIsResolvedOnFirstUse(self):
+        configuration = self._test(self.YAML % 'MockAction')
+        state = configuration.machines['machineName'].states['state1']
+        self.assertEqual(None, state.action.execute(None, None))
+        self.assertTrue(isinstance(state.action._instance, fantasm_tests.test_config.MockAction))
+        self.assertTrue(state.action.resolve() is state.action._instance)
+
+    def test_classResolutionIsMemoized(self):
+        configuration = self._test(self.YAML % 'MockAction')
+        configuration.resolveActions()
+        self.assertTrue(('MockAction', 'fantasm_tests.test_config') in config._resolvedClasses)
+        transition = configuration.machines['machineName'].transitions['state1--next']
+        self.assertTrue(isinstance(transition.action._instance, fantasm_tests.test_config.MockAction))
+
+    def test_unknownActionDoesNotFailLoad(self):
+        configuration = self._test(self.YAML % 'DoesNotExist')
+        self.assertRaises(exceptions.UnknownClassError, configuration.resolveActions)
+
+    def test_badInterfaceFailsResolve(self):
+        configuration = self._test(self.YAML % 'MockActionNoExecute')
+        self.assertRaises(exceptions.InvalidActionInterfaceError, configuration.resolveActions)
+
+    def test_missingContinuationFailsResolve(self):
+        configuration = self._test((self.YAML % 'MockAction').replace('MockActionWithContinuation', 'MockAction'))
+        self.assertRaises(exceptions.InvalidContinuationInterfaceError, configuration.resolveActions)
+
+    def test_eagerByDefault(self):
+        configuration = self._test((self.YAML % 'MockAction').replace('lazy_actions: True', ''))
+        self.assertFalse(configuration.lazyActions)
+        self.assertTrue(isinstance(configuration.machines['machineName'].states['state1'].action,
+                                   fantasm_tests.test_config.MockAction))
+
+    def test_pickleDropsResolvedInstance(self):
+        import pickle
+        configuration = self._test(self.YAML % 'MockAction')
+        configuration.resolveActions()
+        unpickled = pickle.loads(pickle.dumps(configuration))
+        action = unpickled.machines['machineName'].states['state1'].action
+        self.assertEqual(None, action._instance)
+        self.assertTrue(isinstance(action.resolve(), fantasm_tests.test_config.MockAction))
+
 # class TestMachineConfigRetrieval(unittest.TestCase):
 #
 #     def test_ensureMachineConfigIsCachedStatically(self):
@@ -3,6 +3,7 @@
 from google.appengine.ext import db
 from fantasm.action import DatastoreContinuationFSMAction
 from fantasm.action import ListContinuationFSMAction
+from fantasm.action import StoredListContinuationFSMAction
 from fantasm_tests.fixtures import AppEngineTestCase
 from fantasm_tests.helpers import runQueuedTasks
 from fantasm_tests.helpers import setUpByString
@@ -10,7 +11,9 @@ from fantasm.models import _FantasmFanIn
 from fantasm import config # pylint: disable=W0611
 from fantasm.handlers import FSMFanInCleanupHandler # pylint: disable=W0611
 from minimock import mock, restore
-from fantasm.constants import CONTINUATION_RESULTS_KEY
+from fantasm.constants import CONTINUATION_RESULTS_KEY, CONTINUATION_RESULTS_COUNTER_PARAM, RETRY_COUNT_PARAM, \
+                              CONTINUATION_BATCH_SIZE_PARAM
+from fantasm.lock import getLockBackend
 
 # pylint: disable=C0111,W0613
 # - docstrings not reqd in unit tests
@@ -62,6 +65,53 @@ class OutsideListContinuationAction( ListContinuation ):
             context['data'] = obj[CONTINUATION_RESULTS_KEY]
         return context.get('event', 'ok') # bad!!! should be inside if
 
+class AdaptiveListContinuationAction( InsideListContinuationAction ):
+    def __init__(self):
+        self.batches = []
+        self.failat = None # the results counter of a batch to fail once
+    def getTargetBatchTime(self, context, obj):
+        return context.get('target')
+    def getMaxBatchSize(self, context, obj):
+        return 4
+    def execute(self, context, obj):
+        if obj[CONTINUATION_RESULTS_KEY]:
+            self.batches.append((len(obj[CONTINUATION_RESULTS_KEY]), context[CONTINUATION_RESULTS_COUNTER_PARAM]))
+            if context[CONTINUATION_RESULTS_COUNTER_PARAM] == self.failat:
+                self.failat = None
+                raise Exception('failat')
+        return super().execute(context, obj)
+
+class AdaptiveDatastoreContinuationAction( InsideDatastoreContinuationAction ):
+    def __init__(self):
+        self.batches = []
+        self.failat = None # the results counter of a batch to fail once
+    def getTargetBatchTime(self, context, obj):
+        return context.get('target')
+    def getMaxBatchSize(self, context, obj):
+        return 4
+    def execute(self, context, obj):
+        if obj[CONTINUATION_RESULTS_KEY]:
+            self.batches.append((len(obj[CONTINUATION_RESULTS_KEY]), context[CONTINUATION_RESULTS_COUNTER_PARAM]))
+            if context[CONTINUATION_RESULTS_COUNTER_PARAM] == self.failat:
+                self.failat = None
+                raise Exception('failat')
+        return super().execute(context, obj)
+
+class InsideStoredListContinuationAction( StoredListContinuationFSMAction ):
+    def __init__(self):
+        self.getListCalls = 0
+    def getList(self, context, obj):
+        self.getListCalls += 1
+        return context.get('items', [0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
+    def getBatchSize(self, context, obj):
+        return context.get('batchsize', 1)
+    def getChunkSize(self, context, obj):
+        return 4
+    def execute(self, context, obj):
+        if obj[CONTINUATION_RESULTS_KEY]:
+            context['data'] = obj[CONTINUATION_RESULTS_KEY]
+            return context.get('event', 'ok')
+
 class MiddleAction:
     def execute(self, context, obj):
         return 'ok'
@@ -205,6 +255,89 @@ state_machines:
       final: True
       fan_in: 1
       action: FanInAction
+
+  - name: InsideStoredListFanInMachine
+    namespace: fantasm_tests.test_continuation_fan_in
+    task_retry_limit: 0
+    context_types:
+      data: int
+      batchsize: int
+      items: int
+      event: str
+
+    states:
+
+    - name: InitialState
+      initial: True
+      final: True
+      continuation: True
+      action: InsideStoredListContinuationAction
+      transitions:
+        - event: 'ok'
+          to: MiddleState
+        - event: 'fan'
+          to: FanInState
+
+    - name: MiddleState
+      action: MiddleAction
+      transitions:
+        - event: 'ok'
+          to: FanInState
+
+    - name: FanInState
+      final: True
+      fan_in: 1
+      action: FanInAction
+
+  - name: AdaptiveListFanInMachine
+    namespace: fantasm_tests.test_continuation_fan_in
+    task_retry_limit: 0
+    context_types:
+      data: int
+      batchsize: int
+      items: int
+      event: str
+      target: float
+
+    states:
+
+    - name: InitialState
+      initial: True
+      final: True
+      continuation: True
+      action: AdaptiveListContinuationAction
+      transitions:
+        - event: 'ok'
+          to: FanInState
+
+    - name: FanInState
+      final: True
+      fan_in: 1
+      action: FanInAction
+
+  - name: AdaptiveDatastoreFanInMachine
+    namespace: fantasm_tests.test_continuation_fan_in
+    context_types:
+      data: int
+      batchsize: int
+      event: str
+      target: float
+
+    states:
+
+    - name: InitialState
+      initial: True
+      final: True
+      continuation: True
+      action: AdaptiveDatastoreContinuationAction
+      transitions:
+        - event: 'ok'
+          to: FanInState
+
+    - name: FanInState
+      final: True
+      fan_in: 1
+      action: FanInAction
 """
 
 class BaseTest( AppEngineTestCase ):
@@ -276,6 +409,20 @@ class InsideListTest( InsideTest ):
 class InsideFanListTest( InsideListTest ):
     EVENT = 'fan'
 
+class InsideStoredListTest( InsideTest ):
+    MACHINE_NAME = 'InsideStoredListFanInMachine'
+
+    def test_getList_called_once(self):
+        self.context['batchsize'] = 3
+        self.context.initialize() # queues the first task
+        runQueuedTasks()
+        action = self.currentConfig.machines[self.MACHINE_NAME].states['InitialState'].action
+        self.assertEqual(1, action.getListCalls)
+        self.assertEqual(self.EXPECTED_VALUES, sorted(ContinuationFanInResult.get_by_key_name('test').values))
+
+class InsideFanStoredListTest( InsideStoredListTest ):
+    EVENT = 'fan'
+
 class OutsideTest( BaseTest ):
     """
     Tests bad continuation execute() method
@@ -326,3 +473,102 @@ class OutsideListTest( OutsideTest ):
 
 class OutsideFanListTest( OutsideListTest ):
     EVENT = 'fan'
+
+class AdaptiveBatchSizeTest( BaseTest ):
+    """
+    Tests getTargetBatchTime()
+    """
+    MACHINE_NAME = 'AdaptiveListFanInMachine'
+    EVENT = 'ok'
+
+    def setUp(self):
+        super().setUp()
+        self.action = self.currentConfig.machines[self.MACHINE_NAME].states['InitialState'].action
+
+    def test_fast_batches_grow_to_max(self):
+        self.context['target'] = 10.0
+        self.context.initialize() # queues the first task
+        runQueuedTasks()
+        # the first Task sizes the second batch before the time of the first batch is known
+        self.assertEqual([(1, 1), (1, 2), (4, 6), (4, 10)], self.action.batches)
+        self.assertEqual(list(range(10)), sorted(ContinuationFanInResult.get_by_key_name('test').values))
+
+    def test_retry_keeps_batch(self):
+        self.context['target'] = 10.0
+        self.action.failat = 6
+        self.context.initialize() # queues the first task
+        runQueuedTasks()
+        self.assertEqual([(1, 1), (1, 2), (4, 6), (4, 6), (4, 10)], self.action.batches)
+        self.assertEqual(list(range(10)), sorted(ContinuationFanInResult.get_by_key_name('test').values))
+
+    def test_no_target(self):
+        self.context['batchsize'] = 3
+        self.context.initialize() # queues the first task
+        runQueuedTasks()
+        self.assertEqual([(3, 3), (3, 6), (3, 9), (1, 10)], self.action.batches)
+
+    def test_slow_batches(self):
+        self.context['target'] = 1.0
+        self.context.currentState = self.context.initialState
+        getLockBackend().set(self.action._getBatchTimeKey(self.context), 0.5)
+        self.assertEqual(1, self.action._getBatchSize(self.context, {RETRY_COUNT_PARAM: 0}))
+        self.assertEqual(2, self.context[CONTINUATION_BATCH_SIZE_PARAM])
+        self.assertEqual(2, self.action._getBatchSize(self.context, {RETRY_COUNT_PARAM: 0}))
+
+    def test_retry_does_not_resize_batch(self):
+        self.context['target'] = 1.0
+        self.context.currentState = self.context.initialState
+        self.context[CONTINUATION_BATCH_SIZE_PARAM] = 3
+        getLockBackend().set(self.action._getBatchTimeKey(self.context), 0.5)
+        self.assertEqual(3, self.action._getBatchSize(self.context.clone(), {RETRY_COUNT_PARAM: 0}))
+        self.assertEqual(3, self.action._getBatchSize(self.context.clone(), {RETRY_COUNT_PARAM: 1}))
+        self.assertEqual(3, self.action._getBatchSize(self.context.clone(), {RETRY_COUNT_PARAM: 5}))
+
+    def test_retry_shrinks_next_batch(self):
+        self.context['target'] = 1.0
+        self.context.currentState = self.context.initialState
+        self.context[CONTINUATION_BATCH_SIZE_PARAM] = 4
+        getLockBackend().set(self.action._getBatchTimeKey(self.context), 0.25)
+        context = self.context.clone()
+        self.assertEqual(4, self.action._getBatchSize(context, {RETRY_COUNT_PARAM: 0}))
+        self.assertEqual(4, context[CONTINUATION_BATCH_SIZE_PARAM])
+
+        # the first attempt never recorded its time, e.g., it was killed by the deadline
+        context = self.context.clone()
+        self.assertEqual(4, self.action._getBatchSize(context, {RETRY_COUNT_PARAM: 1}))
+        self.assertEqual(2, context[CONTINUATION_BATCH_SIZE_PARAM])
+        self.assertEqual(0.5, getLockBackend().get(self.action._getBatchTimeKey(self.context)))
+
+        # a slower recorded time is kept
+        getLockBackend().set(self.action._getBatchTimeKey(self.context), 1.0)
+        context = self.context.clone()
+        self.assertEqual(4, self.action._getBatchSize(context, {RETRY_COUNT_PARAM: 1}))
+        self.assertEqual(1, context[CONTINUATION_BATCH_SIZE_PARAM])
+
+    def test_recordBatchTime(self):
+        self.context['target'] = 1.0
+        self.context.currentState = self.context.initialState
+        obj = {RETRY_COUNT_PARAM: 0}
+        self.action._getBatchSize(self.context, obj)
+        obj[CONTINUATION_RESULTS_KEY] = [1, 2]
+        self.action.recordBatchTime(self.context, obj)
+        self.assertTrue(getLockBackend().get(self.action._getBatchTimeKey(self.context)) is not None)
+
+class AdaptiveDatastoreBatchSizeTest( BaseTest ):
+    """
+    Tests getTargetBatchTime() with a datastore continuation
+    """
+    MACHINE_NAME = 'AdaptiveDatastoreFanInMachine'
+    EVENT = 'ok'
+
+    def setUp(self):
+        super().setUp()
+        self.action = self.currentConfig.machines[self.MACHINE_NAME].states['InitialState'].action
+
+    def test_retry_keeps_batch(self):
+        self.context['target'] = 10.0
+        self.action.failat = 6
+        self.context.initialize() # queues the first task
+        runQueuedTasks()
+        self.assertEqual([(1, 1), (1, 2), (4, 6), (4, 6), (4, 10)], self.action.batches)
+        self.assertEqual(list(range(10)), sorted(ContinuationFanInResult.get_by_key_name('test').values))
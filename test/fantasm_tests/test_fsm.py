@@ -12,6 +12,8 @@ import urllib.request
 
 from fantasm_tests.actions import (CountExecuteCalls,
                                    CountExecuteCallsWithFork,
+                                   ForkFiveCounters,
+                                   SumCountersCombiner,
                                    RaiseExceptionAction,
                                    RaiseExceptionContinuationAction)
 from fantasm_tests.fixtures import AppEngineTestCase
@@ -21,27 +23,32 @@ from fantasm_tests.helpers import (ConfigurationMock, TaskQueueDouble,
                                    setUpByFilename)
 from google.appengine.api import memcache  # pylint: disable=W0611
 from google.appengine.api.taskqueue.taskqueue import (  # pylint: disable=W0611
-    Queue, Task)
+    Queue, Task, TaskAlreadyExistsError)
 from google.appengine.ext import db
 from google.appengine.ext.ndb import key as ndb_key
 from google.appengine.ext.ndb import model as ndb_model
 from minimock import mock, restore
 
-from fantasm import config
-from fantasm.constants import (CONTINUATION_PARAM, CONTINUATION_RESULTS_KEY,
-                               EVENT_PARAM, FORK_PARAM, FORKED_CONTEXTS_PARAM,
+from fantasm import config, constants
+from fantasm.constants import (CONTEXT_BLOBS_PARAM, CONTINUATION_PARAM, CONTINUATION_RESULTS_KEY,
+                               DEFAULT_FAN_IN_ENTITY_GROUPS, EVENT_PARAM, FAN_IN_CURSOR_PARAM,
+                               FAN_IN_READ_LOCK_MAX_WAITS,
+                               FAN_IN_READ_LOCK_WAIT_PARAM, FORK_PARAM, FORK_STREAM_PARAM, FORKED_CONTEXTS_PARAM,
                                GEN_PARAM, HTTP_REQUEST_HEADER_QUEUENAME,
                                INDEX_PARAM, INSTANCE_NAME_PARAM,
                                MACHINE_STATES_ATTRIBUTE, RETRY_COUNT_PARAM,
-                               STATE_PARAM, STEPS_PARAM, TASK_NAME_PARAM)
-from fantasm.exceptions import (FanInWriteLockFailureRuntimeError,
+                               STATE_PARAM, STEPS_PARAM, TASK_NAME_PARAM, TERMINATED_PARAM)
+from fantasm.exceptions import (FanInWriteLockFailureRuntimeError, InvalidFanInExpectedRuntimeError,
                                 UnknownEventError, UnknownMachineError,
                                 UnknownStateError, YamlFileCircularImportError)
 from fantasm.fsm import FSM, FSMContext, startStateMachine
 from fantasm.handlers import TemporaryStateObject
-from fantasm.models import _FantasmFanIn
+from fantasm.lock import FanInArrivals, FanInCleanupBucket, ReadWriteLock, RunOnceSemaphore
+from fantasm.models import (ContextBlobReference, _FantasmContextBlob, _FantasmFanIn, _FantasmInstance,
+                            _FantasmTaskSemaphore)
 from fantasm.state import State
 from fantasm.transition import Transition
+from fantasm.utils import _NoOpRPC
 
 # pylint: disable=C0111, W0212, W0612, W0613
 # - docstrings not reqd in unit tests
@@ -106,6 +113,7 @@ class FSMContextTests(unittest.TestCase):
         self.machineName = getMachineNameByFilename(filename)
         self.mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
         # dispatch initial event to get context in correct state
         self.taskName = 'foo'
         self.obj = {TASK_NAME_PARAM: self.taskName}
@@ -187,6 +195,79 @@ class FSMContextTests(unittest.TestCase):
         self.assertEqual({'foo': 'bar'}, clone)
         self.assertNotEqual(self.context.instanceName, clone.instanceName)
 
+    def test_clone_is_copy_on_write(self):
+        self.context['list'] = [1, 2]
+        clone1 = self.context.clone()
+        clone2 = self.context.clone()
+        clone1['list'].append(3)
+        self.assertEqual([1, 2, 3], clone1['list'])
+        self.assertEqual([1, 2], clone2['list'])
+        self.assertEqual([1, 2], self.context['list'])
+
+    def test_clone_items_are_copies(self):
+        self.context['list'] = [1, 2]
+        clone1 = self.context.clone()
+        clone2 = self.context.clone()
+        for key, value in clone1.items():
+            if key == 'list':
+                value.append(3)
+        self.assertEqual([1, 2], clone2['list'])
+        self.assertEqual([1, 2, 3], clone1.pop('list'))
+        self.assertEqual([1, 2], clone2.pop('list'))
+
+    def test_clone_shares_snapshot(self):
+        self.context['list'] = [1, 2]
+        values = dict.__getitem__(self.context, 'list')
+        clone = self.context.clone()
+        self.assertFalse(dict.__getitem__(clone, 'list') is values)
+        self.assertTrue(dict.__getitem__(clone, 'list') is dict.__getitem__(self.context, 'list'))
+        self.assertTrue(dict.__getitem__(self.context.clone(), 'list') is dict.__getitem__(clone, 'list'))
+        grandchild1 = clone.clone()
+        grandchild2 = clone.clone()
+        self.assertTrue(dict.__getitem__(grandchild1, 'list') is dict.__getitem__(grandchild2, 'list'))
+        self.assertTrue(dict.__getitem__(grandchild1, 'list') is dict.__getitem__(clone, 'list'))
+        grandchild1['list'].append(3)
+        self.assertEqual([1, 2], grandchild2['list'])
+        self.assertEqual([1, 2], clone['list'])
+
+    def test_clone_ignores_mutation_through_held_reference(self):
+        values = [1, 2]
+        self.context['list'] = values
+        clone1 = self.context.clone()
+        values.append(3)
+        clone2 = self.context.clone()
+        self.assertEqual([1, 2], clone1['list'])
+        self.assertEqual([1, 2], clone2['list'])
+        self.assertEqual([1, 2], self.context['list'])
+
+    def test_clone_ignores_mutation_through_read_reference(self):
+        self.context['list'] = [1, 2]
+        values = self.context['list']
+        clone1 = self.context.clone()
+        values.append(3)
+        clone2 = self.context.clone()
+        self.assertEqual([1, 2], clone1['list'])
+        self.assertEqual([1, 2], clone2['list'])
+        self.assertEqual([1, 2], self.context['list'])
+
+    def test_clone_sees_parent_mutation_in_place(self):
+        self.context['list'] = [1, 2]
+        clone1 = self.context.clone()
+        self.context['list'].append(3)
+        clone2 = self.context.clone()
+        self.assertEqual([1, 2], clone1['list'])
+        self.assertEqual([1, 2, 3], clone2['list'])
+
+    def test_clone_of_clone(self):
+        self.context['dict'] = {'a': [1]}
+        clone = self.context.clone()
+        grandchild = clone.clone(updateData={'b': 2})
+        grandchild['dict']['a'].append(2)
+        self.assertEqual({'a': [1]}, clone['dict'])
+        self.assertEqual({'a': [1, 2]}, grandchild['dict'])
+        self.assertEqual(2, grandchild['b'])
+        self.assertFalse('b' in clone)
+
     def test_fork(self):
         self.context.fork()
         self.assertTrue(FORKED_CONTEXTS_PARAM in self.obj)
@@ -197,8 +278,101 @@ class FSMContextTests(unittest.TestCase):
         self.assertEqual(self.obj[FORKED_CONTEXTS_PARAM][0][FORK_PARAM], 0)
         self.assertEqual(self.obj[FORKED_CONTEXTS_PARAM][1][FORK_PARAM], 1)
 
+    def test_fork_nextEvent_queues_in_batches(self):
+        self.mockQueue.purge()
+        for i in range(250):
+            self.context.fork(data={'i': i}, nextEvent='next-event')
+        self.assertEqual(200, len(self.mockQueue.tasks))
+        self.assertEqual([], self.obj[FORKED_CONTEXTS_PARAM])
+        stream = self.obj[FORK_STREAM_PARAM]
+        self.assertEqual(250, stream.count)
+        stream.flush()
+        self.assertEqual(250, len(self.mockQueue.tasks))
+        self.assertEqual(250, len(set(task.name for (task, _) in self.mockQueue.tasks)))
+
+    def test_fork_nextEvent_retry_is_idempotent(self):
+        for i in range(200):
+            self.context.fork(nextEvent='next-event')
+        self.obj.pop(FORK_STREAM_PARAM).flush()
+        self.mockQueue.purge()
+        # the retry produces the same Task names, in the same batches
+        for i in range(250):
+            self.context.fork(nextEvent='next-event')
+        self.obj.pop(FORK_STREAM_PARAM).flush()
+        self.assertEqual(50, len(self.mockQueue.tasks))
+
+    def test_fork_nextEvent_flushed_by_dispatch(self):
+        self.mockQueue.purge()
+        def execute(context, obj):
+            for i in range(3):
+                context.fork(data={'i': i}, nextEvent='next-event')
+            return 'next-event'
+        mock('CountExecuteCallsWithFork.execute', returns_func=execute, tracker=None)
+        self.context.dispatch('next-event', self.obj)
+        self.assertFalse(FORK_STREAM_PARAM in self.obj)
+        self.assertEqual(['fork-1', 'fork-2'],
+                         [task.name.split('--')[1] for (task, _) in self.mockQueue.tasks if 'fork' in task.name])
+
+class FSMContextFanInCombinerTests(AppEngineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.mockQueue = TaskQueueDouble()
+        mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
+        self.initialState = State('initial', None, None, None)
+        self.forkState = State('fork', None, ForkFiveCounters(), None)
+        self.fanInState = State('fan-in', None, CountExecuteCalls(), None, fanInPeriod=5,
+                                fanInCombiner=SumCountersCombiner())
+        self.initialState.addTransition(Transition('t1', self.forkState, queueName='q'), 'event')
+        self.forkState.addTransition(Transition('t2', self.fanInState, queueName='q'), 'next-event')
+        self.obj = {TASK_NAME_PARAM: 'taskName', RETRY_COUNT_PARAM: 0}
+        self.context = FSMContext(self.initialState,
+                                  currentState=self.initialState,
+                                  machineName='machineName',
+                                  instanceName='instanceName',
+                                  queueName='q',
+                                  url='/fantasm/fsm/machineName/',
+                                  obj=self.obj)
+        self.context['counter'] = 1
+
+    def tearDown(self):
+        super().tearDown()
+        restore()
+
+    def getCounters(self):
+        return sorted(work.context['counter'] for work in _FantasmFanIn.all(namespace=''))
+
+    def test_forks_are_combined(self):
+        self.context.dispatch('event', self.obj)
+        self.assertEqual([1, 5], self.getCounters()) # the forks, and the forking context itself
+
+    def test_forks_are_combined_per_fan_in_group(self):
+        self.fanInState.fanInGroup = 'group'
+        self.forkState.addTransition(Transition('t2', self.fanInState, queueName='q'), 'next-event')
+        self.context['group'] = 0
+        self.context.dispatch('event', self.obj)
+        self.assertEqual([1, 2, 3], self.getCounters())
+
+    def test_streamed_forks_are_combined(self):
+        def execute(context, obj):
+            for i in range(5):
+                context.fork(data={'counter': 1}, nextEvent='next-event')
+            context[FORK_PARAM] = -1
+            return 'next-event'
+        mock('ForkFiveCounters.execute', returns_func=execute, tracker=None)
+        self.context.dispatch('event', self.obj)
+        self.assertEqual([1, 5], self.getCounters())
+
+    def test_no_combiner(self):
+        self.fanInState.fanInCombiner = None
+        self.context.dispatch('event', self.obj)
+        self.assertEqual([1] * 6, self.getCounters())
+
 class FSMContextMergeJoinTests(AppEngineTestCase):
 
+    WORK_INDEX = 'instanceName--foo--event--foo2--step-0-2654435761'
+
     def setUp(self):
         super().setUp()
         self.state = State('foo', None, CountExecuteCalls(), None)
@@ -216,8 +390,16 @@ class FSMContextMergeJoinTests(AppEngineTestCase):
         self.context[INDEX_PARAM] = 1
         self.context[STEPS_PARAM] = 0
 
+    def tearDown(self):
+        super().tearDown()
+        restore()
+
+    def putWork(self, keyName, context=None, entityGroups=DEFAULT_FAN_IN_ENTITY_GROUPS):
+        _FantasmFanIn(key=_FantasmFanIn.buildKey(self.WORK_INDEX, keyName, entityGroups=entityGroups),
+                      workIndex=self.WORK_INDEX, context=context).put()
+
     def test_mergeJoinDispatch_1_context(self):
-        _FantasmFanIn(workIndex='instanceName--foo--event--foo2--step-0-2654435761').put()
+        self.putWork('taskName')
         self.assertEqual(1, _FantasmFanIn.all(namespace='').count())
         contexts = self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
         self.assertEqual([{'__ix__': 1, '__step__': 0}], contexts)
@@ -225,13 +407,357 @@ class FSMContextMergeJoinTests(AppEngineTestCase):
 
     def test_mergeJoinDispatch_1234_contexts(self):
         for i in range(1234):
-            _FantasmFanIn(workIndex='instanceName--foo--event--foo2--step-0-2654435761').put()
+            self.putWork('taskName-%d' % i)
         self.assertEqual(1000, _FantasmFanIn.all(namespace='').count()) # can't get them all with .count()
         contexts = self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
         self.assertEqual(1234, len(contexts))
         self.assertEqual(1000, _FantasmFanIn.all(namespace='').count())
 
+    def test_mergeJoinDispatch_key_name_order_across_entity_groups(self):
+        for i in reversed(range(50)):
+            self.putWork('taskName-%02d' % i, context={'i': i})
+        self.assertTrue(len(set(work.parent_key() for work in _FantasmFanIn.all(namespace=''))) > 1)
+        contexts = self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
+        self.assertEqual(list(range(50)), [context['i'] for context in contexts])
+
+    def test_mergeJoinDispatch_does_not_sleep(self):
+        mock('time.sleep', raises=AssertionError('slept'), tracker=None)
+        self.putWork('taskName')
+        self.assertEqual(1, len(self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})))
+
+    def test_mergeJoinDispatch_is_read_once(self):
+        for i in range(10):
+            self.putWork('taskName-%d' % i, context={'i': i})
+        contexts = self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
+        self.assertTrue(isinstance(contexts, list))
+        self.assertEqual(0, list.__len__(contexts)) # nothing is read until the list is used
+        self.assertTrue(contexts)
+        self.assertEqual(10, list.__len__(contexts))
+        for context in contexts:
+            context['j'] = context['i'] * 2
+        mock('_FantasmFanIn.fetchWorkIndex', raises=AssertionError('read the datastore'), tracker=None)
+        self.assertEqual([i * 2 for i in range(10)], [context['j'] for context in contexts])
+        self.assertEqual(10, len(contexts))
+        self.assertTrue(contexts[3] is list(contexts)[3])
+
+    def test_mergeJoinDispatch_fanInMaxContexts_is_lazy(self):
+        self.state2.fanInMaxContexts = 20
+        for i in range(10):
+            self.putWork('taskName-%d' % i, context={'i': i})
+        contexts = self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
+        self.assertTrue(contexts)
+        self.assertEqual(list(range(10)), [context['i'] for context in contexts])
+        self.assertEqual(0, list.__len__(contexts)) # iterating did not hold on to the contexts
+        self.assertEqual(10, len(contexts))
+        self.assertEqual(10, list.__len__(contexts))
+
+    def test_mergeJoinDispatch_fanInMaxContexts(self):
+        self.state2.fanInMaxContexts = 4
+        for i in range(10):
+            self.putWork('taskName-%d' % i, context={'i': i})
+        contexts = self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
+        self.assertEqual([0, 1, 2, 3], [context['i'] for context in contexts])
+        self.assertEqual('taskName-3', contexts.nextCursor)
+        self.context[FAN_IN_CURSOR_PARAM] = 'taskName-7'
+        contexts = self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
+        self.assertEqual([8, 9], [context['i'] for context in contexts])
+        self.assertEqual(None, contexts.nextCursor)
 
+    def test_mergeJoinDispatch_fanInReadLockCountdown(self):
+        mockQueue = TaskQueueDouble()
+        mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock('time.sleep', raises=AssertionError('slept'), tracker=None)
+        self.state2.fanInReadLockCountdown = 2
+        self.context.startingEvent = 'event'
+        self.state.getTransition('event').retryOptions = self.context.retryOptions
+        self.context.url = '/fantasm/fsm/machineName/'
+        self.putWork('taskName')
+        rwlock = ReadWriteLock(self.context.getTaskName('event', fanIn=True), self.context)
+        rwlock.acquireWriteLock(1) # a writer is still in flight
+
+        obj = {RETRY_COUNT_PARAM: 0}
+        contexts = self.context.mergeJoinDispatch('event', obj)
+        self.assertTrue(obj[TERMINATED_PARAM])
+        self.assertEqual([], contexts)
+        self.assertEqual(['instanceName--work-index-1--read-lock-wait-1--foo--event--foo2--step-0'],
+                         [task.name for (task, _) in mockQueue.tasks])
+
+        # the re-queued Task finds the writer done
+        rwlock.releaseWriteLock(1)
+        self.context[FAN_IN_READ_LOCK_WAIT_PARAM] = 1
+        obj = {RETRY_COUNT_PARAM: 0}
+        contexts = self.context.mergeJoinDispatch('event', obj)
+        self.assertFalse(obj.get(TERMINATED_PARAM))
+        self.assertEqual(1, len(contexts))
+
+    def test_mergeJoinDispatch_fanInReadLockCountdown_gives_up(self):
+        self.state2.fanInReadLockCountdown = 2
+        self.putWork('taskName')
+        rwlock = ReadWriteLock(self.context.getTaskName('event', fanIn=True), self.context)
+        rwlock.acquireWriteLock(1)
+        rwlock.closeWriteLock(1)
+        self.context[FAN_IN_READ_LOCK_WAIT_PARAM] = FAN_IN_READ_LOCK_MAX_WAITS
+        obj = {RETRY_COUNT_PARAM: 0}
+        self.assertEqual(1, len(self.context.mergeJoinDispatch('event', obj)))
+        self.assertFalse(obj.get(TERMINATED_PARAM))
+
+    def test_fetchWorkIndex_keysOnly(self):
+        self.putWork('taskName-1')
+        self.putWork('taskName-2')
+        self.assertEqual([_FantasmFanIn.buildKey(self.WORK_INDEX, 'taskName-1'),
+                          _FantasmFanIn.buildKey(self.WORK_INDEX, 'taskName-2')],
+                         list(_FantasmFanIn.fetchWorkIndex(self.WORK_INDEX, keysOnly=True)))
+
+    def test_fetchWorkIndex_entityGroups(self):
+        for i in range(4):
+            self.putWork('taskName-%d' % i, entityGroups=1)
+        self.assertEqual(1, len(set(work.key().parent() for work in _FantasmFanIn.all(namespace=''))))
+        self.assertEqual(4, len(list(_FantasmFanIn.fetchWorkIndex(self.WORK_INDEX, entityGroups=1))))
+        self.state2.fanInEntityGroups = 1
+        self.assertEqual(4, len(self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})))
+
+    def test_fetchWorkIndex_root_work_packages(self):
+        # written by an earlier version, without a parent key
+        _FantasmFanIn(key_name='taskName-1', workIndex=self.WORK_INDEX, namespace='').put()
+        _FantasmFanIn(key_name='taskName-3', workIndex='other', namespace='').put()
+        self.putWork('taskName-0')
+        self.putWork('taskName-2')
+        self.assertEqual(['taskName-0', 'taskName-1', 'taskName-2'],
+                         [key.name() for key in _FantasmFanIn.fetchWorkIndex(self.WORK_INDEX, keysOnly=True)])
+        self.assertEqual(['taskName-2'],
+                         [work.key().name() for work in _FantasmFanIn.fetchWorkIndex(self.WORK_INDEX,
+                                                                                     startAfter='taskName-1')])
+        self.assertEqual([self.WORK_INDEX], _FantasmFanIn.deleteWorkIndexes([self.WORK_INDEX], 2, 1))
+        self.assertEqual([], _FantasmFanIn.deleteWorkIndexes([self.WORK_INDEX], 2, 1))
+        self.assertEqual(['other'], [work.workIndex for work in _FantasmFanIn.all(namespace='')])
+
+    def test_fetchWorkIndex_root_work_packages_off(self):
+        mock('constants.FAN_IN_READ_ROOT_WORK_PACKAGES', mock_obj=False, tracker=None)
+        _FantasmFanIn(key_name='taskName-1', workIndex=self.WORK_INDEX, namespace='').put()
+        self.putWork('taskName-0')
+        self.assertEqual(['taskName-0'],
+                         [key.name() for key in _FantasmFanIn.fetchWorkIndex(self.WORK_INDEX, keysOnly=True)])
+
+    def test_mergeJoinDispatch_fanInExpected_claim(self):
+        self.state2.fanInExpected = 1
+        self.putWork('taskName')
+        obj = {RETRY_COUNT_PARAM: 0}
+        self.assertEqual(1, len(self.context.mergeJoinDispatch('event', obj)))
+        self.assertFalse(obj.get(TERMINATED_PARAM))
+
+        # the Task queued for the end of the fan_in period finds the fan-in claimed
+        self.context._FSMContext__obj = {TASK_NAME_PARAM: 'taskName-period'}
+        obj = {RETRY_COUNT_PARAM: 0}
+        contexts = self.context.mergeJoinDispatch('event', obj)
+        self.assertTrue(obj[TERMINATED_PARAM])
+        self.assertEqual([], contexts)
+        self.assertTrue(contexts.guarded)
+
+    def test_mergeJoinDispatch_fanInExpected_claim_evicted(self):
+        self.state2.fanInExpected = 1
+        self.putWork('taskName')
+        self.assertEqual(1, len(self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})))
+        RunOnceSemaphore(self.WORK_INDEX, None).writeRunOnceSemaphore(payload='taskName') # see State.dispatch()
+        memcache.flush_all()
+
+        # the Task queued for the end of the fan_in period finds the semaphore of the fan-in in the datastore
+        self.context._FSMContext__obj = {TASK_NAME_PARAM: 'taskName-period'}
+        obj = {RETRY_COUNT_PARAM: 0}
+        contexts = self.context.mergeJoinDispatch('event', obj)
+        self.assertFalse(obj.get(TERMINATED_PARAM))
+        self.assertEqual([], contexts)
+        self.assertTrue(contexts.guarded)
+
+    def test_getFanInExpected_context_key(self):
+        self.state2.fanInExpected = 'num-items'
+        self.assertEqual(None, self.context._getFanInExpected(self.state2))
+        self.context['num-items'] = '12'
+        self.assertEqual(12, self.context._getFanInExpected(self.state2))
+        self.context['num-items'] = 'twelve'
+        self.assertRaises(InvalidFanInExpectedRuntimeError, self.context._getFanInExpected, self.state2)
+
+    def test_mergeJoinDispatch_fanInAdaptive(self):
+        self.state2.fanInAdaptive = True
+        self.state2.fanInPeriod = 30
+        self.assertEqual(30, self.context._getAdaptiveFanInPeriod('event', 30))
+        self.putWork('taskName')
+        arrivals = FanInArrivals(self.WORK_INDEX)
+        arrivals.recordSpan(1000.0)
+        arrivals.recordSpan(1003.5)
+        arrivals.recordSpan(1001.0)
+        self.assertEqual(3, arrivals.span())
+        self.context.mergeJoinDispatch('event', {RETRY_COUNT_PARAM: 0})
+        self.assertEqual(6, self.context._getAdaptiveFanInPeriod('event', 30))
+        self.assertEqual(5, self.context._getAdaptiveFanInPeriod('event', 5))
+
+    def test_deleteWorkIndexes_batches(self):
+        for i in range(5):
+            self.putWork('taskName-%d' % i)
+        self.assertEqual([self.WORK_INDEX, 'other'],
+                         _FantasmFanIn.deleteWorkIndexes([self.WORK_INDEX, 'other'], 2, 2))
+        self.assertEqual(1, _FantasmFanIn.all(namespace='').count())
+        self.assertEqual([], _FantasmFanIn.deleteWorkIndexes([self.WORK_INDEX, 'other'], 2, 2))
+        self.assertEqual(0, _FantasmFanIn.all(namespace='').count())
+
+    def test_queueFanInCleanup(self):
+        mockQueue = TaskQueueDouble()
+        mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        self.context._FSMContext__obj = {TASK_NAME_PARAM: 'taskName', RETRY_COUNT_PARAM: 0}
+        self.context._queueFanInCleanup('workIndex-1', self.state2)
+        self.context._queueFanInCleanup('workIndex-2', self.state2)
+        self.assertEqual(['taskName-cleanup'], [task.name for (task, _) in mockQueue.tasks])
+
+    def test_queueFanInCleanup_fanInCleanupPeriod(self):
+        mockQueue = TaskQueueDouble()
+        mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock('time.time', returns=6000.0, tracker=None)
+        self.state2.fanInCleanupPeriod = 60
+        self.context._FSMContext__obj = {TASK_NAME_PARAM: 'taskName', RETRY_COUNT_PARAM: 0}
+        for i in range(3):
+            self.context._queueFanInCleanup('workIndex-%d' % i, self.state2)
+        self.assertEqual(['fantasm-cleanup-machineName-foo2-100'], [task.name for (task, _) in mockQueue.tasks])
+        self.assertEqual('__fcb__=fantasm-cleanup-machineName-foo2-100&__feg__=8', mockQueue.tasks[0][0].payload)
+        self.assertEqual(['workIndex-0', 'workIndex-1', 'workIndex-2'],
+                         FanInCleanupBucket('fantasm-cleanup-machineName-foo2-100').workIndexes())
+
+
+
+class FSMContextOffloadTests(AppEngineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.state = State('foo', None, CountExecuteCalls(), None)
+        self.state2 = State('foo2', None, CountExecuteCalls(), None)
+        self.state.addTransition(Transition('t1', self.state2, queueName='q'), 'event')
+        self.context = FSMContext(self.state, currentState=self.state, machineName='machineName',
+                                  instanceName='instanceName', queueName='q', offloadThreshold=100)
+        self.context[STEPS_PARAM] = 0
+        self.context['big'] = 'x' * 1000
+        self.context['small'] = 'y'
+
+    def _digest(self, key='big'):
+        return json.loads(self.context.buildParams(self.state, 'event')[CONTEXT_BLOBS_PARAM])[key][0]
+
+    def test_buildParams_offloads_large_values(self):
+        params = self.context.buildParams(self.state, 'event')
+        self.assertFalse('big' in params)
+        self.assertEqual(['big'], list(json.loads(params[CONTEXT_BLOBS_PARAM])))
+        self.assertEqual('y', params['small'])
+        self.assertEqual(1, _FantasmContextBlob.all(namespace='').count())
+
+    def test_buildParams_no_offloaded_values(self):
+        del self.context['big']
+        self.assertFalse(CONTEXT_BLOBS_PARAM in self.context.buildParams(self.state, 'event'))
+
+    def test_clones_write_blob_once(self):
+        puts = []
+        mock('_FantasmContextBlob.put', returns_func=lambda: puts.append(1), tracker=None)
+        try:
+            clones = [self.context.clone() for i in range(10)]
+            for clone in clones:
+                self.assertTrue(clone._offloadedDigests is self.context._offloadedDigests)
+                clone.buildParams(self.state, 'event')
+            self.assertEqual(1, len(puts))
+        finally:
+            restore()
+
+    def test_clones_pickle_shared_value_once(self):
+        del self.context['big']
+        self.context['big_list'] = list(range(1000))
+        parent = self.context.clone() # shares nothing it could have handed out, so its clones share a snapshot
+        dumps = []
+        pickleDumps = pickle.dumps
+        mock('pickle.dumps', returns_func=lambda *args, **kwargs: dumps.append(1) or pickleDumps(*args, **kwargs),
+             tracker=None)
+        try:
+            for i in range(10):
+                parent.clone().buildParams(self.state, 'event')
+            self.assertEqual(1, len(dumps))
+        finally:
+            restore()
+
+    def test_clones_pickle_value_read_by_caller_again(self):
+        del self.context['big']
+        self.context['big_list'] = list(range(1000))
+        parent = self.context.clone()
+        digest = json.loads(parent.clone().buildParams(self.state, 'event')[CONTEXT_BLOBS_PARAM])['big_list'][0]
+        parent['big_list'].append(1000) # handed out, so no longer shared
+        params = parent.clone().buildParams(self.state, 'event')
+        self.assertNotEqual(digest, json.loads(params[CONTEXT_BLOBS_PARAM])['big_list'][0])
+
+    def test_reference_resolved_on_read(self):
+        self.context['big'] = ContextBlobReference(self._digest())
+        self.assertEqual('x' * 1000, self.context.get('big'))
+        self.assertEqual('x' * 1000, dict.__getitem__(self.context, 'big'))
+
+    def test_reference_resolved_on_pop(self):
+        self.context['big'] = ContextBlobReference(self._digest())
+        self.assertEqual('x' * 1000, self.context.pop('big'))
+
+    def test_reference_resolved_by_items(self):
+        self.context['big'] = ContextBlobReference(self._digest())
+        self.assertEqual('x' * 1000, dict(self.context.items())['big'])
+
+    def test_reference_resolved_by_values(self):
+        self.context['big'] = ContextBlobReference(self._digest())
+        self.assertTrue('x' * 1000 in list(self.context.values()))
+
+    def test_shared_reference_resolved_by_items(self):
+        self.context['big'] = ContextBlobReference(self._digest())
+        clone = self.context.clone().clone()
+        self.assertEqual('x' * 1000, dict(clone.items())['big'])
+        self.assertEqual(ContextBlobReference, dict.__getitem__(self.context, 'big').__class__)
+
+    def test_unread_reference_passes_through(self):
+        self.context['big'] = ContextBlobReference('abc', storedAt=time.time())
+        params = self.context.buildParams(self.state, 'event')
+        self.assertEqual('abc', json.loads(params[CONTEXT_BLOBS_PARAM])['big'][0])
+        self.assertEqual(0, _FantasmContextBlob.all(namespace='').count())
+
+    def test_user_value_is_not_a_reference(self):
+        self.context['small'] = '__fantasm-blob__:abc'
+        params = self.context.buildParams(self.state, 'event')
+        self.assertEqual('__fantasm-blob__:abc', params['small'])
+        self.assertEqual(['big'], list(json.loads(params[CONTEXT_BLOBS_PARAM])))
+
+    def _ageBlob(self, digest):
+        blob = _FantasmContextBlob.get_by_key_name(digest)
+        blob.createdTime = datetime.datetime(2000, 1, 1)
+        blob.put()
+
+    def test_storing_again_refreshes_createdTime(self):
+        digest = self._digest()
+        self._ageBlob(digest)
+        self.context._offloadedDigests = set() # i.e., another request
+        self.context._offloadedReferences = {}
+        self.assertEqual(digest, self._digest())
+        self.assertTrue(_FantasmContextBlob.get_by_key_name(digest).createdTime > datetime.datetime(2000, 1, 1))
+
+    def test_stale_unread_reference_refreshes_createdTime(self):
+        digest = self._digest()
+        self._ageBlob(digest)
+        self.context._offloadedDigests = set() # i.e., another request
+        self.context['big'] = ContextBlobReference(digest, storedAt=time.time() - 2 * 24 * 60 * 60)
+        puts = []
+        mock('_FantasmContextBlob.put', returns_func=lambda: puts.append(1), tracker=None)
+        try:
+            for i in range(10):
+                self.context.clone().buildParams(self.state, 'event')
+            self.assertEqual(1, len(puts))
+        finally:
+            restore()
+        self.context._offloadedDigests = set()
+        self.context['big'] = ContextBlobReference(digest, storedAt=time.time() - 2 * 24 * 60 * 60)
+        self.context.clone().buildParams(self.state, 'event')
+        self.assertTrue(_FantasmContextBlob.get_by_key_name(digest).createdTime > datetime.datetime(2000, 1, 1))
+
+    def test_fresh_unread_reference_keeps_createdTime(self):
+        digest = self._digest()
+        self._ageBlob(digest)
+        self.context._offloadedDigests = set()
+        self.context['big'] = ContextBlobReference(digest, storedAt=time.time())
+        self.context.buildParams(self.state, 'event')
+        self.assertEqual(datetime.datetime(2000, 1, 1), _FantasmContextBlob.get_by_key_name(digest).createdTime)
 
 class TaskQueueFSMTests(AppEngineTestCase):
 
@@ -277,6 +803,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
     def test_initialDispatchEmitsEventAsTask(self):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         event = self.context.initialize()
         self.assertEqual(len(mockQueue.tasks), 1)
@@ -302,6 +829,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
     def test_normalStateDispatchWithEventEmitsEventAsTask(self):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         self.context.currentState = self.stateInitial
         self.context.dispatch('next-event', {})
@@ -315,6 +843,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
         import time
         mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         self.context.currentState = self.stateInitial
         self.context.dispatch('next-event', {})
@@ -335,6 +864,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
     def test_finalStateDispatchWithEventEmitsNoEventAsTask(self):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         self.context.currentState = self.stateNormal
         self.context.dispatch('next-event', {})
@@ -364,6 +894,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
     def test_instanceNameIsPropagated(self):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         event = self.context.initialize()
         self.context.dispatch(event, {})
@@ -385,10 +916,26 @@ class TaskQueueFSMTests(AppEngineTestCase):
         self.assertEqual('instanceName--state-initial--next-event--state-normal--step-123',
                          self.context.getTaskName('next-event'))
 
+    def test_getDispatchPlan(self):
+        plan = self.stateInitial.getDispatchPlan('next-event')
+        self.assertTrue(plan.transition is self.transInitialToNormal)
+        self.assertEqual('state-initial/next-event/state-normal/', plan.path)
+        self.assertEqual('state-initial--next-event--state-normal', plan.taskNameSuffix)
+        self.assertFalse(plan.isFanIn)
+        self.assertTrue(plan is self.stateInitial.getDispatchPlan('next-event'))
+
+    def test_getDispatchPlan_unknownEvent(self):
+        self.assertRaises(UnknownEventError, self.stateInitial.getDispatchPlan, 'bad-event')
+
+    def test_buildUrl(self):
+        self.assertEqual(self.context.url + 'state-initial/next-event/state-normal/',
+                         self.context.buildUrl(self.stateInitial, 'next-event'))
+
     def test_taskQueueOnQueueSpecifiedAtTransitionLevel(self):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.__init__', returns_func=mockQueue.__init__, tracker=None)
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         self.transNormalToFinal.queueName = 'fantasm-queue' # should be this one (dest state)
         self.transInitialToNormal.queueName = 'barfoo'
@@ -403,6 +950,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.__init__', returns_func=mockQueue.__init__, tracker=None)
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         self.transNormalToFinal.taskTarget = 'correct-target' # should be this one (dest state)
         self.transInitialToNormal.taskTarget = 'other-target'
@@ -417,6 +965,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.__init__', returns_func=mockQueue.__init__, tracker=None)
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
         self.transNormalToFinal.queueName = 'fantasm-queue' # this is what we'll override
         self.context.currentState = self.stateInitial
         alternateQueue = 'some-other-queue'
@@ -428,6 +977,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.__init__', returns_func=mockQueue.__init__, tracker=None)
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
         self.transNormalToFinal.queueName = 'fantasm-queue' # this is what we'll override
         self.context.currentState = self.stateInitial
         alternateQueue = 'some-other-queue'
@@ -439,6 +989,7 @@ class TaskQueueFSMTests(AppEngineTestCase):
         mockQueue = TaskQueueDouble()
         mock(name='Queue.__init__', returns_func=mockQueue.__init__, tracker=None)
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
         self.transNormalToFinal.queueName = 'fantasm-queue' # this is what we'll override
         self.context.headers[HTTP_REQUEST_HEADER_QUEUENAME] = 'queueName'
         self.context.currentState = self.stateInitial
@@ -492,6 +1043,7 @@ class TaskQueueFSMRandomCountdownTests(AppEngineTestCase):
         import time
         mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=mockQueue.add_async, tracker=None)
 
         self.context.currentState = self.stateInitial
         self.context.dispatch('next-event', {})
@@ -524,6 +1076,7 @@ class TaskQueueFSMRetryTests(AppEngineTestCase):
 
         self.mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
         self.loggingDouble = getLoggingDouble()
 
         # drive the machine to ready
@@ -592,6 +1145,7 @@ class DatastoreFSMContinuationBaseTests(AppEngineTestCase):
         setUpByFilename(self, self.FILENAME, instanceName='instanceName', machineName=self.MACHINE_NAME)
         self.mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
         self.loggingDouble = getLoggingDouble()
         self.modelKeys = []
         for i in range(10):
@@ -773,6 +1327,86 @@ class DatastoreFSMContinuationFanInTests(DatastoreFSMContinuationBaseTests):
         self.assertEqual('state-final', self.context.currentState.name)
         self.assertEqual(1, _FantasmFanIn.all(namespace='').count())
 
+    def test_DatastoreFSMContinuationFanIn_semaphore_with_work_package(self):
+        obj = TemporaryStateObject()
+        obj[TASK_NAME_PARAM] = 'taskName'
+        obj[RETRY_COUNT_PARAM] = 0
+        event = self.context.initialize()
+        event = self.context.dispatch(event, obj)
+
+        puts = []
+        put = db.put
+        def countingPut(models, **kwargs):
+            puts.append(models)
+            return put(models, **kwargs)
+        mock('db.put', returns_func=countingPut, tracker=None)
+
+        self.context.dispatch(event, obj) # fans out one work package
+        self.assertEqual([[_FantasmTaskSemaphore, _FantasmFanIn]], [[m.__class__ for m in ms] for ms in puts])
+        work = puts[0][1]
+        semaphore = puts[0][0]
+        self.assertEqual(work.workIndex, semaphore.payload)
+        self.assertEqual(semaphore.payload, memcache.get(semaphore.key().name()))
+
+    def test_DatastoreFSMContinuationFanIn_uses_workIndex_of_semaphore(self):
+        obj = TemporaryStateObject()
+        obj[TASK_NAME_PARAM] = 'taskName'
+        obj[RETRY_COUNT_PARAM] = 0
+        event = self.context.initialize()
+        event = self.context.dispatch(event, obj)
+
+        # the same fork, written concurrently by another Task before the index moved
+        RunOnceSemaphore('workIndex-taskName', None).writeRunOnceSemaphore(payload='other-work-index')
+        memcache.flush_all()
+
+        self.context.dispatch(event, obj) # fans out one work package
+        self.assertEqual(['other-work-index'], [work.workIndex for work in _FantasmFanIn.all(namespace='')])
+        self.assertEqual(1, len(list(_FantasmFanIn.fetchWorkIndex('other-work-index'))))
+        index = self.context[INDEX_PARAM]
+        self.assertEqual(2**16, memcache.get('%s-lock-%d' % (self.context.getTaskName(event, fanIn=True), index)))
+
+    def test_DatastoreFSMContinuationFanIn_fanInExpected(self):
+        state = self.factory.machines[self.MACHINE_NAME][MACHINE_STATES_ATTRIBUTE]['state-fan-in']
+        state.fanInExpected = 1
+        try:
+            obj = TemporaryStateObject()
+            obj[TASK_NAME_PARAM] = 'taskName'
+            obj[RETRY_COUNT_PARAM] = 0
+            event = self.context.initialize()
+            event = self.context.dispatch(event, obj)
+            self.mockQueue.tasks = []
+            self.context.dispatch(event, obj) # fans out one work package
+            (expectedTask, _), (periodTask, _) = self.mockQueue.tasks[-2:]
+            self.assertEqual(periodTask.name + '-expected', expectedTask.name)
+            self.assertTrue(periodTask.eta - expectedTask.eta > datetime.timedelta(seconds=4))
+        finally:
+            state.fanInExpected = None
+
+    def test_DatastoreFSMContinuationFanIn_fanInExpected_retry_counts_once(self):
+        state = self.factory.machines[self.MACHINE_NAME][MACHINE_STATES_ATTRIBUTE]['state-fan-in']
+        state.fanInExpected = 2
+        try:
+            obj = TemporaryStateObject()
+            obj[TASK_NAME_PARAM] = 'taskName'
+            obj[RETRY_COUNT_PARAM] = 0
+            event = self.context.initialize()
+            event = self.context.dispatch(event, obj)
+            retry = self.context.clone()
+            self.mockQueue.tasks = []
+            self.context.dispatch(event, obj) # fans out one work package
+            workIndex = _FantasmFanIn.all(namespace='').get().workIndex
+            self.assertEqual(1, FanInArrivals(workIndex).count())
+
+            obj = TemporaryStateObject()
+            obj[TASK_NAME_PARAM] = 'taskName'
+            obj[RETRY_COUNT_PARAM] = 1
+            retry._FSMContext__obj = obj
+            retry.dispatch(event, obj) # writes the same work package again
+            self.assertEqual(1, FanInArrivals(workIndex).count())
+            self.assertFalse([task for (task, _) in self.mockQueue.tasks if task.name.endswith('-expected')])
+        finally:
+            state.fanInExpected = None
+
     def test_DatastoreFSMContinuationFanInTests_write_lock_error(self):
         obj = TemporaryStateObject()
         obj[TASK_NAME_PARAM] = 'taskName'
@@ -863,6 +1497,7 @@ class NDBDatastoreFSMContinuationTests(AppEngineTestCase):
         setUpByFilename(self, self.FILENAME, instanceName='instanceName', machineName=self.MACHINE_NAME)
         self.mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
         self.loggingDouble = getLoggingDouble()
         self.modelKeys = []
         for i in range(10):
@@ -1050,6 +1685,7 @@ class SpawnTests(unittest.TestCase):
         self.machineName = getMachineNameByFilename(filename)
         self.mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
         # dispatch initial event to get context in correct state
         self.taskName = 'foo'
         self.obj = {TASK_NAME_PARAM: self.taskName}
@@ -1101,6 +1737,31 @@ class SpawnTests(unittest.TestCase):
         self.context.spawn(self.machineName, {'a': '1'}, _currentConfig=self.currentConfig)
         self.assertEqual(len(self.mockQueue.tasks), 1)
 
+class FSMContextInitializeTests(AppEngineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        setUpByFilename(self, 'test-TaskQueueFSMTests.yaml', instanceName='instanceName')
+        self.mockQueue = TaskQueueDouble()
+        mock(name='Queue.add', raises=AssertionError('waited for the Task add alone'), tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
+
+    def tearDown(self):
+        super().tearDown()
+        restore()
+
+    def test_initialize(self):
+        self.assertEqual(FSM.PSEUDO_INIT, self.context.initialize())
+        self.assertEqual(1, len(self.mockQueue.tasks))
+        self.assertEqual(['instanceName'], [i.instanceName for i in _FantasmInstance.all(namespace='')])
+
+    def test_initialize_instance_rows_False(self):
+        self.machineConfig.instanceRows = False
+        context = self.factory.createFSMInstance(self.machineName, instanceName='instanceName')
+        context.initialize()
+        self.assertEqual(1, len(self.mockQueue.tasks))
+        self.assertEqual(0, _FantasmInstance.all(namespace='').count())
+
 class StartStateMachineTests(unittest.TestCase):
     """ Tests for startStateMachine """
 
@@ -1111,6 +1772,7 @@ class StartStateMachineTests(unittest.TestCase):
         self.machineName = getMachineNameByFilename(filename)
         self.mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
 
     def tearDown(self):
         super().tearDown()
@@ -1222,6 +1884,68 @@ class StartStateMachineTests(unittest.TestCase):
         self.assertEqual(len(self.mockQueue.tasks), 1)
         self.assertEqual(self.getTask(0).headers[HTTP_REQUEST_HEADER_QUEUENAME], alternateQueue)
 
+    def test_instanceRows(self):
+        puts = []
+        mock(name='db.put_async', returns_func=lambda models: puts.append(models) or _NoOpRPC(), tracker=None)
+        startStateMachine(self.machineName, [{'a': '1'}, {'b': '2'}], _currentConfig=self.currentConfig)
+        self.assertEqual([], puts)
+        startStateMachine(self.machineName, [{'a': '1'}, {'b': '2'}], _currentConfig=self.currentConfig,
+                          instanceRows=True)
+        self.assertEqual([[_FantasmInstance, _FantasmInstance]], [[m.__class__ for m in ms] for ms in puts])
+        self.assertEqual(4, len(self.mockQueue.tasks))
+
+    def test_instanceRows_instance_rows_False(self):
+        puts = []
+        mock(name='db.put_async', returns_func=lambda models: puts.append(models) or _NoOpRPC(), tracker=None)
+        self.machineConfig.instanceRows = False
+        startStateMachine(self.machineName, [{'a': '1'}, {'b': '2'}], _currentConfig=self.currentConfig,
+                          instanceRows=True)
+        self.assertEqual([], puts)
+        self.assertEqual(2, len(self.mockQueue.tasks))
+
+    def test_manyMachinesQueuedInConcurrentBatches(self):
+        calls = []
+        def addAsync(tasks, transactional=False):
+            calls.append(len(tasks))
+            return self.mockQueue.add_async(tasks, transactional=transactional)
+        mock(name='Queue.add_async', returns_func=addAsync, tracker=None)
+        startStateMachine(self.machineName, [{'a': str(i)} for i in range(250)], _currentConfig=self.currentConfig)
+        self.assertEqual([100, 100, 50], calls)
+        self.assertEqual(len(self.mockQueue.tasks), 250)
+
+    def test_alreadyEnqueuedTasksReported(self):
+        startStateMachine(self.machineName, [{'a': str(i)} for i in range(150)], taskName='foo',
+                          _currentConfig=self.currentConfig)
+        try:
+            startStateMachine(self.machineName, [{'a': str(i)} for i in range(250)], taskName='foo',
+                              _currentConfig=self.currentConfig, raiseIfTaskExists=True)
+            self.fail('TaskAlreadyExistsError should be raised.')
+        except TaskAlreadyExistsError as e:
+            self.assertEqual(['foo--startStateMachine-%d' % i for i in range(150)],
+                             [task.name for task in e.alreadyEnqueuedTasks])
+        self.assertEqual(len(self.mockQueue.tasks), 250)
+
+    def test_queueTasksBoundsRPCsInFlight(self):
+        from fantasm.fsm import _queueTasks
+        inFlight = []
+        class RPC:
+            def __init__(self):
+                inFlight.append(self)
+                self.maxInFlight = len(inFlight)
+            def get_result(self):
+                inFlight.remove(self)
+        rpcs = []
+        class SlowQueue:
+            def __init__(self, name=None):
+                pass
+            def add_async(self, tasks, transactional=False):
+                rpcs.append(RPC())
+                return rpcs[-1]
+        _queueTasks(SlowQueue, 'default', [Task(url='/') for i in range(1000)], maxInFlight=3)
+        self.assertEqual(10, len(rpcs))
+        self.assertEqual(3, max(rpc.maxInFlight for rpc in rpcs))
+        self.assertEqual([], inFlight)
+
 
 class HaltMachineErrorTest(AppEngineTestCase):
 
@@ -1233,6 +1957,7 @@ class HaltMachineErrorTest(AppEngineTestCase):
         setUpByFilename(self, self.FILENAME, instanceName='instanceName', machineName=self.MACHINE_NAME)
         self.mockQueue = TaskQueueDouble()
         mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        mock(name='Queue.add_async', returns_func=self.mockQueue.add_async, tracker=None)
         self.loggingDouble = getLoggingDouble()
 
     def tearDown(self):
@@ -3,12 +3,19 @@
 # pylint: disable=C0111
 # - docstrings not reqd in tests
 
+import io
 import unittest
+import urllib.parse
+from google.appengine.api.taskqueue.taskqueue import Queue # pylint: disable=W0611
 from minimock import mock, restore
-from fantasm_tests.helpers import buildRequest
-from fantasm.handlers import getMachineNameFromRequest
+from fantasm_tests.fixtures import AppEngineTestCase
+from fantasm_tests.helpers import TaskQueueDouble, buildRequest
+from fantasm.handlers import FSMFanInCleanupHandler, getMachineNameFromRequest
+from fantasm.lock import FanInCleanupBucket
+from fantasm.models import _FantasmFanIn
 from fantasm import config # pylint: disable=W0611
                            # - actually used by minimock
+from fantasm import constants
 
 class MockConfigRootUrl:
     """ Simple mock config. """
@@ -72,3 +79,53 @@ class GetMachineNameFromRequestTests(unittest.TestCase):
         mock('config.currentConfiguration', returns=MockConfigRootUrl('/other/mount/point/'), tracker=None)
         name = getMachineNameFromRequest(request)
         self.assertEqual(name, 'MyMachine')
+
+class FSMFanInCleanupHandlerTests(AppEngineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.mockQueue = TaskQueueDouble()
+        mock(name='Queue.add', returns_func=self.mockQueue.add, tracker=None)
+        for workIndex in ('workIndex-1', 'workIndex-2'):
+            for i in range(3):
+                _FantasmFanIn(key=_FantasmFanIn.buildKey(workIndex, 'taskName-%d' % i), workIndex=workIndex).put()
+
+    def tearDown(self):
+        super().tearDown()
+        restore()
+
+    def post(self, params):
+        body = urllib.parse.urlencode(params, doseq=True).encode()
+        environ = {'REQUEST_METHOD': 'POST', 'wsgi.input': io.BytesIO(body)}
+        FSMFanInCleanupHandler()(environ, lambda status, headers: None)
+
+    def test_workIndex(self):
+        self.post({constants.WORK_INDEX_PARAM: 'workIndex-1'})
+        self.assertEqual(['workIndex-2'] * 3, [e.workIndex for e in _FantasmFanIn.all(namespace='')])
+        self.assertEqual([], self.mockQueue.tasks)
+
+    def test_bucket(self):
+        bucket = FanInCleanupBucket('fantasm-cleanup-machine-state-1')
+        bucket.add('workIndex-1')
+        bucket.add('workIndex-2')
+        self.post({constants.FAN_IN_CLEANUP_BUCKET_PARAM: bucket.key})
+        self.assertEqual(0, _FantasmFanIn.all(namespace='').count())
+
+    def test_continues_in_another_task(self):
+        mock('constants.FAN_IN_CLEANUP_BATCH_SIZE', mock_obj=2, tracker=None)
+        mock('constants.FAN_IN_CLEANUP_MAX_BATCHES', mock_obj=3, tracker=None)
+        self.post({constants.WORK_INDEX_PARAM: ['workIndex-1', 'workIndex-2']})
+        self.assertEqual(['workIndex-2'], [e.workIndex for e in _FantasmFanIn.all(namespace='')])
+        (task, _), = self.mockQueue.tasks
+        self.assertEqual(constants.DEFAULT_CLEANUP_URL, task.url)
+        self.assertEqual('__wix__=workIndex-2&__feg__=8', task.payload)
+        self.post({constants.WORK_INDEX_PARAM: 'workIndex-2'})
+        self.assertEqual(0, _FantasmFanIn.all(namespace='').count())
+
+    def test_entityGroups(self):
+        _FantasmFanIn(key=_FantasmFanIn.buildKey('workIndex-3', 'taskName-1', entityGroups=32),
+                      workIndex='workIndex-3').put()
+        self.post({constants.WORK_INDEX_PARAM: 'workIndex-3'})
+        self.assertEqual(1, _FantasmFanIn.all(namespace='').filter('workIndex =', 'workIndex-3').count())
+        self.post({constants.WORK_INDEX_PARAM: 'workIndex-3', constants.FAN_IN_ENTITY_GROUPS_PARAM: 32})
+        self.assertEqual(0, _FantasmFanIn.all(namespace='').filter('workIndex =', 'workIndex-3').count())
@@ -21,6 +21,7 @@ from fantasm.lock import ReadWriteLock # pylint: disable=W0611
                                        # - used by minimock
 from fantasm.models import _FantasmFanIn
 from fantasm.constants import CONTINUATION_RESULTS_KEY
+from fantasm.utils import Metrics
 
 from minimock import mock, restore
 
@@ -129,6 +130,33 @@ class TaskDoubleExecutionTest( AppEngineTestCase ):
         self.assertEqual(1, _FantasmTaskSemaphore.all(namespace='').count())
         self.assertEqual(1, SimpleModel.all().count())
 
+class TaskDoubleExecutionTest_fast( AppEngineTestCase ):
+    """
+    As TaskDoubleExecutionTest, with run_once_semaphore_mode: fast.
+    """
+    def setUp(self):
+        super().setUp()
+        setUpByString(self, SIMPLE_MACHINE.replace('    states:', '    run_once_semaphore_mode: fast\n    states:'),
+                      machineName='SimpleMachine')
+        mock('config.currentConfiguration', returns=self.currentConfig, tracker=None)
+        Metrics.reset()
+
+    def tearDown(self):
+        super().tearDown()
+        restore()
+        Metrics.reset()
+
+    def test(self):
+        self.context.initialize() # queues the first task
+        tq = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        tasks = tq.GetTasks('default')
+        runQueuedTasks(tasksOverride=tasks)
+        self.assertEqual(1, SimpleModel.all().count())
+        runQueuedTasks(tasksOverride=tasks)
+        self.assertEqual(1, SimpleModel.all().count())
+        self.assertEqual(0, _FantasmTaskSemaphore.all(namespace='').count()) # no datastore transaction
+        self.assertEqual(1, Metrics.get(constants.RUN_ONCE_SEMAPHORE_METRIC + '.duplicates'))
+
 class FanInTxnException( AppEngineTestCase ):
     """
     App Engine Tasks occasionally run multiple times. This tests that
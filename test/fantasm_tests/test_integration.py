@@ -1,13 +1,23 @@
 """ Integration tests for testing the Task execution order etc. """
+import base64
 import logging
 import datetime
+import json
 import os
+import pickle
 
 import random # pylint: disable=W0611
-from fantasm.lock import ReadWriteLock
+from fantasm.lock import ReadWriteLock, RunOnceSemaphore
 from fantasm import config # pylint: disable=W0611
-from fantasm.fsm import FSM
-from fantasm.models import _FantasmFanIn, _FantasmInstance, _FantasmLog
+from fantasm.constants import JSON_CONTENT_TYPE, PAYLOAD_CONTEXT_KEY, PAYLOAD_FORMAT_JSON, STATE_PARAM, \
+                              COMPRESSED_PAYLOAD_PREFIX, COMPRESSION_METRIC_TASK, CONTINUATION_COMPLETE_PARAM, \
+                              CONTINUATION_RESULTS_COUNTER_PARAM, CONTINUATION_SHARD_PARAM, CONTINUATION_SHARDS_PARAM, \
+                              CONTEXT_BLOB_MAX_SIZE, DEFAULT_SPAWN_URL, MACHINE_STATES_ATTRIBUTE, TASK_NAME_PARAM
+from fantasm.utils import Metrics
+from fantasm import fsm
+from fantasm.exceptions import SpawnContextTooLargeRuntimeError
+from fantasm.fsm import FSM, startStateMachine
+from fantasm.models import _FantasmFanIn, _FantasmInstance, _FantasmLog, _FantasmContextBlob, ContextBlobReference
 from fantasm_tests.helpers import runQueuedTasks
 from fantasm_tests.helpers import overrideFails
 from fantasm_tests.helpers import setUpByFilename
@@ -17,9 +27,13 @@ from fantasm_tests.test_fsm import TestModel, NDBTestModel
 from fantasm_tests.test_fsm import getLoggingDouble
 from fantasm_tests.actions import ContextRecorder, CountExecuteCallsFanIn, TestFileContinuationFSMAction, \
                                   DoubleContinuation1, DoubleContinuation2, ResultModel, CustomImpl
+from fantasm_tests.ndb_actions import CountShardedResultsFanIn
 from minimock import mock, restore
-from google.appengine.api import datastore_types
+from google.appengine.api import apiproxy_stub_map, datastore_types, memcache
+from google.appengine.ext import db
+from google.appengine.ext import ndb
 from google.appengine.ext.ndb import key as ndb_key
+from google.appengine.ext.ndb import query as ndb_query
 
 # pylint: disable=C0111, W0212, W0612, W0613, C0301
 # - docstrings not reqd in unit tests
@@ -252,6 +266,189 @@ class ParamsTests(RunTasksBaseTest):
     def test_POST_lots_of_different_data_types(self):
         self._test_lots_of_different_data_types('POST')
 
+class JsonPayloadParamsTests(RunTasksBaseTest):
+
+    FILENAME = 'test-TaskQueueFSMTests.yaml'
+    MACHINE_NAME = 'JsonPayloadContextRecorder'
+    METHOD = 'POST'
+
+    def setUp(self):
+        super().setUp()
+        ContextRecorder.CONTEXTS = []
+
+    def tearDown(self):
+        super().tearDown()
+        ContextRecorder.CONTEXTS = []
+
+    def test_payloadFormat(self):
+        self.assertEqual(PAYLOAD_FORMAT_JSON, self.context.payloadFormat)
+
+    def test_task_has_json_payload(self):
+        self.assertEqual(JSON_CONTENT_TYPE, self.context.generateInitializationTask(taskName='taskName').headers['Content-Type'])
+        self.context['foo'] = 'bar'
+        payload = json.loads(self.context.generateInitializationTask(taskName='taskName').payload)
+        self.assertEqual('pseudo-init', payload[STATE_PARAM])
+        self.assertEqual({'foo': 'bar'}, payload[PAYLOAD_CONTEXT_KEY])
+
+    def test_GET_falls_back_to_params(self):
+        self.context.method = 'GET'
+        self.context['foo'] = 'bar'
+        task = self.context.generateInitializationTask(taskName='taskName')
+        self.assertTrue('foo=bar' in task.url)
+
+    def test_lots_of_different_data_types(self):
+        models = list(TestModel.all())
+        dt = datetime.datetime.now() # NOT in UTC
+        nkey1 = ndb_key.Key('NDBTestModel', '1')
+
+        self.context['db_Key'] = models[0].key()
+        self.context['db_Key_defined_in_context_types'] = models[0].key()
+        self.context['bool1'] = False
+        self.context['bool2'] = True
+        self.context['int'] = 1
+        self.context['str'] = b'abc'
+        self.context['unicode'] = '\xe8'
+        self.context['list_of_str_len_1'] = ['a']
+        self.context['list_of_db_Key'] = [models[0].key(), models[1].key()]
+        self.context['list_of_mixed'] = ['a', 1, 'b', 2]
+        self.context['dict_int_keys'] = {1: 1, 2: 2}
+        self.context['dict_str_keys'] = {'a': 1, 'b': 2}
+        self.context['custom'] = CustomImpl(a='A', b='B')
+        self.context['list_of_custom'] = [CustomImpl(a='A', b='B'), CustomImpl(a='AA', b='BB')]
+        self.context['plain_old_object'] = {'a': 'b'}
+        self.context['datetime_obj'] = dt
+        self.context['ndb_Key'] = nkey1
+
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+
+        self.assertEqual(['instanceName--pseudo-init--pseudo-init--state-initial--step-0',
+                          'instanceName--state-initial--next-event--state-final--step-1'], ran)
+
+        # unlike the urlencoded format, values arrive typed without needing an entry in context_types
+        self.assertEqual([{'db_Key': datastore_types.Key.from_path('TestModel', '0', _app='fantasm'),
+                           'db_Key_defined_in_context_types': datastore_types.Key.from_path('TestModel', '0', _app='fantasm'),
+                           'bool1': False,
+                           'bool2': True,
+                           'int': 1,
+                           'str': 'abc',
+                           'unicode': '\xe8',
+                           'list_of_str_len_1': ['a'],
+                           'list_of_db_Key': [datastore_types.Key.from_path('TestModel', '0', _app='fantasm'),
+                                              datastore_types.Key.from_path('TestModel', '1', _app='fantasm')],
+                           'list_of_mixed': ['a', 1, 'b', 2],
+                           'dict_int_keys': {'1': 1, '2': 2},
+                           'dict_str_keys': {'a': 1, 'b': 2},
+                           'custom': CustomImpl(a="A", b="B"),
+                           'list_of_custom': [CustomImpl(a="A", b="B"), CustomImpl(a="AA", b="BB")],
+                           'plain_old_object': {'a': 'b'},
+                           'datetime_obj': dt,
+                           'ndb_Key': nkey1,
+                           '__step__': 1}], ContextRecorder.CONTEXTS)
+
+    def test_values_not_of_their_context_types(self):
+        self.context['int_declared_str'] = 1
+        self.context['str_declared_int'] = '2'
+        self.context['int_declared_float'] = 3
+        self.context['str_declared_bool'] = 'True'
+        self.context['list_of_int_declared_str'] = [4, 5]
+        self.context['binary'] = b'\xff\xfe'
+        self.context.initialize() # queues the first task
+        runQueuedTasks(queueName=self.context.queueName)
+        # cast as in the urlencoded format
+        self.assertEqual([{'int_declared_str': '1',
+                           'str_declared_int': 2,
+                           'int_declared_float': 3.0,
+                           'str_declared_bool': True,
+                           'list_of_int_declared_str': ['4', '5'],
+                           'binary': b'\xff\xfe',
+                           '__step__': 1}], ContextRecorder.CONTEXTS)
+        self.assertEqual(float, ContextRecorder.CONTEXTS[0]['int_declared_float'].__class__)
+
+    def test_undeclared_pickle_marker_is_not_unpickled(self):
+        crafted = {'__pickle__': True, 'value': base64.urlsafe_b64encode(pickle.dumps('unpickled')).decode()}
+        self.context['crafted'] = crafted
+        self.context.initialize() # queues the first task
+        runQueuedTasks(queueName=self.context.queueName)
+        # only keys with a pickle context_types entry are ever unpickled
+        self.assertEqual([{'crafted': crafted, '__step__': 1}], ContextRecorder.CONTEXTS)
+
+class CompressedParamsTests(ParamsTests):
+    """ Every POST task body is compressed; the results must not change. """
+
+    def setUp(self):
+        super().setUp()
+        Metrics.reset()
+        self.machineConfig.compressionThreshold = 0
+        self.context.compressionThreshold = 0
+
+    def test_POST_metrics(self):
+        self._test_not_a_list('POST')
+        self.assertEqual(2, Metrics.get(COMPRESSION_METRIC_TASK + '.count'))
+
+    def test_GET_metrics(self):
+        self._test_not_a_list('GET')
+        self.assertEqual(0, Metrics.get(COMPRESSION_METRIC_TASK + '.count'))
+
+class CompressedJsonPayloadParamsTests(JsonPayloadParamsTests):
+    """ Every POST task body is compressed; the results must not change. """
+
+    def setUp(self):
+        super().setUp()
+        self.machineConfig.compressionThreshold = 0
+        self.context.compressionThreshold = 0
+
+    def test_task_has_json_payload(self):
+        self.context['foo'] = 'bar'
+        payload = self.context.generateInitializationTask(taskName='taskName').payload
+        self.assertTrue(payload.startswith(COMPRESSED_PAYLOAD_PREFIX))
+
+class OffloadParamsTests(RunTasksBaseTest):
+
+    FILENAME = 'test-TaskQueueFSMTests.yaml'
+    MACHINE_NAME = 'ContextRecorder'
+
+    def setUp(self):
+        super().setUp()
+        ContextRecorder.CONTEXTS = []
+        self.machineConfig.offloadThreshold = 100
+        self.context.offloadThreshold = 100
+
+    def tearDown(self):
+        super().tearDown()
+        ContextRecorder.CONTEXTS = []
+
+    def _test_offload(self, method):
+        self.context.method = method
+        self.context['big'] = 'x' * 1000
+        self.context['big_list'] = list(range(1000))
+        self.context['small'] = 'y'
+        self.context['lookalike'] = '__fantasm-blob__:abc'
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        self.assertEqual(['instanceName--pseudo-init--pseudo-init--state-initial--step-0',
+                          'instanceName--state-initial--next-event--state-final--step-1'], ran)
+        self.assertEqual(1, len(ContextRecorder.CONTEXTS))
+        context = ContextRecorder.CONTEXTS[0]
+        self.assertEqual(ContextBlobReference, dict.__getitem__(context, 'big').__class__) # not read yet
+        self.assertEqual({'big': 'x' * 1000,
+                          'big_list': list(range(1000)),
+                          'small': 'y',
+                          'lookalike': '__fantasm-blob__:abc',
+                          '__step__': 1}, {key: context[key] for key in context})
+        self.assertEqual(2, _FantasmContextBlob.all(namespace='').count())
+
+    def test_GET_offload(self):
+        self._test_offload('GET')
+
+    def test_POST_offload(self):
+        self._test_offload('POST')
+
+    def test_POST_json_offload(self):
+        self.machineConfig.payloadFormat = PAYLOAD_FORMAT_JSON
+        self.context.payloadFormat = PAYLOAD_FORMAT_JSON
+        self._test_offload('POST')
+
 class HeadersTests(RunTasksBaseTest):
 
     FILENAME = 'test-TaskQueueFSMTests.yaml'
@@ -401,6 +598,236 @@ class RunTasksTests_NDBDatastoreFSMContinuationTests(RunTasksBaseTest):
 class RunTasksTests_NDBDatastoreFSMContinuationTests_POST(RunTasksTests_NDBDatastoreFSMContinuationTests):
     METHOD = 'POST'
 
+class RunTasksTests_NDBPrefetchingFSMContinuationTests(RunTasksTests_NDBDatastoreFSMContinuationTests):
+
+    MACHINE_NAME = 'NDBPrefetchingFSMContinuationTests'
+
+    def test_NDBDatastoreFSMContinuationTests(self):
+        queries = []
+        fetchPage = ndb_query.Query.fetch_page
+        def countingFetchPage(query, *args, **kwargs):
+            queries.append(kwargs.get('start_cursor'))
+            return fetchPage(query, *args, **kwargs)
+        ndb_query.Query.fetch_page = countingFetchPage
+        try:
+            super().test_NDBDatastoreFSMContinuationTests()
+        finally:
+            ndb_query.Query.fetch_page = fetchPage
+        self.assertEqual([None], queries) # the continuation Tasks use the keys prefetched by the previous one
+
+class RunTasksTests_NDBPrefetchingFSMContinuationTests_POST(RunTasksTests_NDBPrefetchingFSMContinuationTests):
+    METHOD = 'POST'
+
+class RunTasksTests_NDBPrefetchingFSMContinuationTests_LargeBatches(RunTasksBaseTest):
+
+    FILENAME = 'test-NDBDatastoreFSMContinuationTests.yaml'
+    MACHINE_NAME = 'NDBPrefetchingFSMContinuationTests'
+
+    def setUp(self):
+        super().setUp()
+        for i in range(10, 250):
+            NDBTestModel(key=ndb_key.Key('NDBTestModel', 'a-realistic-key-name-%d' % i)).put()
+        self.machineConfig.states['state-continuation'].action.batchSize = 100
+
+    def _runQueuedTasks(self):
+        queries = []
+        fetchPage = ndb_query.Query.fetch_page
+        def countingFetchPage(query, *args, **kwargs):
+            queries.append(kwargs.get('start_cursor'))
+            return fetchPage(query, *args, **kwargs)
+        ndb_query.Query.fetch_page = countingFetchPage
+        try:
+            self.context.initialize() # queues the first task
+            runQueuedTasks(queueName=self.context.queueName)
+        finally:
+            ndb_query.Query.fetch_page = fetchPage
+        self.assertEqual(3, getCounts(self.machineConfig)['state-final']['action'])
+        return queries
+
+    def test_GET_passes_cursor(self):
+        mock('ndb.get_multi', raises=AssertionError('fetched the entities separately'), tracker=None)
+        try:
+            queries = self._runQueuedTasks()
+        finally:
+            restore()
+        self.assertEqual(3, len(queries)) # the keys do not fit in the url, so each Task queries its own page
+        self.assertEqual(None, queries[0])
+
+    def test_POST_prefetches(self):
+        self.context.method = 'POST'
+        self.assertEqual([None], self._runQueuedTasks())
+
+    def test_next_page_resolved_after_execute(self):
+        self.context.method = 'POST'
+        calls = []
+        action = self.machineConfig.states['state-continuation'].action
+        def trackingExecute(context, obj):
+            calls.append('execute')
+            return type(action).execute(action, context, obj)
+        fetchPageAsync = ndb_query.Query.fetch_page_async
+        def trackingFetchPageAsync(query, *args, **kwargs):
+            future = fetchPageAsync(query, *args, **kwargs)
+            if kwargs.get('start_cursor') is None:
+                return future # the first page, from fetch_page()
+            getResult = future.get_result
+            def trackingGetResult():
+                calls.append('next-page')
+                return getResult()
+            future.get_result = trackingGetResult
+            return future
+        action.execute = trackingExecute
+        ndb_query.Query.fetch_page_async = trackingFetchPageAsync
+        try:
+            self._runQueuedTasks()
+        finally:
+            del action.execute
+            ndb_query.Query.fetch_page_async = fetchPageAsync
+        self.assertEqual(['execute', 'next-page'] * 2 + ['execute'], calls)
+
+class RunTasksTests_NDBInlineFSMContinuationTests(RunTasksBaseTest):
+
+    FILENAME = 'test-NDBDatastoreFSMContinuationTests.yaml'
+    MACHINE_NAME = 'NDBInlineFSMContinuationTests'
+
+    def test_NDBInlineFSMContinuationTests(self):
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        self.assertEqual(['instanceName--pseudo-init--pseudo-init--state-initial--step-0',
+                          'instanceName--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-1--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-2--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-3--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--continuation-1-3--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-4--state-continuation--next-event--state-final--step-2'], ran)
+        self.assertEqual({'state-initial': {'entry': 1, 'action': 1, 'exit': 0},
+                          'state-continuation': {'entry': 5, 'action': 5, 'continuation': 5, 'exit': 0},
+                          'state-final': {'entry': 5, 'action': 5, 'exit': 0},
+                          'state-initial--next-event': {'action': 0},
+                          'state-continuation--next-event': {'action': 0}},
+                         getCounts(self.machineConfig))
+
+    def test_continuation_seconds(self):
+        states = self.factory.machines[self.MACHINE_NAME][MACHINE_STATES_ATTRIBUTE]
+        states['state-continuation'].continuationSeconds = 0.000001 # every batch runs out of time
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        # the Tasks of a state without continuation_batches, queued in another order
+        self.assertEqual(sorted(['instanceName--pseudo-init--pseudo-init--state-initial--step-0',
+                                 'instanceName--state-initial--next-event--state-continuation--step-1',
+                                 'instanceName--continuation-1-1--state-initial--next-event--state-continuation--step-1',
+                                 'instanceName--state-continuation--next-event--state-final--step-2',
+                                 'instanceName--continuation-1-2--state-initial--next-event--state-continuation--step-1',
+                                 'instanceName--continuation-1-1--state-continuation--next-event--state-final--step-2',
+                                 'instanceName--continuation-1-3--state-initial--next-event--state-continuation--step-1',
+                                 'instanceName--continuation-1-2--state-continuation--next-event--state-final--step-2',
+                                 'instanceName--continuation-1-4--state-initial--next-event--state-continuation--step-1',
+                                 'instanceName--continuation-1-3--state-continuation--next-event--state-final--step-2',
+                                 'instanceName--continuation-1-4--state-continuation--next-event--state-final--step-2']),
+                         sorted(ran))
+        semaphore = RunOnceSemaphore('inline-continuation-' +
+                                     'instanceName--state-initial--next-event--state-continuation--step-1', None)
+        self.assertEqual('1', semaphore.readRunOnceSemaphore())
+
+    def test_retry_stops_after_completed_batches(self):
+        action = self.machineConfig.states['state-continuation'].action
+        action.failat = 3 # the third batch fails (e.g., runs into the deadline) after two completed
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        self.assertEqual(['instanceName--pseudo-init--pseudo-init--state-initial--step-0',
+                          'instanceName--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--state-initial--next-event--state-continuation--step-1', # the retry
+                          'instanceName--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-1--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-2--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--continuation-1-2--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-3--state-continuation--next-event--state-final--step-2',
+                          'instanceName--continuation-1-4--state-continuation--next-event--state-final--step-2'], ran)
+        semaphore = RunOnceSemaphore('inline-continuation-' +
+                                     'instanceName--state-initial--next-event--state-continuation--step-1', None)
+        self.assertEqual('2', semaphore.readRunOnceSemaphore())
+        self.assertEqual(5, getCounts(self.machineConfig)['state-final']['action'])
+
+    def test_retry_keeps_continuation_seconds(self):
+        states = self.factory.machines[self.MACHINE_NAME][MACHINE_STATES_ATTRIBUTE]
+        states['state-continuation'].continuationSeconds = 0.000001 # every batch runs out of time
+        self.machineConfig.states['state-continuation'].action.failat = 1 # the first attempt completes no batch
+        self.context.initialize() # queues the first task
+        runQueuedTasks(queueName=self.context.queueName)
+        semaphore = RunOnceSemaphore('inline-continuation-' +
+                                     'instanceName--state-initial--next-event--state-continuation--step-1', None)
+        self.assertEqual('1', semaphore.readRunOnceSemaphore())
+        self.assertEqual(5, getCounts(self.machineConfig)['state-final']['action'])
+
+class RunTasksTests_NDBInlineFSMContinuationTests_POST(RunTasksTests_NDBInlineFSMContinuationTests):
+    METHOD = 'POST'
+
+class RunTasksTests_NDBShardedFSMContinuationTests(RunTasksBaseTest):
+
+    FILENAME = 'test-NDBDatastoreFSMContinuationTests.yaml'
+    MACHINE_NAME = 'NDBShardedFSMContinuationTests'
+
+    def setUp(self):
+        super().setUp()
+        self.action = self.machineConfig.states['state-continuation'].action
+        self.action.splitKeys = ['3', '7']
+        self.action.seen = []
+        CountShardedResultsFanIn.TOTALS = []
+
+    def tearDown(self):
+        super().tearDown()
+        self.action.splitKeys = None
+        CountShardedResultsFanIn.TOTALS = []
+
+    def test_NDBShardedFSMContinuationTests(self):
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        self.assertEqual(['instanceName--pseudo-init--pseudo-init--state-initial--step-0',
+                          'instanceName--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--continuation-1-1--continuation-shard-1--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--continuation-1-1--continuation-shard-2--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--continuation-1-1--continuation-shard-0--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--continuation-1-2--continuation-shard-1--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--continuation-1-2--continuation-shard-2--state-initial--next-event--state-continuation--step-1',
+                          'instanceName--state-continuation--next-event--state-fan-in--step-2-1'], ran)
+        self.assertEqual([str(i) for i in range(10)], sorted(self.action.seen))
+        self.assertEqual([10], CountShardedResultsFanIn.TOTALS)
+
+    def test_NDBShardedFSMContinuationTests_scatter(self):
+        self.action.splitKeys = None
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        self.assertTrue([name for name in ran if 'continuation-shard-1' in name])
+        self.assertEqual([str(i) for i in range(10)], sorted(self.action.seen))
+        self.assertEqual([10], CountShardedResultsFanIn.TOTALS)
+
+    def test_startShards_retry(self):
+        class ContinuationRecorder(dict):
+            def continuation(self, nextToken, shard=None):
+                self.setdefault('tokens', []).append((shard, json.loads(nextToken)))
+        first, retry = ContinuationRecorder(), ContinuationRecorder()
+        obj = {TASK_NAME_PARAM: 'taskName'}
+        self.action._startShards(first, obj)
+        self.action.splitKeys = ['5']
+        memcache.flush_all()
+        self.action._startShards(retry, obj) # the already queued shards keep their key ranges
+        self.assertEqual(first, retry)
+        self.assertEqual(3, first[CONTINUATION_SHARDS_PARAM])
+        self.assertEqual([1, 2], [shard for (shard, token) in first['tokens']])
+
+    def test_checkFanInForTotalResultsCount(self):
+        contexts = [{CONTINUATION_COMPLETE_PARAM: True, CONTINUATION_RESULTS_COUNTER_PARAM: 3,
+                     CONTINUATION_SHARD_PARAM: 0, CONTINUATION_SHARDS_PARAM: 2},
+                    {CONTINUATION_COMPLETE_PARAM: False, CONTINUATION_RESULTS_COUNTER_PARAM: 2,
+                     CONTINUATION_SHARD_PARAM: 1, CONTINUATION_SHARDS_PARAM: 2}]
+        self.assertEqual(None, self.action.checkFanInForTotalResultsCount(contexts, {}))
+        contexts.append({CONTINUATION_COMPLETE_PARAM: True, CONTINUATION_RESULTS_COUNTER_PARAM: 4,
+                         CONTINUATION_SHARD_PARAM: 1, CONTINUATION_SHARDS_PARAM: 2})
+        self.assertEqual(7, self.action.checkFanInForTotalResultsCount(contexts, {}))
+
+class RunTasksTests_NDBShardedFSMContinuationTests_POST(RunTasksTests_NDBShardedFSMContinuationTests):
+    METHOD = 'POST'
+
 class RunTasksTests_DatastoreFSMContinuationQueueTests(RunTasksBaseTest):
 
     FILENAME = 'test-DatastoreFSMContinuationTests.yaml'
@@ -842,6 +1269,77 @@ class RunTasksTests_DatastoreFSMContinuationFanInTests(RunTasksBaseTest):
 class RunTasksTests_DatastoreFSMContinuationFanInTests_POST(RunTasksTests_DatastoreFSMContinuationFanInTests):
     METHOD = 'POST'
 
+class RunTasksTests_DatastoreFSMContinuationFanInMaxContextsTests(RunTasksBaseTest):
+
+    FILENAME = 'test-DatastoreFSMContinuationFanInTests.yaml'
+    MACHINE_NAME = 'DatastoreFSMContinuationFanInTests'
+
+    def setUp(self):
+        super().setUp()
+        CountExecuteCallsFanIn.CONTEXTS = []
+        self.factory.machines[self.MACHINE_NAME]['states']['state-fan-in'].fanInMaxContexts = 2
+
+    def tearDown(self):
+        super().tearDown()
+        CountExecuteCallsFanIn.CONTEXTS = []
+
+    def test_DatastoreFSMContinuationFanInTests(self):
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        self.assertEqual(['instanceName--state-continuation--next-event--state-fan-in--step-2-1',
+                          'instanceName--work-index-1--chunk-1--state-continuation--next-event--state-fan-in--step-2',
+                          'instanceName--work-index-1--state-fan-in--next-event--state-final--step-3',
+                          'instanceName--work-index-1--chunk-2--state-continuation--next-event--state-fan-in--step-2',
+                          'instanceName--work-index-1--chunk-1--state-fan-in--next-event--state-final--step-3',
+                          'instanceName--work-index-1--chunk-2--state-fan-in--next-event--state-final--step-3'],
+                         ran[-6:])
+        counts = getCounts(self.machineConfig)
+        self.assertEqual({'entry': 3, 'action': 3, 'exit': 0,
+                          'fan-in-entry': 5, 'fan-in-action': 5, 'fan-in-exit': 0}, counts['state-fan-in'])
+        self.assertEqual({'entry': 3, 'action': 3, 'exit': 0}, counts['state-final'])
+        self.assertEqual([2, 4, 6, 8, 10], sorted(c['__crc__'] for c in CountExecuteCallsFanIn.CONTEXTS))
+        self.assertEqual(0, _FantasmFanIn.all(namespace='').count())
+        self.assertEqual(10, ResultModel.get_by_key_name(self.context.instanceName).total)
+
+class RunTasksTests_DatastoreFSMContinuationFanInMaxContextsTests_POST(
+                                                        RunTasksTests_DatastoreFSMContinuationFanInMaxContextsTests):
+    METHOD = 'POST'
+
+class RunTasksTests_DatastoreFSMContinuationFanInShardsTests(RunTasksBaseTest):
+
+    FILENAME = 'test-DatastoreFSMContinuationFanInTests.yaml'
+    MACHINE_NAME = 'DatastoreFSMContinuationFanInShardsTests'
+
+    def setUp(self):
+        super().setUp()
+        CountExecuteCallsFanIn.CONTEXTS = []
+
+    def tearDown(self):
+        super().tearDown()
+        CountExecuteCallsFanIn.CONTEXTS = []
+
+    def test_DatastoreFSMContinuationFanInShardsTests(self):
+        self.context.initialize() # queues the first task
+        ran = runQueuedTasks(queueName=self.context.queueName)
+        shardTasks = [name for name in ran if '--state-continuation--next-event--state-fan-in--' in name]
+        mergeTasks = [name for name in ran if '--state-fan-in--next-event--state-merge--' in name]
+        self.assertTrue(len(shardTasks) > 1)
+        self.assertEqual(len(shardTasks), len(set(name.split('--shard-')[1] for name in shardTasks)))
+        self.assertEqual(1, len(mergeTasks))
+        self.assertFalse('--shard-' in mergeTasks[0])
+        counts = getCounts(self.machineConfig)
+        self.assertEqual({'entry': len(shardTasks), 'action': len(shardTasks), 'exit': 0,
+                          'fan-in-entry': 5, 'fan-in-action': 5, 'fan-in-exit': 0}, counts['state-fan-in'])
+        self.assertEqual({'entry': 1, 'action': 1, 'exit': 0,
+                          'fan-in-entry': len(shardTasks), 'fan-in-action': len(shardTasks), 'fan-in-exit': 0},
+                         counts['state-merge'])
+        self.assertEqual(0, _FantasmFanIn.all(namespace='').count())
+        self.assertEqual(10, ResultModel.get_by_key_name(self.context.instanceName).total)
+
+class RunTasksTests_DatastoreFSMContinuationFanInShardsTests_POST(
+                                                        RunTasksTests_DatastoreFSMContinuationFanInShardsTests):
+    METHOD = 'POST'
+
 class RunTasksTests_DatastoreFSMContinuationFanInGroupDefaultTests(RunTasksBaseTest):
 
     FILENAME = 'test-DatastoreFSMContinuationFanInTests.yaml'
@@ -1514,6 +2012,97 @@ class FinalStateCanEmitEventTests(RunTasksBaseTest):
         self.assertEqual(1, counts['OptionalFinalState']['action'])
         self.assertEqual(1, counts['FinalState']['action'])
 
+class TreeSpawnTests(RunTasksBaseTest):
+
+    FILENAME = 'test-SpawnTests.yaml'
+    MACHINE_NAME = 'MachineToSpawn'
+
+    def startMachines(self, number):
+        startStateMachine(self.MACHINE_NAME, [{'i': i} for i in range(number)], taskName='tree',
+                          countdown=list(range(number)), treeSpawnSize=2)
+
+    def getTaskNames(self):
+        return sorted(task['name'] for task in apiproxy_stub_map.apiproxy.GetStub('taskqueue').GetTasks('default'))
+
+    def test_treeSpawn(self):
+        self.startMachines(25)
+        # 13 slices, in 7 groups of 2 (the last has 1)
+        self.assertEqual(['tree--spawn-%d' % i for i in range(7)],
+                         self.getTaskNames())
+        self.assertEqual(13, _FantasmContextBlob.all(namespace='').count())
+        runQueuedTasks(queueName='default')
+        counts = getCounts(self.machineConfig)
+        self.assertEqual({'entry': 25, 'action': 25, 'exit': 25}, counts['MachineToSpawn-InitialState'])
+
+    def test_treeSpawn_taskNames(self):
+        self.startMachines(5)
+        runQueuedTasks(queueName='default')
+        names = self.getTaskNames()
+        self.assertEqual(['tree--spawn-0--startStateMachine-0', 'tree--spawn-0--startStateMachine-1',
+                          'tree--spawn-1--startStateMachine-0', 'tree--spawn-1--startStateMachine-1',
+                          'tree--spawn-2--startStateMachine-0'],
+                         [name for name in names if 'startStateMachine' in name])
+
+    def test_treeSpawn_idempotent(self):
+        self.startMachines(25)
+        self.startMachines(25)
+        self.assertEqual(7, len(self.getTaskNames()))
+        self.assertEqual(13, _FantasmContextBlob.all(namespace='').count())
+
+    def test_treeSpawn_transactional(self):
+        def tx():
+            startStateMachine(self.MACHINE_NAME, [{'i': i} for i in range(25)], transactional=True,
+                              treeSpawnSize=2)
+        db.run_in_transaction(tx)
+        self.assertEqual(1, len(self.getTaskNames()))
+        runQueuedTasks(queueName='default')
+        counts = getCounts(self.machineConfig)
+        self.assertEqual({'entry': 25, 'action': 25, 'exit': 25}, counts['MachineToSpawn-InitialState'])
+
+    def test_treeSpawn_instanceRows(self):
+        startStateMachine(self.MACHINE_NAME, [{'i': i} for i in range(5)], taskName='tree', treeSpawnSize=2,
+                          instanceRows=True)
+        self.assertEqual(0, _FantasmInstance.all(namespace='').count())
+        runQueuedTasks(queueName='default')
+        self.assertEqual(5, _FantasmInstance.all(namespace='').count())
+
+    def test_treeSpawn_target(self):
+        self.machineConfig.target = 'spawner-target'
+        queued = []
+        queueTasks = fsm._queueTasks
+        def recordingQueueTasks(Queue, queueName, tasks, **kwargs):
+            queued.extend(tasks)
+            return queueTasks(Queue, queueName, tasks, **kwargs)
+        mock('fsm._queueTasks', returns_func=recordingQueueTasks, tracker=None)
+        try:
+            self.startMachines(25)
+            runQueuedTasks(queueName='default')
+        finally:
+            restore()
+        spawners = [task for task in queued if task.url == DEFAULT_SPAWN_URL]
+        self.assertTrue(spawners)
+        self.assertEqual(set(['spawner-target']), set(task.target for task in spawners))
+
+    def test_treeSpawn_splits_large_slices(self):
+        big = 'x' * (CONTEXT_BLOB_MAX_SIZE // 3)
+        startStateMachine(self.MACHINE_NAME, [{'i': i, 'big': big + str(i)} for i in range(8)], taskName='tree',
+                          treeSpawnSize=4)
+        # 2 slices of 4 contexts, each split in halves of 2 contexts
+        slices = [pickle.loads(blob.value) for blob in _FantasmContextBlob.all(namespace='')]
+        self.assertEqual([2, 2, 2, 2], [len(contexts) for (contexts, countdowns) in slices])
+        self.assertEqual(list(range(8)), sorted(context['i'] for (contexts, _) in slices for context in contexts))
+
+    def test_treeSpawn_context_too_large(self):
+        contexts = [{'big': 'x' * CONTEXT_BLOB_MAX_SIZE} for i in range(3)]
+        self.assertRaises(SpawnContextTooLargeRuntimeError, startStateMachine, self.MACHINE_NAME, contexts,
+                          taskName='tree', treeSpawnSize=2)
+        self.assertEqual(0, _FantasmContextBlob.all(namespace='').count())
+
+    def test_noTreeSpawn_under_treeSpawnSize(self):
+        startStateMachine(self.MACHINE_NAME, [{'i': 0}, {'i': 1}], taskName='tree', treeSpawnSize=2)
+        self.assertEqual(['tree--startStateMachine-0', 'tree--startStateMachine-1'],
+                         self.getTaskNames())
+
 class SpawnMachinesTests(RunTasksBaseTest):
 
     FILENAME = 'test-SpawnTests.yaml'
@@ -6,11 +6,14 @@ import random
 import time # pylint: disable=W0611
 
 from fantasm_tests.fixtures import AppEngineTestCase
-from fantasm.lock import ReadWriteLock, RunOnceSemaphore
+from fantasm import constants, lock # pylint: disable=W0611
+from fantasm.lock import (FanInArrivals, FanInCleanupBucket, InProcessLockBackend, ReadWriteLock, RunOnceSemaphore,
+                          getLockBackend, setLockBackend)
 from fantasm.fsm import FSMContext
 from fantasm.state import State
 from fantasm.exceptions import FanInWriteLockFailureRuntimeError
 from fantasm.models import _FantasmTaskSemaphore
+from fantasm.utils import Metrics
 
 from fantasm_tests.helpers import getLoggingDouble
 
@@ -91,6 +94,14 @@ class ReadWriteLockTest(AppEngineTestCase):
         lock.releaseWriteLock(index)
         self.assertEqual(65536, memcache.get(lock.lockKey(index)))
 
+    def test_releaseWriteLockAsync(self):
+        lock = ReadWriteLock('foo', self.context)
+        index = lock.currentIndex()
+        lock.acquireWriteLock(index)
+        self.assertEqual(65537, memcache.get(lock.lockKey(index)))
+        lock.releaseWriteLockAsync(index).get_result()
+        self.assertEqual(65536, memcache.get(lock.lockKey(index)))
+
     def test_acquireReadLock_before_acquireWriteLock(self):
         lock = ReadWriteLock('foo', self.context)
         index = lock.currentIndex()
@@ -143,6 +154,66 @@ class ReadWriteLockTest(AppEngineTestCase):
         self.assertEqual(["Gave up waiting for all fan-in work items with read lock 'foo-lock-3626764238'."],
                          self.loggingDouble.messages['critical'])
 
+class InProcessLockBackendTest(AppEngineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.state = State('name', None, None, None)
+        self.context = FSMContext(self.state, queueName='default')
+        self.context.currentState = self.state
+        self.backend = InProcessLockBackend()
+        self.defaultBackend = getLockBackend()
+        setLockBackend(self.backend)
+
+    def tearDown(self):
+        setLockBackend(self.defaultBackend)
+        super().tearDown()
+
+    def test_acquireReadLock(self):
+        lock = ReadWriteLock('foo', self.context)
+        index = lock.currentIndex()
+        self.assertEqual(index, self.backend.get(lock.indexKey()))
+        self.assertTrue(lock.acquireWriteLock(index))
+        self.assertEqual(65537, self.backend.get(lock.lockKey(index)))
+        lock.closeWriteLock(index)
+        self.assertFalse(lock.writersDone(index))
+        self.assertEqual(index + 1, self.backend.get(lock.indexKey()))
+        lock.releaseWriteLockAsync(index).get_result()
+        self.assertTrue(lock.writersDone(index))
+        self.assertEqual(32768, self.backend.get(lock.lockKey(index)))
+        self.assertRaises(FanInWriteLockFailureRuntimeError, lock.acquireWriteLock, index)
+        self.assertEqual(None, memcache.get(lock.lockKey(index)))
+
+    def test_counters(self):
+        self.assertEqual(None, self.backend.incr('foo'))
+        self.assertEqual(None, self.backend.decr('foo'))
+        self.assertEqual(11, self.backend.incr('foo', initialValue=10))
+        self.assertEqual(0, self.backend.decr('foo', 20))
+        self.backend.add('foo', 5)
+        self.assertEqual(0, self.backend.get('foo'))
+        self.assertEqual({'foo': 0}, self.backend.getMulti(['foo', 'bar']))
+
+    def test_FanInArrivals(self):
+        arrivals = FanInArrivals('workIndex')
+        self.assertEqual(0, arrivals.count())
+        self.assertEqual(None, arrivals.span())
+        for _ in range(20):
+            arrivals.arrive()
+        self.assertEqual(20, arrivals.count())
+        self.assertTrue(len(self.backend.getMulti(arrivals.shardKeys)) > 1)
+        arrivals.recordSpan(100.0)
+        self.assertEqual(0, arrivals.span())
+        arrivals.recordSpan(107.0)
+        self.assertEqual(7, arrivals.span())
+
+    def test_FanInCleanupBucket(self):
+        bucket = FanInCleanupBucket.forPeriod('machine', 'state', 60, 6059.0)
+        self.assertEqual('fantasm-cleanup-machine-state-100', bucket.key)
+        self.assertEqual([], bucket.workIndexes())
+        self.assertEqual(1, bucket.add('workIndex-1'))
+        self.assertEqual(2, bucket.add('workIndex-2'))
+        self.assertEqual(['workIndex-1', 'workIndex-2'], FanInCleanupBucket(bucket.key).workIndexes())
+
 class RunOnceSemaphoreTest(AppEngineTestCase):
 
     TRANSACTIONAL = True
@@ -156,6 +227,37 @@ class RunOnceSemaphoreTest(AppEngineTestCase):
         restore()
         super().tearDown()
 
+    def test_addRunOnceSemaphores(self):
+        lock._recentSemaphoreKeys.clear()
+        Metrics.reset()
+        self.assertEqual(set(), RunOnceSemaphore.addRunOnceSemaphores(['foo', 'bar'], payload='payload'))
+        self.assertEqual('payload', memcache.get('foo'))
+        self.assertEqual({'foo'}, RunOnceSemaphore.addRunOnceSemaphores(['foo', 'baz'], payload='payload'))
+        self.assertEqual(1, Metrics.get('runOnceSemaphore.lruHits'))
+
+        # another process finds them in memcache
+        lock._recentSemaphoreKeys.clear()
+        self.assertFalse(RunOnceSemaphore('bar', None).addRunOnceSemaphore(payload='payload'))
+        self.assertTrue(RunOnceSemaphore('qux', None).addRunOnceSemaphore(payload='payload'))
+        self.assertEqual(0, _FantasmTaskSemaphore.all(namespace='').count())
+
+    def test_addRunOnceSemaphores_memcache_unavailable(self):
+        lock._recentSemaphoreKeys.clear()
+        Metrics.reset()
+        mock('memcache.add_multi', returns_func=lambda mapping, **kwargs: list(mapping), tracker=None)
+        mock('memcache.get_multi', returns={}, tracker=None)
+        self.assertEqual(set(), RunOnceSemaphore.addRunOnceSemaphores(['foo'], payload='payload'))
+        self.assertEqual(1, _FantasmTaskSemaphore.all(namespace='').count())
+        lock._recentSemaphoreKeys.clear()
+        self.assertEqual({'foo'}, RunOnceSemaphore.addRunOnceSemaphores(['foo'], payload='payload'))
+        self.assertEqual(2, Metrics.get('runOnceSemaphore.datastoreFallbacks'))
+
+    def test_addRunOnceSemaphores_lru_is_bounded(self):
+        lock._recentSemaphoreKeys.clear()
+        mock('constants.RUN_ONCE_SEMAPHORE_LRU_SIZE', mock_obj=2, tracker=None)
+        RunOnceSemaphore.addRunOnceSemaphores(['a', 'b', 'c'], payload='payload')
+        self.assertEqual(['b', 'c'], list(lock._recentSemaphoreKeys))
+
     def test_writeRunOnceSemaphore(self):
         sem = RunOnceSemaphore('foo', None)
         self.assertEqual(None, memcache.get('foo'))
@@ -167,6 +269,31 @@ class RunOnceSemaphoreTest(AppEngineTestCase):
         self.assertEqual(1, _FantasmTaskSemaphore.all(namespace='').count())
         self.assertEqual('payload', _FantasmTaskSemaphore.all(namespace='').get().payload)
 
+    def test_writeRunOnceSemaphoreWithEntities(self):
+        sem = RunOnceSemaphore('foo', None)
+        built = []
+        def buildEntities(payload):
+            built.append(payload)
+            return [_FantasmTaskSemaphore(key_name='entity-' + payload, payload=payload, namespace='')]
+        success, payload = sem.writeRunOnceSemaphoreWithEntities(buildEntities, payload='payload')
+        self.assertTrue(success)
+        self.assertEqual('payload', payload)
+        self.assertEqual('payload', memcache.get('foo'))
+        self.assertEqual(['foo', 'entity-payload'],
+                         sorted([e.key().name() for e in _FantasmTaskSemaphore.all(namespace='')], key=len))
+
+        # a later writer agrees on the first payload, with or without memcache
+        success, payload = sem.writeRunOnceSemaphoreWithEntities(buildEntities, payload='other')
+        self.assertFalse(success)
+        self.assertEqual('payload', payload)
+        memcache.delete('foo')
+        success, payload = sem.writeRunOnceSemaphoreWithEntities(buildEntities, payload='other')
+        self.assertFalse(success)
+        self.assertEqual('payload', payload)
+        self.assertEqual('payload', memcache.get('foo'))
+        self.assertEqual(['payload'] * 3, built)
+        self.assertEqual(2, _FantasmTaskSemaphore.all(namespace='').count())
+
     def test_writeRunOnceSemaphore_second_time_False(self):
         sem = RunOnceSemaphore('foo', None)
         self.assertEqual(None, memcache.get('foo'))
@@ -264,6 +391,15 @@ class RunOnceSemaphoreTest(AppEngineTestCase):
         payload = sem.readRunOnceSemaphore('payload', transactional=self.TRANSACTIONAL)
         self.assertEqual('payload', payload)
 
+    def test_readRunOnceSemaphore_any_payload(self):
+        sem = RunOnceSemaphore('foo', None)
+        self.assertEqual(None, sem.readRunOnceSemaphore(transactional=self.TRANSACTIONAL))
+        sem.writeRunOnceSemaphore('payload', transactional=self.TRANSACTIONAL)
+        self.assertEqual('payload', sem.readRunOnceSemaphore(transactional=self.TRANSACTIONAL))
+        memcache.delete('foo')
+        self.assertEqual('payload', sem.readRunOnceSemaphore(transactional=self.TRANSACTIONAL))
+        self.assertEqual(0, len(self.loggingDouble.messages['critical']))
+
     def test_readRunOnceSemaphore_payload_error(self):
         sem = RunOnceSemaphore('foo', None)
         sem.writeRunOnceSemaphore('payload', transactional=self.TRANSACTIONAL)
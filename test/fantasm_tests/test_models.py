@@ -4,8 +4,11 @@
 # - docstrings not reqd in unit tests
 
 import datetime
-from fantasm.models import _FantasmFanIn
+from fantasm import constants
+from fantasm.models import _FantasmFanIn, _FantasmContextBlob, StoredList
+from fantasm.utils import Metrics
 from fantasm_tests.fixtures import AppEngineTestCase
+from google.appengine.api import datastore
 from google.appengine.ext import db
 
 class TestModel(db.Model):
@@ -47,3 +50,58 @@ class FastasmFanInTest(AppEngineTestCase):
         model.put()
         model = db.get(model.key())
         self.assertEqual({'a': nows}, model.context)
+
+    def test_compressed(self):
+        model = _FantasmFanIn()
+        model.compressionThreshold = 10
+        model.context = {'a': 'x' * 1000, 'b': self.testModel.key()}
+        model.put()
+        raw = datastore.Get(model.key())['context']
+        self.assertTrue(raw.startswith(constants.COMPRESSED_JSON_PREFIX))
+        self.assertTrue(len(raw) < 1000)
+        model = db.get(model.key())
+        self.assertEqual({'a': 'x' * 1000, 'b': self.testModel.key()}, model.context)
+
+    def test_under_compression_threshold(self):
+        model = _FantasmFanIn()
+        model.compressionThreshold = 1000
+        model.context = {'a': 'x'}
+        model.put()
+        self.assertEqual('{"a": "x"}', datastore.Get(model.key())['context'])
+
+    def test_compression_metrics(self):
+        Metrics.reset()
+        model = _FantasmFanIn()
+        model.compressionThreshold = 0
+        model.context = {'a': 'x' * 1000}
+        model.put()
+        self.assertEqual(1, Metrics.get(constants.COMPRESSION_METRIC_JSON_PROPERTY + '.count'))
+        self.assertTrue(Metrics.ratio(constants.COMPRESSION_METRIC_JSON_PROPERTY) < 0.1)
+
+class StoredListTest(AppEngineTestCase):
+
+    def test_store(self):
+        storedList = StoredList.store(list(range(25)), 10)
+        self.assertEqual(25, storedList.length)
+        self.assertEqual(3, _FantasmContextBlob.all().count())
+        self.assertEqual(storedList.digest, StoredList.store(list(range(25)), 10).digest)
+        self.assertNotEqual(storedList.digest, StoredList.store(list(range(25)), 5).digest)
+
+    def test_slice(self):
+        storedList = StoredList.store(['item%d' % i for i in range(25)], 10)
+        storedList = StoredList(storedList.digest, storedList.length, storedList.chunkSize) # as rebuilt from a token
+        self.assertEqual(['item0', 'item1'], storedList.slice(0, 2))
+        self.assertEqual(['item%d' % i for i in range(8, 22)], storedList.slice(8, 22))
+        self.assertEqual(['item24'], storedList.slice(24, 30))
+        self.assertEqual([], storedList.slice(25, 30))
+
+    def test_slice_reads_only_its_chunks(self):
+        storedList = StoredList.store(list(range(25)), 10)
+        db.delete(storedList._chunkKey(0))
+        self.assertEqual([10, 11], storedList.slice(10, 12))
+        self.assertRaises(KeyError, storedList.slice, 8, 12)
+
+    def test_empty(self):
+        storedList = StoredList.store([], 10)
+        self.assertEqual(0, storedList.length)
+        self.assertEqual([], storedList.slice(0, 10))